@@ -1,4 +1,10 @@
 
 from coders import *
 from primitives import *
-from containers import *
\ No newline at end of file
+from containers import *
+from storage import *
+from streams import *
+from indexing import *
+from routing import *
+from parallel import *
+from delta import *
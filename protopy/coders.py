@@ -1,5 +1,237 @@
+import threading
+from contextlib import contextmanager
 from cStringIO import StringIO
 
+import enum34
+from streams import IovWriter, skip_bytes
+
+
+class Validation(str, enum34.Enum):
+    """
+    Validation policies for coders.
+
+    STRICT validates values both when encoding and when decoding.
+    DECODE_ONLY trusts the values we encode ourselves, but still validates
+    whatever is decoded.
+    OFF skips validation entirely. Use it only when both ends are trusted.
+    """
+    STRICT = "strict"
+    DECODE_ONLY = "decode-only"
+    OFF = "off"
+
+
+class _Policy(threading.local):
+    """
+    The validation policy in effect in the current thread, resolved ahead of
+    time, since coders check it for every value.
+
+    The class attributes hold the process-wide policy. The `validation`
+    context manager overrides them with instance (per thread) attributes.
+    """
+    # The policy set by the `validation` context manager, or None.
+    override = None
+    # The policy in effect for coders without a policy of their own.
+    policy = Validation.STRICT
+    # Whether values are validated when encoded / decoded under `policy`.
+    encode = True
+    decode = True
+
+
+def _apply(target, policy):
+    target.policy = policy
+    target.encode = policy is Validation.STRICT
+    target.decode = policy is not Validation.OFF
+
+
+def _coder_policy(policy):
+    # A class of its own, whose attributes hold `policy`.
+    policy_class = type("_CoderPolicy", (_Policy,), {})
+    _apply(policy_class, policy)
+    return policy_class()
+
+
+_policy = _Policy()
+
+# The policy in effect in the current thread, for each value of the
+# ``validation`` attribute of coders: those without a policy of their own
+# follow `_policy`, the others theirs, unless the `validation` context
+# manager overrides them all. Coders that validate every value check
+# ``_policies[self.validation].encode`` (or ``.decode``), since a method call
+# costs about as much as the validation it may skip.
+_policies = {policy: _coder_policy(policy) for policy in Validation}
+_policies[None] = _policy
+
+# Holds the active sessions, per thread.
+_local = threading.local()
+
+
+def set_validation(policy):
+    """
+    Set the process-wide validation policy.
+
+    :param policy: One of Validation's values.
+    """
+    # Threads that have not overridden the policy read it from the class.
+    _apply(_Policy, Validation(policy))
+
+
+def get_validation(coder=None):
+    """
+    Return the validation policy in effect for `coder`.
+
+    The policy is resolved in the following order:
+    1. A policy set for the current call using the `validation` context.
+    2. The ``validation`` attribute of the coder (or of its class).
+    3. The process-wide policy, set by `set_validation`.
+
+    :param coder: Optional. The coder that is about to validate.
+    :return: One of Validation's values.
+    """
+    if _policy.override is None:
+        policy = getattr(coder, "validation", None)
+        if policy is not None:
+            return policy
+    return _policy.policy
+
+
+@contextmanager
+def validation(policy):
+    """
+    Temporarily override the validation policy of the current thread.
+
+    Usage:
+        with validation(Validation.OFF):
+            packet.encode()
+
+    :param policy: One of Validation's values.
+    """
+    policy = Validation(policy)
+    previous = [(target, target.__dict__.copy())
+                for target in _policies.itervalues()]
+    for target, _ in previous:
+        target.override = policy
+        _apply(target, policy)
+    try:
+        yield
+    finally:
+        for target, attributes in previous:
+            target.__dict__.clear()
+            target.__dict__.update(attributes)
+
+
+class Session(object):
+    """
+    Holds the state of stateful coders for the lifetime of a connection or a
+    file.
+
+    Some coders, like streaming compression, carry state from one message to
+    the next. Such a state must live exactly as long as the connection or file
+    the messages go through. A Session holds these states, and coders find it
+    by looking for the active session of the current thread:
+
+        session = Session()  # One per connection.
+        with session:
+            packet.write_to(sock_file)
+    """
+
+    def __init__(self):
+        self._states = {}
+        # The actions that revert the changes made to the states during the
+        # current `atomic` block, or None outside of it.
+        self._undo = None
+
+    def state(self, coder, factory):
+        """
+        Return the state of a coder in this session, creating it if needed.
+
+        :param coder: The coder the state belongs to.
+        :param factory: A callable that creates the initial state.
+        :return: The state of `coder`.
+        """
+        try:
+            return self._states[coder]
+        except KeyError:
+            state = self._states[coder] = factory()
+            return state
+
+    def reset(self):
+        """
+        Discard the states of all the coders.
+        """
+        self._states.clear()
+
+    def used(self):
+        """
+        :return: Whether any coder has a state in this session.
+        """
+        return bool(self._states)
+
+    def undo(self, action, *args):
+        """
+        Register an action that reverts a change a coder has made to its
+        state, in case the message being encoded is discarded (see `atomic`).
+
+        :param action: A callable.
+        :param args: The arguments to call `action` with.
+        """
+        if self._undo is not None:
+            self._undo.append((action, args))
+
+    def undoable(self):
+        """
+        :return: Whether the changes made to the states may have to be
+            reverted (inside an `atomic` block). Coders whose undo actions
+            are expensive to prepare register them only then.
+        """
+        return self._undo is not None
+
+    @contextmanager
+    def atomic(self):
+        """
+        Activate this session for encoding a single message, reverting the
+        changes coders make to their states if the encoding fails.
+
+        Without it, a message that fails halfway may leave states that refer
+        to parts of it that were never sent.
+
+        Usage:
+            with session.atomic():
+                packet.write_to(buf)
+        """
+        outer = self._undo
+        self._undo = []
+        try:
+            with self:
+                yield
+        except:
+            for action, args in reversed(self._undo):
+                action(*args)
+            raise
+        else:
+            if outer is not None:
+                # Reverted along with the enclosing message.
+                outer.extend(self._undo)
+        finally:
+            self._undo = outer
+
+    def __enter__(self):
+        sessions = getattr(_local, "sessions", None)
+        if sessions is None:
+            sessions = _local.sessions = []
+        sessions.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _local.sessions.pop()
+
+
+def current_session():
+    """
+    :return: The innermost active Session of the current thread, or None.
+    """
+    sessions = getattr(_local, "sessions", None)
+    return sessions[-1] if sessions else None
+
 
 class Encoder(object):
 
@@ -69,6 +301,23 @@ class Coder(Encoder, Decoder):
     Aggregates both Encoder and Decoder interfaces.
     """
 
+    # The validation policy of this coder. None means "use the global policy".
+    # Can be overridden per class or per instance, before Records using the
+    # coder are created (they group their members by policy).
+    validation = None
+
+    def validate_on_encode(self):
+        """
+        :return: Whether values should be validated before they are encoded.
+        """
+        return _policies[self.validation].encode
+
+    def validate_on_decode(self):
+        """
+        :return: Whether decoded values should be validated.
+        """
+        return _policies[self.validation].decode
+
     def default_value(self):
         """
         Return the value that is considered "default" or "empty" for this type.
@@ -76,11 +325,59 @@ class Coder(Encoder, Decoder):
         """
         raise NotImplementedError("Subclasses must implement")
 
+    def fixed_size(self):
+        """
+        Return the number of bytes every value of this coder is encoded into,
+        or None if the size of the encoding depends on the value.
+        """
+        return None
+
+    def skip(self, stream):
+        """
+        Advance a stream past an encoded value, decoding as little of it as
+        possible. Used to find the boundaries of values quickly.
+
+        Values are not validated, so skipping may succeed where decoding
+        would fail.
+
+        :param stream: A readable, seekable file-like object.
+        :raise ValueError: If the end of the data is reached before the end of
+            the value.
+        """
+        # Subclasses are encouraged to override if they can tell the size of
+        # their values without decoding them.
+        size = self.fixed_size()
+        if size is None:
+            self.read_from(stream)
+        else:
+            skip_bytes(stream, size)
+
+    def encode_iov(self, value, threshold=IovWriter.DEFAULT_THRESHOLD):
+        """
+        Encode a value as a list of buffers, for scatter-gather output with
+        `write_iov` or `send_iov`.
+
+        Small parts of the encoding are coalesced, while large payloads are
+        passed by reference rather than copied. They must not be modified
+        until the buffers are sent.
+
+        :param value: The value to encode.
+        :param threshold: The size, in bytes, from which payloads are passed
+            by reference.
+        :return: A list of buffers whose concatenation is the encoding.
+        :raise ValueError: If this value could not be encoded.
+        """
+        writer = IovWriter(threshold)
+        self.write_to(value, writer)
+        return writer.buffers()
+
 
 class SelfEncodable(object):
     """
     Represents an object that can decode itself.
     """
+    # So that subclasses may have no __dict__ (see FrozenRecord).
+    __slots__ = ()
 
     def write_to(self, stream):
         """
@@ -105,6 +402,19 @@ class SelfEncodable(object):
         self.write_to(stream)
         return stream.getvalue()
 
+    def encode_iov(self, threshold=IovWriter.DEFAULT_THRESHOLD):
+        """
+        Encode this object as a list of buffers. See `Coder.encode_iov`.
+
+        :return: A list of buffers whose concatenation is the encoding.
+        :raise ValueError: If this object could not be encoded.
+        """
+        writer = IovWriter(threshold)
+        self.write_to(writer)
+        return writer.buffers()
+
 
 __all__ = (Encoder.__name__, Decoder.__name__, Coder.__name__,
-           SelfEncodable.__name__,)
+           SelfEncodable.__name__, Validation.__name__, set_validation.__name__,
+           get_validation.__name__, validation.__name__, Session.__name__,
+           current_session.__name__)
@@ -1,13 +1,25 @@
 import operator
+import struct
 import sys
+import zlib
+from cStringIO import StringIO
 from collections import OrderedDict
-from functools import total_ordering
+from copy import deepcopy
+from functools import partial, total_ordering
 
-from coders import Coder, SelfEncodable
-from primitives import UnsignedInteger, ByteOrder
+from coders import Coder, SelfEncodable, Validation, Session, \
+    current_session, validation, _policies
+from primitives import UnsignedInteger, ByteOrder, VarUInt
+from streams import BufferedSource, BufferWriter, skip_bytes
 import enum34
 from proxy import Proxy
 
+# Values of these types can be shared by records.
+_IMMUTABLE_TYPES = (int, long, float, basestring, type(None))
+
+# Stands for a default value that is not valid, and never is a value.
+_INVALID = object()
+
 
 class EnumerationMeta(enum34.EnumMeta, Coder):
     """
@@ -20,26 +32,64 @@ class EnumerationMeta(enum34.EnumMeta, Coder):
     def __new__(mcs, name, bases, classdict):
         width = classdict.pop("__width__", mcs.DEFAULT_WIDTH)
         byte_oder = classdict.pop("__byte_order__", mcs.DEFAULT_BYTE_ORDER)
-        coder = UnsignedInteger(width=width, byte_order=byte_oder)
-        classdict["__coder__"] = coder
-        return super(EnumerationMeta, mcs).__new__(mcs, name, bases, classdict)
+        # A class may specify its own coder, for example VarUInt().
+        if classdict.get("__coder__") is None:
+            classdict["__coder__"] = UnsignedInteger(
+                width=width, byte_order=byte_oder)
+        enum_class = super(EnumerationMeta, mcs).__new__(mcs, name, bases,
+                                                         classdict)
+
+        # An enum has only a handful of possible encodings, so they are
+        # computed once, along with the reverse mapping.
+        coder = enum_class.__coder__
+        encodings = {}
+        with validation(Validation.STRICT):
+            for member in enum_class:
+                try:
+                    encodings[member] = coder.encode(member)
+                except ValueError:
+                    # Fails when it is actually encoded.
+                    pass
+        enum_class._encodings = encodings
+        enum_class._first_member = next(iter(enum_class), None)
+        enum_class._members_by_encoding = {
+            encoded: member for member, encoded in encodings.iteritems()}
+        return enum_class
 
     def default_value(self):
         """
         :return: The first ordinal member in the enum.
         """
-        if len(self.__members__) == 0:
+        if self._first_member is None:
             raise ValueError("%s class does not have any members" %
                              (self.__name__,))
+        return self._first_member
 
-        _, value = self.__members__.items()[0]
-        return value
+    def fixed_size(self):
+        return self.__coder__.fixed_size()
 
     def write_to(self, value, stream):
-        self.__coder__.write_to(self(value), stream)
+        encoded = self._encodings.get(value)
+        if encoded is None:
+            # Not a member, but maybe its value.
+            encoded = self._encodings.get(self(value))
+        if encoded is None:
+            return self.__coder__.write_to(self(value), stream)
+        stream.write(encoded)
+        return len(encoded)
 
     def read_from(self, stream):
-        value = self.__coder__.read_from(stream)
+        size = self.__coder__.fixed_size()
+        if size is None:
+            return self(self.__coder__.read_from(stream))
+
+        data = stream.read(size)
+        member = self._members_by_encoding.get(data)
+        if member is not None:
+            return member
+        if len(data) < size:
+            raise ValueError("Cannot decode - reached end of data")
+        value, _ = self.__coder__.decode(data)
         return self(value)
 
 
@@ -51,9 +101,444 @@ class Enumeration(int, SelfEncodable, enum34.Enum):
     """
     __metaclass__ = EnumerationMeta
     __coder__ = None  # Set by the metaclass
+    __choice__ = None  # The Choice whose tags these are, if any
+
+    def __reduce_ex__(self, protocol):
+        if self.__choice__ is None:
+            return super(Enumeration, self).__reduce_ex__(protocol)
+        # Tag enums are created by their Choice, and cannot be found by name.
+        return _choice_tag, (self.__choice__, int(self))
 
     def write_to(self, stream):
-        return self.__coder__.write_to(self, stream)
+        encoded = self._encodings.get(self)
+        if encoded is None:
+            return self.__coder__.write_to(self, stream)
+        stream.write(encoded)
+        return len(encoded)
+
+    def encode(self):
+        encoded = self._encodings.get(self)
+        if encoded is None:
+            return self.__coder__.encode(self)
+        return encoded
+
+
+def _choice_tag(choice_class, value):
+    return choice_class.tag_enum(value)
+
+
+def _decode_pickled(coder, data):
+    """
+    Decode a value pickled as its encoding (see `_reduce_encoded`).
+    """
+    with Session(), validation(Validation.OFF):
+        value, remainder = coder.decode(data)
+    if remainder:
+        raise ValueError("%s bytes left after decoding a pickled %s" %
+                         (len(remainder), coder.__name__))
+    return value
+
+
+def _reduce_encoded(value):
+    """
+    Pickle a value as its encoding, which is far smaller and faster than its
+    attributes. The value is encoded in a Session of its own, so it can be
+    decoded on its own.
+
+    Values come back exactly as they would be decoded: single precision
+    Float members lose the precision the value had beyond it, String members
+    come back as unicode, and checksums and computed members are set on the
+    value, as by any encoding. Copies are not affected (see
+    `_copy_attributes`).
+    """
+    with Session(), validation(Validation.OFF):
+        return _decode_pickled, (type(value), value.encode())
+
+
+def _copy_attributes(value):
+    """
+    Copy a value by its attributes, as `copy.copy` would without
+    `_reduce_encoded`.
+    """
+    copied = object.__new__(type(value))
+    copied.__dict__.update(value.__dict__)
+    return copied
+
+
+def _deepcopy_attributes(value, memo):
+    """
+    Copy a value and its attributes, as `copy.deepcopy` would without
+    `_reduce_encoded`.
+    """
+    copied = memo[id(value)] = object.__new__(type(value))
+    copied.__dict__.update(deepcopy(value.__dict__, memo))
+    return copied
+
+
+def _default_encoding(coder):
+    """
+    :return: (default, encoding) The default value of `coder` and its
+        encoding, if the encoding can be computed once and reused, or
+        (None, None) otherwise.
+    """
+    # Only fixed-size coders are known to encode values the same way every
+    # time (others may depend on the Session, for example).
+    if coder.fixed_size() is None:
+        return None, None
+    default = coder.default_value()
+    if not isinstance(default, (int, long, basestring)):
+        return None, None
+    try:
+        with validation(Validation.STRICT):
+            return default, coder.encode(default)
+    except ValueError:
+        return None, None
+
+
+class _MemberStep(object):
+    """
+    A step in the layout of a Record: a single member, encoded by its coder.
+    """
+    __slots__ = ("name", "coder", "covered_by", "default", "default_encoding")
+
+    def __init__(self, name, coder, covered_by=()):
+        self.name = name
+        self.coder = coder
+        # The names of the Checksum members covering this step.
+        self.covered_by = covered_by
+        self.default, self.default_encoding = _default_encoding(coder)
+
+    def write_to(self, record, stream):
+        value = getattr(record, self.name)
+        if self.default_encoding is not None and value == self.default and \
+                type(value) is type(self.default):
+            stream.write(self.default_encoding)
+            return len(self.default_encoding)
+        return self.coder.write_to(value, stream)
+
+    def read_into(self, stream, values):
+        values[self.name] = self.coder.read_from(stream)
+
+    def read_values(self, stream, values):
+        values.append(self.coder.read_from(stream))
+
+
+class _FusedStep(object):
+    """
+    A step in the layout of a Record: consecutive fusable members (integers,
+    floats), packed and unpacked together by a single struct.
+
+    The coders of a step share a validation policy, which is resolved once
+    for all of them.
+    """
+    __slots__ = ("endian", "validation", "names", "coders", "struct",
+                 "covered_by", "defaults")
+
+    def __init__(self, endian, validation=None, covered_by=()):
+        self.endian = endian
+        # The ``validation`` attribute of the coders.
+        self.validation = validation
+        self.names = []
+        self.coders = []
+        self.struct = None
+        self.covered_by = covered_by
+        # The default value of each member, if valid. Members still holding
+        # them (constants, for example) need not be validated again.
+        self.defaults = None
+
+    def add(self, name, coder):
+        self.names.append(name)
+        self.coders.append(coder)
+
+    def compile(self):
+        self.struct = struct.Struct(self.endian + "".join(
+            coder.struct.format[1:] for coder in self.coders))
+        self.defaults = []
+        for coder in self.coders:
+            default = coder.default_value()
+            try:
+                coder.validate(default)
+            except (ValueError, TypeError):
+                default = _INVALID
+            self.defaults.append(default)
+
+    def write_to(self, record, stream):
+        values = [getattr(record, name) for name in self.names]
+        if _policies[self.validation].encode:
+            for coder, value, default in zip(self.coders, values,
+                                             self.defaults):
+                if value is not default:
+                    coder.validate(value)
+        try:
+            stream.write(self.struct.pack(*values))
+        except (struct.error, OverflowError) as e:
+            # Reachable only when validation is turned off.
+            raise ValueError(str(e))
+        return self.struct.size
+
+    def read_into(self, stream, values):
+        values.update(zip(self.names, self._unpack(stream)))
+
+    def read_values(self, stream, values):
+        values.extend(self._unpack(stream))
+
+    def _unpack(self, stream):
+        if isinstance(stream, BufferedSource):
+            decoded = stream.unpack(self.struct)
+        else:
+            data = stream.read(self.struct.size)
+            if len(data) < self.struct.size:
+                raise ValueError("Cannot decode - reached end of data")
+            decoded = self.struct.unpack(data)
+        if _policies[self.validation].decode:
+            for coder, value in zip(self.coders, decoded):
+                coder.validate(value)
+        return decoded
+
+
+class Checksum(Coder):
+    """
+    A Record member holding a checksum of (some of) the preceding members.
+
+    The checksum is computed while the covered members are written, and is
+    written (and assigned to the record) right after them, so the record is
+    encoded in a single pass. When decoding, it is computed while the covered
+    members are read, and verified against the decoded value.
+    """
+
+    # (update function, initial value) of each of the built-in algorithms.
+    ALGORITHMS = {
+        "crc32": (zlib.crc32, 0),
+        "adler32": (zlib.adler32, 1),
+    }
+
+    def __init__(self, algorithm="crc32", over="preceding", width=4,
+                 byte_order=ByteOrder.MSB_FIRST, initial=None):
+        """
+        Initialize new Checksum.
+
+        :param algorithm: "crc32", "adler32", or a function that takes
+            (data, checksum) and returns the checksum updated with `data`,
+            like zlib.crc32.
+        :param over: "preceding" to cover all the members preceding the
+            checksum, or a list of the names of the covered members, all of
+            which must precede it.
+        :param width: The number of bytes of the checksum.
+        :param byte_order: The byte-order of the checksum.
+        :param initial: Optional. The checksum of no data. Required for custom
+            algorithms.
+        """
+        if callable(algorithm):
+            if initial is None:
+                raise ValueError("Custom algorithms require an initial value")
+            self._update = algorithm
+        elif algorithm in self.ALGORITHMS:
+            self._update, default_initial = self.ALGORITHMS[algorithm]
+            initial = default_initial if initial is None else initial
+        else:
+            raise ValueError("Unsupported algorithm %r. Supported algorithms "
+                             "are %s" % (algorithm, sorted(self.ALGORITHMS)))
+        if over != "preceding" and isinstance(over, basestring):
+            raise ValueError("`over` must be \"preceding\" or a list of "
+                             "member names")
+        self.algorithm = algorithm
+        self.over = over
+        self.initial = initial
+        self.coder = UnsignedInteger(width=width, byte_order=byte_order)
+
+    def default_value(self):
+        return 0
+
+    def fixed_size(self):
+        return self.coder.fixed_size()
+
+    def update(self, data, checksum):
+        """
+        :return: `checksum` updated with `data`.
+        """
+        return self._update(data, checksum)
+
+    def finish(self, checksum):
+        """
+        :return: The value of the running `checksum`, as written.
+        """
+        return checksum & self.coder.max
+
+    def write_to(self, value, stream):
+        return self.coder.write_to(value, stream)
+
+    def read_from(self, stream):
+        return self.coder.read_from(stream)
+
+
+class _ChecksumStep(_MemberStep):
+    """
+    A step in the layout of a Record: a Checksum member.
+    """
+    __slots__ = ()
+
+    def write_to(self, record, stream):
+        value = stream.checksum(self.name)
+        setattr(record, self.name, value)
+        return self.coder.write_to(value, stream)
+
+    def read_into(self, stream, values):
+        expected = stream.checksum(self.name)
+        value = self.coder.read_from(stream)
+        if self.coder.validate_on_decode() and value != expected:
+            raise ValueError("Checksum mismatch in %s: computed %#x, got %#x" %
+                             (self.name, expected, value))
+        values[self.name] = value
+
+
+class _ChecksumTap(object):
+    """
+    Wraps the stream a Record with Checksum members is written to or read
+    from, and updates the checksums with the data passing through it.
+    """
+
+    def __init__(self, stream, checksums):
+        self.stream = stream
+        self.checksums = checksums
+        self.running = {name: checksum.initial
+                        for name, checksum in checksums.iteritems()}
+        # The names of the checksums covering the data currently passing.
+        self.covering = ()
+
+    def _update(self, data):
+        for name in self.covering:
+            self.running[name] = self.checksums[name].update(
+                data, self.running[name])
+
+    def write(self, data):
+        self.stream.write(data)
+        self._update(data)
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self._update(data)
+        return data
+
+    def checksum(self, name):
+        return self.checksums[name].finish(self.running[name])
+
+    def write_steps(self, record, layout):
+        written = 0
+        for step in layout:
+            self.covering = step.covered_by
+            written += step.write_to(record, self)
+        return written
+
+    def read_steps(self, layout, values):
+        for step in layout:
+            self.covering = step.covered_by
+            step.read_into(self, values)
+
+
+class LengthOf(object):
+    """
+    Describes a computed Record member, whose value is the length, in bytes,
+    of the encoding of another member of the same Record.
+    """
+
+    def __init__(self, name, inverted=False):
+        """
+        Initialize new LengthOf.
+
+        :param name: The name of the measured member.
+        :param inverted: Whether the value is the bitwise inversion of the
+            length, within the range of the coder (for example, 0xfffe for a
+            length of 1 with a 2-byte coder).
+        """
+        self.name = name
+        self.inverted = inverted
+
+    def compute(self, length, coder):
+        """
+        :param length: The length of the measured member.
+        :param coder: The coder of the computed member.
+        :return: The value of the computed member.
+        """
+        return ~length & coder.max if self.inverted else length
+
+    def length(self, value, coder):
+        """
+        :param value: The value of the computed member.
+        :param coder: The coder of the computed member.
+        :return: The length of the measured member.
+        """
+        # Inversion is its own inverse.
+        return self.compute(value, coder)
+
+
+def _check_computed(record_name, members, computed, coverage):
+    names = members.keys()
+    for name, spec in computed.iteritems():
+        if spec.name not in members or spec.name in computed:
+            raise ValueError("%s.%s: %s is not a member that can be measured" %
+                             (record_name, name, spec.name))
+        if names.index(name) < names.index(spec.name):
+            # The value is patched in after the measured member is written.
+            if members[name].fixed_size() is None:
+                raise ValueError(
+                    "%s.%s: Members computed before the member they measure "
+                    "must have a fixed size" % (record_name, name))
+            if name in coverage:
+                raise ValueError(
+                    "%s.%s: Checksums cannot cover members computed after "
+                    "they are written" % (record_name, name))
+
+
+def _coverage(record_name, members):
+    """
+    :return: A dictionary mapping the name of each member covered by a
+        Checksum to the names of the Checksums covering it.
+    """
+    coverage = {}
+    names = members.keys()
+    for position, (name, coder) in enumerate(members.iteritems()):
+        if not isinstance(coder, Checksum):
+            continue
+        covered = names[:position] if coder.over == "preceding" else coder.over
+        for covered_name in covered:
+            if covered_name not in names[:position]:
+                raise ValueError(
+                    "%s.%s: Checksum covers %s, which is not a member "
+                    "preceding it" % (record_name, name, covered_name))
+            coverage[covered_name] = coverage.get(covered_name, ()) + (name,)
+    return coverage
+
+
+def _layout(members, coverage, unfused=()):
+    """
+    Plan the encoding of a Record.
+
+    :param members: The ordered members of the Record.
+    :param coverage: The Checksums covering each member (see `_coverage`).
+    :param unfused: The names of members that must have their own steps.
+    :return: A list of steps, which encode / decode the members in order.
+    """
+    steps = []
+    for name, coder in members.iteritems():
+        covered_by = coverage.get(name, ())
+        if isinstance(coder, Checksum):
+            steps.append(_ChecksumStep(name, coder, covered_by))
+            continue
+        if not getattr(coder, "fusable", False) or name in unfused:
+            steps.append(_MemberStep(name, coder, covered_by))
+            continue
+        endian = coder.struct.format[0]
+        if not steps or not isinstance(steps[-1], _FusedStep) or \
+                steps[-1].endian != endian or \
+                steps[-1].validation != coder.validation or \
+                steps[-1].covered_by != covered_by:
+            steps.append(_FusedStep(endian, coder.validation, covered_by))
+        steps[-1].add(name, coder)
+
+    for step in steps:
+        if isinstance(step, _FusedStep):
+            step.compile()
+    return steps
 
 
 class RecordBase(type, Coder):
@@ -83,24 +568,208 @@ class RecordBase(type, Coder):
 
         # Extract the actual coders, and throw away the Member wrapper.
         members = OrderedDict()
+        computed = OrderedDict()
         for member_name, member in coder_items:
             members[member_name] = member.coder
+            if member.computed is not None:
+                computed[member_name] = member.computed
         attrs.update(members)
 
         # Add `members` to the class
         attrs["members"] = members
+        attrs["_checksums"] = OrderedDict(
+            (member_name, coder) for member_name, coder in members.iteritems()
+            if isinstance(coder, Checksum))
+        coverage = _coverage(name, members)
+        _check_computed(name, members, computed, coverage)
+        attrs["_computed"] = computed
+        attrs["_measured"] = frozenset(spec.name
+                                       for spec in computed.itervalues())
+        attrs["_layout"] = _layout(members, coverage,
+                                   set(computed) | attrs["_measured"])
+        # Computed on first use, since the default values of some coders
+        # cannot be computed before the class is complete.
+        attrs["_defaults"] = None
+        attrs["_skips"] = None
         # Create and return the class
         return super(RecordBase, mcs).__new__(mcs, name, bases, attrs)
 
+    def fixed_size(self):
+        total = 0
+        for coder in self.members.itervalues():
+            size = coder.fixed_size()
+            if size is None:
+                return None
+            total += size
+        return total
+
     def write_to(self, value, stream):
         # Note that `value` is actually a Record **instance**
         return value.write_to(stream)
 
+    def _compute_defaults(self):
+        """
+        Compute the default values of the members of new instances.
+
+        :return: (shared, factories) The immutable default values, which are
+            shared by all instances, and a (name, factory) pair for each
+            mutable default value, which is created for each instance.
+        """
+        shared = {}
+        factories = []
+        for name, coder in self.members.iteritems():
+            value = coder.default_value()
+            if isinstance(value, _IMMUTABLE_TYPES):
+                shared[name] = value
+            elif type(value) in (list, dict, bytearray):
+                factories.append((name, partial(type(value), value)))
+            else:
+                factories.append((name, coder.default_value))
+        self._defaults = shared, factories
+        return self._defaults
+
+    def _compute_skips(self):
+        """
+        Compute how to skip an encoded Record.
+
+        :return: A list of (size, name, coder) triples: skip `size` bytes
+            (the encodings of consecutive fixed-size members), then the value
+            of member `name`, whose coder is `coder`. The name and coder of
+            the last triple may be None.
+        """
+        skips = []
+        size = 0
+        for name, coder in self.members.iteritems():
+            coder_size = coder.fixed_size()
+            # Computed members are decoded, for the lengths they hold.
+            if coder_size is None or name in self._computed:
+                skips.append((size, name, coder))
+                size = 0
+            else:
+                size += coder_size
+        if size or not skips:
+            skips.append((size, None, None))
+        self._skips = skips
+        return skips
+
+    def skip(self, stream):
+        computed = self._computed
+        # The lengths of the measured members decoded so far.
+        lengths = {}
+        for size, name, coder in self._skips or self._compute_skips():
+            if size:
+                skip_bytes(stream, size)
+            if coder is None:
+                continue
+            if name in lengths:
+                skip_bytes(stream, lengths[name])
+            elif name in computed:
+                spec = computed[name]
+                lengths[spec.name] = spec.length(coder.read_from(stream),
+                                                 coder)
+            else:
+                coder.skip(stream)
+
+    def template(self, **fields):
+        """
+        Encode a Record once, as a template whose fixed-size fields can then
+        be changed in place. See Template.
+
+        :param fields: The values of the members of the Record.
+        :return: A Template.
+        """
+        return Template(self(**fields))
+
     def read_from(self, stream):
-        # This is valid decoding since self.fields is an *Ordered*Dict, so the
-        # decoding is guaranteed to happen in the correct order.
-        kwargs = {name: coder.read_from(stream) for name, coder
-                  in self.members.iteritems()}
+        # The layout follows the order of the members, so the decoding is
+        # guaranteed to happen in the correct order.
+        if self._computed:
+            return self._read_bounded(stream)
+        kwargs = {}
+        if self._checksums:
+            _ChecksumTap(stream, self._checksums).read_steps(self._layout,
+                                                            kwargs)
+            return self(**kwargs)
+        for step in self._layout:
+            step.read_into(stream, kwargs)
+        return self(**kwargs)
+
+    def read_into(self, instance, stream):
+        """
+        Decode a value from a stream into an existing instance, overwriting
+        the values of its members. Nested Records and Choices are decoded into
+        the existing ones, where possible.
+
+        If decoding fails, the instance may be partially overwritten.
+
+        :param instance: An instance of this class.
+        :param stream: A readable file-like object.
+        :return: `instance`
+        """
+        if self._computed or self._checksums:
+            decoded = self.read_from(stream)
+            instance._assign({name: getattr(decoded, name)
+                              for name in self.members})
+            return instance
+
+        values = {}
+        current = instance.__dict__
+        for step in self._layout:
+            if isinstance(step, _MemberStep):
+                value = current.get(step.name)
+                # FrozenRecords are immutable, and are decoded anew.
+                if isinstance(type(value), (RecordBase, ChoiceBase)) and \
+                        not isinstance(type(value), FrozenRecordBase) and \
+                        type(value) is step.coder:
+                    values[step.name] = step.coder.read_into(value, stream)
+                    continue
+            step.read_into(stream, values)
+        instance._assign(values)
+        return instance
+
+    def decode_into(self, instance, buf):
+        """
+        Decode a value from a buffer into an existing instance. See
+        `read_into`.
+
+        :return: (instance, remainder) A tuple of `instance` and the remainder
+            of the buffer.
+        """
+        stream = StringIO(buf)
+        self.read_into(instance, stream)
+        return instance, stream.read()
+
+    def _read_bounded(self, stream):
+        """
+        Decode a Record with computed members, reading each measured member
+        from exactly as many bytes as its length says.
+        """
+        kwargs = {}
+        lengths = {}
+        tap = _ChecksumTap(stream, self._checksums) if self._checksums \
+            else None
+        source = tap or stream
+        for step in self._layout:
+            if tap is not None:
+                tap.covering = step.covered_by
+            name = getattr(step, "name", None)
+            if name in lengths:
+                data = source.read(lengths[name])
+                if len(data) < lengths[name]:
+                    raise ValueError("Cannot decode - reached end of data")
+                kwargs[name], remainder = step.coder.decode(data)
+                if remainder:
+                    raise ValueError("%s is shorter than its length (%s)" %
+                                     (name, lengths[name]))
+            else:
+                step.read_into(source, kwargs)
+
+            spec = self._computed.get(name)
+            if spec is not None:
+                length = spec.length(kwargs[name], step.coder)
+                if lengths.setdefault(spec.name, length) != length:
+                    raise ValueError("Inconsistent lengths of %s: %s, %s" %
+                                     (spec.name, lengths[spec.name], length))
         return self(**kwargs)
 
 
@@ -116,7 +785,7 @@ class Member(object):
     # Used to obtain the order of members declared in a Record subclass.
     creation_counter = 0
 
-    def __init__(self, coder, order=None):
+    def __init__(self, coder, order=None, computed=None):
         """
         Initialize a new Member.
 
@@ -130,10 +799,13 @@ class Member(object):
         :param coder: A Coder object
         :param order: Optional. User-defined order to override the default
             order, which is the order of declaration.
+        :param computed: Optional. Computes the value of the member when the
+            record is encoded, for example LengthOf("payload").
         """
         self.creation_counter = Member.creation_counter
         Member.creation_counter += 1
         self.coder = coder
+        self.computed = computed
         self._user_defined_order = order is not None
         self.order = order if order is not None else sys.maxint
 
@@ -181,28 +853,108 @@ class Record(SelfEncodable):
     """
     __metaclass__ = RecordBase
 
-    # This attribute will be overridden by the metaclass, but we declare it here
-    # just so that it'll be a known attribute of the class.
+    # These attributes will be overridden by the metaclass, but we declare them
+    # here just so that they'll be known attributes of the class.
     members = OrderedDict()
+    _defaults = None
+    _checksums = OrderedDict()
+    _computed = OrderedDict()
+    _measured = frozenset()
+    _layout = []
 
     def __init__(self, **kwargs):
         super(Record, self).__init__()
-        # Values of fields which were passed to us.
-        values = {name: value for name, value in kwargs.iteritems()
-                  if name in self.members}
+        shared, factories = self._defaults or type(self)._compute_defaults()
+        values = shared.copy()
+        for name, factory in factories:
+            if name not in kwargs:
+                values[name] = factory()
+        members = self.members
+        for name, value in kwargs.iteritems():
+            if name in members:
+                values[name] = value
+        self.__dict__.update(values)
 
-        for name, value in values.iteritems():
-            setattr(self, name, value)
+    @classmethod
+    def from_values(cls, *values):
+        """
+        Create a new instance, from the values of all of its members.
+
+        This is faster than keyword arguments, since no default values are
+        needed.
 
-        # Field names of the fields that
-        without_value = set(self.members.keys()) - set(values.keys())
-        for field in without_value:
-            setattr(self, field, self.members[field].default_value())
+        :param values: The values of the members, in the order they are
+            encoded.
+        :return: A new instance.
+        """
+        if len(values) != len(cls.members):
+            raise ValueError("%s has %s members, got %s values" %
+                             (cls.__name__, len(cls.members), len(values)))
+        return cls._from_members(zip(cls.members, values))
+
+    @classmethod
+    def _from_members(cls, items):
+        record = cls.__new__(cls)
+        record.__dict__.update(items)
+        return record
+
+    def _assign(self, values):
+        """
+        Overwrite the values of members, as decoded.
+        """
+        self.__dict__.update(values)
 
     def write_to(self, stream):
+        if self._computed:
+            return self._write_computed(stream)
+        if self._checksums:
+            return _ChecksumTap(stream, self._checksums).write_steps(
+                self, self._layout)
         written = 0
-        for name, coder in self.members.iteritems():
-            written += coder.write_to(getattr(self, name), stream)
+        for step in self._layout:
+            written += step.write_to(self, stream)
+        return written
+
+    def _write_computed(self, stream):
+        """
+        Encode a Record with computed members, in a single pass.
+
+        The record is encoded into a buffer (or straight into `stream`, if it
+        is a BufferWriter). Members computed before the member they measure
+        are reserved, and patched once it is written.
+        """
+        buf = stream if isinstance(stream, BufferWriter) else BufferWriter()
+        start = len(buf)
+        tap = _ChecksumTap(buf, self._checksums) if self._checksums else None
+        target = tap or buf
+        lengths = {}
+        reserved = []
+        for step in self._layout:
+            if tap is not None:
+                tap.covering = step.covered_by
+            name = getattr(step, "name", None)
+            offset = len(buf)
+            spec = self._computed.get(name)
+            if spec is not None and spec.name not in lengths:
+                reserved.append((step, offset))
+                target.write("\x00" * step.coder.fixed_size())
+                continue
+            if spec is not None:
+                setattr(self, name, spec.compute(lengths[spec.name],
+                                                 step.coder))
+            step.write_to(self, target)
+            if name in self._measured:
+                lengths[name] = len(buf) - offset
+
+        for step, offset in reserved:
+            spec = self._computed[step.name]
+            value = spec.compute(lengths[spec.name], step.coder)
+            setattr(self, step.name, value)
+            buf.patch(offset, step.coder.encode(value))
+
+        written = len(buf) - start
+        if buf is not stream:
+            stream.write(buffer(buf.buffer, 0, written))
         return written
 
     def __eq__(self, other):
@@ -216,6 +968,121 @@ class Record(SelfEncodable):
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    __reduce__ = _reduce_encoded
+    __copy__ = _copy_attributes
+    __deepcopy__ = _deepcopy_attributes
+
+
+class FrozenRecordBase(RecordBase):
+    """
+    Metaclass for FrozenRecord
+    """
+
+    def __new__(mcs, name, bases, attrs):
+        """
+        Create a new FrozenRecord (sub)class
+        """
+        # Instances are plain tuples, without a __dict__.
+        attrs.setdefault("__slots__", ())
+        cls = super(FrozenRecordBase, mcs).__new__(mcs, name, bases, attrs)
+        if cls._checksums or cls._computed:
+            raise ValueError("%s: FrozenRecords cannot have checksums or "
+                             "computed members" % (name,))
+        # Replace the coders with accessors of the tuple items.
+        for index, member_name in enumerate(cls.members):
+            setattr(cls, member_name, property(operator.itemgetter(index)))
+        return cls
+
+    def read_from(self, stream):
+        # The layout follows the order of the members, so the decoded values
+        # are already in the order of the tuple.
+        values = []
+        for step in self._layout:
+            step.read_values(stream, values)
+        return tuple.__new__(self, values)
+
+    def read_into(self, instance, stream):
+        raise ValueError("FrozenRecords are immutable, and cannot be decoded "
+                         "into")
+
+
+class FrozenRecord(tuple, SelfEncodable):
+    """
+    An immutable Record, stored as a tuple of the values of its members.
+
+    Members are declared exactly as in Record, and read as attributes, but
+    cannot be changed. Instances take far less memory than Records, and are
+    hashed and compared as tuples. Members with checksums or computed members
+    are not supported, since encoding would have to change them.
+    """
+    __metaclass__ = FrozenRecordBase
+
+    def __new__(cls, *args, **kwargs):
+        """
+        Create a new instance.
+
+        :param args: The values of the first members, in the order they are
+            encoded.
+        :param kwargs: The values of members, by name. Members that are not
+            given take their default values.
+        """
+        members = cls.members
+        if len(args) == len(members) and not kwargs:
+            return tuple.__new__(cls, args)
+        if len(args) > len(members):
+            raise ValueError("%s has %s members, got %s values" %
+                             (cls.__name__, len(members), len(args)))
+        shared, factories = cls._defaults or cls._compute_defaults()
+        values = shared.copy()
+        for name, factory in factories:
+            if name not in kwargs:
+                values[name] = factory()
+        values.update(zip(members, args))
+        for name, value in kwargs.iteritems():
+            if name in members:
+                values[name] = value
+        return tuple.__new__(cls, [values[name] for name in members])
+
+    @classmethod
+    def from_values(cls, *values):
+        """
+        Create a new instance, from the values of all of its members.
+
+        :param values: The values of the members, in the order they are
+            encoded.
+        :return: A new instance.
+        """
+        if len(values) != len(cls.members):
+            raise ValueError("%s has %s members, got %s values" %
+                             (cls.__name__, len(cls.members), len(values)))
+        return tuple.__new__(cls, values)
+
+    def replace(self, **fields):
+        """
+        :param fields: New values of members, by name.
+        :return: A copy of this instance, with the given members changed.
+        """
+        return type(self)(*self, **fields)
+
+    def write_to(self, stream):
+        written = 0
+        for step in self._layout:
+            written += step.write_to(self, stream)
+        return written
+
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__, ", ".join(
+            "%s=%r" % item for item in zip(self.members, self)))
+
+    # tuple's own pickling passes all the values as a single argument.
+    __reduce__ = _reduce_encoded
+
+    def __copy__(self):
+        return tuple.__new__(type(self), self)
+
+    def __deepcopy__(self, memo):
+        return tuple.__new__(type(self), deepcopy(tuple(self), memo))
+
 
 class ChoiceBase(type, Coder):
     """
@@ -243,10 +1110,13 @@ class ChoiceBase(type, Coder):
             # Defaults to 1 because who will pass 256 variants?!
             tag_width = 1  # Fallback.
 
+        # A class may specify a coder for its tag, instead of a width.
+        tag_coder = attrs.get("tag_coder")
+
         # Just to make sure...
         num_variants = len(variants)
         max_possible = 2 ** (8 * tag_width)
-        if num_variants > max_possible:
+        if tag_coder is None and num_variants > max_possible:
             raise ValueError(
                 "The class declares %s different variants which cannot be "
                 "distinguished by tag of %s bytes. You must either lower "
@@ -256,12 +1126,14 @@ class ChoiceBase(type, Coder):
         # Create the tags enum for this class.
         class_dict = {cls.__name__: tag for tag, cls in variants.iteritems()}
         class_dict["__width__"] = tag_width
+        class_dict["__coder__"] = tag_coder
         variants_enum = EnumerationMeta(
             "%sTag" % (name,), (Enumeration,), class_dict)
         attrs["tag_enum"] = variants_enum
 
         # Create the class here, because we need it for the next steps
         choice_class = super(ChoiceBase, mcs).__new__(mcs, name, bases, attrs)
+        variants_enum.__choice__ = choice_class
 
         # Replace the actual variants with a Variant Proxy object.
         variants = {tag: Variant(choice_class, tag, variant_type)
@@ -278,6 +1150,15 @@ class ChoiceBase(type, Coder):
 
         return choice_class
 
+    def fixed_size(self):
+        # A Choice has a fixed size only if all of its variants have the same
+        # fixed size.
+        sizes = set(variant.fixed_size() for variant in self.variants.values())
+        tag_size = self.tag_enum.fixed_size()
+        if len(sizes) != 1 or None in sizes or tag_size is None:
+            return None
+        return tag_size + sizes.pop()
+
     def write_to(self, value, stream):
         # Note here that `value` is actually a Choice instance.
         return value.write_to(stream)
@@ -287,6 +1168,439 @@ class ChoiceBase(type, Coder):
         variant_cls = self.variants.get(tag)
         return self(tag=tag, value=variant_cls.read_from(stream))
 
+    def skip(self, stream):
+        tag = self.tag_enum.read_from(stream)
+        self.variants[tag].skip(stream)
+
+    def read_into(self, instance, stream):
+        """
+        Decode a value from a stream into an existing instance. If it holds
+        the same variant, the value of the variant is decoded into the
+        existing one, where possible.
+
+        :param instance: An instance of this class.
+        :param stream: A readable file-like object.
+        :return: `instance`
+        """
+        tag = self.tag_enum.read_from(stream)
+        variant_cls = self.variants.get(tag)._obj
+        value = instance.value
+        if tag is instance.tag and type(value) is variant_cls and \
+                isinstance(variant_cls, (RecordBase, ChoiceBase)):
+            variant_cls.read_into(value, stream)
+        else:
+            instance.tag = tag
+            instance.value = variant_cls.read_from(stream)
+        return instance
+
+    def decode_into(self, instance, buf):
+        """
+        Decode a value from a buffer into an existing instance. See
+        `read_into`.
+
+        :return: (instance, remainder) A tuple of `instance` and the remainder
+            of the buffer.
+        """
+        stream = StringIO(buf)
+        self.read_into(instance, stream)
+        return instance, stream.read()
+
+    def peek_tag(self, buf):
+        """
+        Read the tag of an encoded Choice, without decoding its value.
+
+        :param buf: The encoding. A string, a bytearray or a memoryview.
+        :return: The tag, a member of `tag_enum`.
+        :raise ValueError: If the tag cannot be decoded.
+        """
+        return self.tag_enum.read_from(StringIO(buf))
+
+    def peek_path(self, buf):
+        """
+        Read the tags of an encoded Choice, and of the Choices nested in it,
+        without decoding any other value.
+
+        :param buf: The encoding. A string, a bytearray or a memoryview.
+        :return: A tuple of the tags, outermost first. For example, the path
+            of Command.General.Reset() is (Command.tag_enum.General,
+            General.tag_enum.Reset).
+        :raise ValueError: If the tags cannot be decoded.
+        """
+        # cStringIO reads memoryviews without copying them.
+        stream = StringIO(buf)
+        tags = []
+        choice_class = self
+        while isinstance(choice_class, ChoiceBase):
+            tag = choice_class.tag_enum.read_from(stream)
+            tags.append(tag)
+            choice_class = choice_class.variants[tag]._obj
+        return tuple(tags)
+
+
+class Template(object):
+    """
+    A pre-encoded Record, whose fixed-size fields can be changed in place,
+    without encoding the Record again.
+
+    Fields are named by their paths, for example "crc" or "header.size" for
+    a member of a nested Record. Checksums covering a changed field are
+    recomputed. Computed members cannot be changed.
+    """
+
+    def __init__(self, record):
+        """
+        Initialize new Template.
+
+        :param record: The Record to encode.
+        """
+        writer = BufferWriter()
+        if isinstance(record, Record):
+            # The actual encoding, rather than a cached one (see CachedRecord).
+            Record.write_to(record, writer)
+        else:
+            record.write_to(writer)
+        self.buffer = writer.buffer[:len(writer)]
+        # (offset, coder) of each fixed-size field.
+        self._fields = {}
+        # (start, end) of the encoding of each member.
+        self._ranges = {}
+        self._computed = set()
+        # (offset, checksum, covered ranges), in order of their offsets.
+        self._checksums = []
+        # Members are measured by skipping over their encodings, in a Session
+        # of their own, which coders whose encodings depend on the Session
+        # leave their state in.
+        session = Session()
+        try:
+            with session, validation(Validation.OFF):
+                end = self._measure(record, StringIO(buffer(self.buffer)), 0,
+                                    "")
+        except ValueError:
+            end = None
+        if end != len(self.buffer) or session.used():
+            raise ValueError("%s depends on the Session, and cannot be used "
+                             "as a template" % (type(record).__name__,))
+        self._checksums.sort(key=operator.itemgetter(0))
+
+    def _measure(self, record, stream, offset, prefix):
+        """
+        Find the offsets of the members of `record`, encoded at `offset`.
+
+        :param stream: A stream over the encoding.
+        :return: The offset of the end of the record.
+        """
+        record_class = type(record)
+        for step in record_class._layout:
+            if isinstance(step, _FusedStep):
+                for name, coder in zip(step.names, step.coders):
+                    self._add(prefix + name, coder, offset,
+                              offset + coder.struct.size)
+                    offset += coder.struct.size
+                continue
+
+            path = prefix + step.name
+            value = getattr(record, step.name)
+            if isinstance(step.coder, RecordBase):
+                end = self._measure(value, stream, offset, path + ".")
+            else:
+                stream.seek(offset)
+                step.coder.skip(stream)
+                end = stream.tell()
+            self._add(path, step.coder, offset, end)
+            if step.name in record_class._computed or \
+                    step.name in record_class._checksums:
+                self._computed.add(path)
+            offset = end
+
+        names = record_class.members.keys()
+        for name, checksum in record_class._checksums.iteritems():
+            covered = checksum.over
+            if covered == "preceding":
+                covered = names[:names.index(name)]
+            self._checksums.append((self._ranges[prefix + name][0], checksum,
+                                    [self._ranges[prefix + covered_name]
+                                     for covered_name in covered]))
+        return offset
+
+    def _add(self, path, coder, start, end):
+        self._ranges[path] = (start, end)
+        if coder.fixed_size() is not None:
+            self._fields[path] = (start, coder)
+
+    def fields(self):
+        """
+        :return: The paths of the fields that can be changed, sorted.
+        """
+        return sorted(path for path in self._fields
+                      if path not in self._computed)
+
+    def settable(self, path):
+        """
+        :return: Whether the field `path` can be changed.
+        """
+        return path in self._fields and path not in self._computed
+
+    def set(self, path, value):
+        """
+        Change the value of a field.
+
+        :param path: The path of the field, for example "header.size".
+        :param value: The new value.
+        :raise ValueError: If the field cannot be changed, or the value cannot
+            be encoded.
+        """
+        if not self.settable(path):
+            raise ValueError("%s is not a field that can be changed" % (path,))
+        offset, coder = self._fields[path]
+        if getattr(coder, "fusable", False):
+            if coder.validate_on_encode():
+                coder.validate(value)
+            try:
+                coder.struct.pack_into(self.buffer, offset, value)
+            except (struct.error, OverflowError) as e:
+                raise ValueError(str(e))
+        else:
+            encoded = coder.encode(value)
+            if len(encoded) != coder.fixed_size():
+                raise ValueError("Cannot change the size of %s" % (path,))
+            self.buffer[offset:offset + len(encoded)] = encoded
+        self._update_checksums(self._ranges[path])
+
+    __setitem__ = set
+
+    def get(self, path):
+        """
+        :param path: The path of a fixed-size field.
+        :return: The current value of the field.
+        """
+        if path not in self._fields:
+            raise ValueError("%s is not a fixed-size field" % (path,))
+        offset, coder = self._fields[path]
+        if getattr(coder, "fusable", False):
+            return coder.struct.unpack_from(self.buffer, offset)[0]
+        value, _ = coder.decode(
+            str(buffer(self.buffer, offset, coder.fixed_size())))
+        return value
+
+    def _update_checksums(self, changed_range):
+        changed = [changed_range]
+        for offset, checksum, covered in self._checksums:
+            if not any(start < changed_end and changed_start < end
+                       for start, end in covered
+                       for changed_start, changed_end in changed):
+                continue
+            running = checksum.initial
+            for start, end in covered:
+                running = checksum.update(
+                    buffer(self.buffer, start, end - start), running)
+            checksum.coder.struct.pack_into(self.buffer, offset,
+                                            checksum.finish(running))
+            changed.append((offset, offset + checksum.fixed_size()))
+
+    def update(self, **fields):
+        """
+        Change the values of top-level fields.
+
+        :return: A memoryview of the updated encoding.
+        """
+        for name, value in fields.iteritems():
+            self.set(name, value)
+        return self.view()
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def view(self):
+        """
+        :return: A memoryview of the encoding. It reflects later changes.
+        """
+        return memoryview(self.buffer)
+
+    def getvalue(self):
+        """
+        :return: A copy of the encoding, as a string.
+        """
+        return str(self.buffer)
+
+    def write_to(self, stream):
+        """
+        Write the encoding into a stream.
+
+        :return: The number of bytes written.
+        """
+        stream.write(buffer(self.buffer))
+        return len(self.buffer)
+
+
+class CachedRecord(Record):
+    """
+    A Record that caches its encoding, for records that are encoded many
+    times.
+
+    Assigning a member marks it as changed. Encoding an unchanged record
+    returns the cached encoding. If only fixed-size members changed, they
+    are patched into the cached encoding (see Template), rather than encoding
+    the whole record again.
+
+    Members holding CachedRecords, or Choices of CachedRecords, are checked
+    for changes whenever the record is encoded: each CachedRecord counts its
+    changes (its generation), and the record remembers the generations it
+    was encoded with. A CachedRecord may therefore be encoded on its own, or
+    shared by several records. Members holding any other mutable value (a
+    list, a plain Record) may be changed in place, so they are always
+    considered changed.
+    """
+
+    def __init__(self, **kwargs):
+        self._reset_cache()
+        super(CachedRecord, self).__init__(**kwargs)
+
+    @classmethod
+    def _from_members(cls, items):
+        record = super(CachedRecord, cls)._from_members(items)
+        record._reset_cache()
+        return record
+
+    def _assign(self, values):
+        super(CachedRecord, self)._assign(values)
+        self._reset_cache()
+
+    def __copy__(self):
+        copied = super(CachedRecord, self).__copy__()
+        copied._reset_cache()
+        return copied
+
+    def __deepcopy__(self, memo):
+        copied = super(CachedRecord, self).__deepcopy__(memo)
+        copied._reset_cache()
+        return copied
+
+    def _reset_cache(self):
+        # Never reset, so a record that remembers an earlier generation of
+        # this one cannot mistake it for the current one.
+        object.__setattr__(self, "_generation",
+                           self.__dict__.get("_generation", -1) + 1)
+        object.__setattr__(self, "_changed", set())
+        object.__setattr__(self, "_template", None)
+        object.__setattr__(self, "_encoded", None)
+        # The state of the mutable members, when last encoded (see _snapshot).
+        object.__setattr__(self, "_snapshots", {})
+
+    def __setattr__(self, name, value):
+        if name in self.members:
+            self._changed.add(name)
+            object.__setattr__(self, "_generation", self._generation + 1)
+        super(CachedRecord, self).__setattr__(name, value)
+
+    def changed(self):
+        """
+        :return: Whether the record changed since it was last encoded.
+        """
+        changed = self._changed_members()
+        return changed is None or bool(changed)
+
+    def _changed_members(self):
+        """
+        :return: The names of the members that changed since the record was
+            last encoded, or None if it was never encoded.
+        """
+        if self._template is None:
+            return None
+        changed = set(self._changed)
+        for name in self.members:
+            if name in changed:
+                continue
+            value = getattr(self, name)
+            if isinstance(value, _IMMUTABLE_TYPES):
+                continue
+            snapshot = self._snapshots.get(name)
+            if snapshot is None or not _unchanged_since(snapshot):
+                changed.add(name)
+        return changed
+
+    def encode(self):
+        changed = self._changed_members()
+        if changed is None or not self._patch(changed):
+            object.__setattr__(self, "_template", None)
+            template = Template(self)
+            object.__setattr__(self, "_template", template)
+            self._encoded_as(template)
+        return self._encoded
+
+    def write_to(self, stream):
+        encoded = self.encode()
+        stream.write(encoded)
+        return len(encoded)
+
+    def _patch(self, changed):
+        """
+        Patch the changed members into the cached encoding.
+
+        :return: Whether all of them could be patched.
+        """
+        if not changed:
+            return True
+        template = self._template
+        if not all(template.settable(name) for name in changed):
+            return False
+        try:
+            for name in changed:
+                template.set(name, getattr(self, name))
+        except ValueError:
+            # The cached encoding is partially patched.
+            object.__setattr__(self, "_template", None)
+            raise
+        for name in self._checksums:
+            object.__setattr__(self, name, template.get(name))
+        self._encoded_as(template)
+        return True
+
+    def _encoded_as(self, template):
+        object.__setattr__(self, "_encoded", template.getvalue())
+        self._changed.clear()
+        self._snapshots.clear()
+        for name in self.members:
+            value = getattr(self, name)
+            if not isinstance(value, _IMMUTABLE_TYPES):
+                self._snapshots[name] = _snapshot(value, [])
+
+
+def _snapshot(value, snapshot):
+    """
+    Record the state of the CachedRecords and Choices in a value.
+
+    :param value: The value of a member.
+    :param snapshot: A list to which (object, state) pairs are appended.
+    :return: `snapshot`, or None if the value holds other mutable values,
+        whose changes cannot be detected.
+    """
+    if isinstance(value, _IMMUTABLE_TYPES):
+        return snapshot
+    if isinstance(value, CachedRecord):
+        snapshot.append((value, value._generation))
+        for name in value.members:
+            if _snapshot(getattr(value, name), snapshot) is None:
+                return None
+        return snapshot
+    if isinstance(value, Choice):
+        snapshot.append((value, (value.tag, value.value)))
+        return _snapshot(value.value, snapshot)
+    return None
+
+
+def _unchanged_since(snapshot):
+    """
+    :param snapshot: A snapshot taken by `_snapshot`.
+    :return: Whether none of the objects in it changed since.
+    """
+    for value, state in snapshot:
+        if isinstance(value, CachedRecord):
+            if value._generation != state:
+                return False
+        elif value.tag is not state[0] or value.value is not state[1]:
+            return False
+    return True
+
 
 class Choice(SelfEncodable):
     """
@@ -299,6 +1613,7 @@ class Choice(SelfEncodable):
     # here just to publicly declare their existence.
     tag_enum = None
     tag_width = 1
+    tag_coder = None
     variants = {}
     reverse_variants = {}
 
@@ -309,14 +1624,14 @@ class Choice(SelfEncodable):
         :param tag: The id of this instance. An instance of Class.tag_enum
         :param value: Optional. A value corresponding to `tag`.
         """
-        self.tag = self.tag_enum(tag)
+        self.tag = tag if type(tag) is self.tag_enum else self.tag_enum(tag)
         self.value = value
         if self.value is None:
             variant_coder = self.variants.get(self.tag)
             self.value = variant_coder.default_value()
 
     def write_to(self, stream):
-        written = self.tag_enum.write_to(self.tag_enum(self.tag), stream)
+        written = self.tag_enum.write_to(self.tag, stream)
         variant_cls = self.variants.get(self.tag)
         written += variant_cls.write_to(self.value, stream)
         return written
@@ -328,6 +1643,114 @@ class Choice(SelfEncodable):
             return False
         return self.value == other.value
 
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    __reduce__ = _reduce_encoded
+    __copy__ = _copy_attributes
+    __deepcopy__ = _deepcopy_attributes
+
+
+class RecordPool(object):
+    """
+    A free list of instances of a Record or Choice class, which are decoded
+    into rather than allocated for each message. Instances are returned to
+    the pool once they are no longer used.
+    """
+
+    def __init__(self, record_class, max_size=64):
+        """
+        Initialize new RecordPool.
+
+        :param record_class: A Record or Choice subclass.
+        :param max_size: The maximal number of free instances kept.
+        """
+        self.record_class = record_class
+        self.max_size = max_size
+        self._free = []
+
+    def __len__(self):
+        """
+        :return: The number of free instances.
+        """
+        return len(self._free)
+
+    def acquire(self):
+        """
+        :return: A free instance, holding the values it was released with, or
+            a new default instance if there are none.
+        """
+        try:
+            return self._free.pop()
+        except IndexError:
+            return self.record_class.default_value()
+
+    def release(self, instance):
+        """
+        Return an instance to the pool. It must not be used afterwards.
+        """
+        if len(self._free) < self.max_size:
+            self._free.append(instance)
+
+    def read_from(self, stream):
+        """
+        Decode a value from a stream into a free instance.
+        """
+        return self.record_class.read_into(self.acquire(), stream)
+
+    def decode(self, buf):
+        """
+        Decode a value from a buffer into a free instance.
+
+        :return: (value, remainder) A tuple of the value decoded and the
+            remainder of the buffer.
+        """
+        return self.record_class.decode_into(self.acquire(), buf)
+
+
+def _decode_batch(coder, count, data):
+    stream = StringIO(data)
+    with Session(), validation(Validation.OFF):
+        values = [coder.read_from(stream) for _ in xrange(count)]
+    if stream.read(1):
+        raise ValueError("Bytes left after decoding a pickled Batch")
+    return Batch(coder, values)
+
+
+class Batch(list):
+    """
+    A list of values of a single coder, pickled as the concatenation of their
+    encodings. Pickling a batch, for example to pass it to another process,
+    costs about as much as encoding it, and the pickle is about as large as
+    the encoding.
+
+    Unpickling a batch decodes all of its values, and costs as much as any
+    other decoding of them. Passing decoded values to another process is
+    therefore no cheaper than having that process decode them itself (see
+    the `func` of parallel_decode).
+
+    The values are encoded in a single Session, so stateful coders (for
+    example, InternedString) share their state across the batch.
+    """
+
+    def __init__(self, coder, values=()):
+        """
+        Initialize new Batch.
+
+        :param coder: The coder of the values.
+        :param values: Optional. The initial values.
+        """
+        super(Batch, self).__init__(values)
+        self.coder = coder
+
+    def __reduce__(self):
+        stream = StringIO()
+        write_to = self.coder.write_to
+        with Session(), validation(Validation.OFF):
+            for value in self:
+                write_to(value, stream)
+        return _decode_batch, (self.coder, len(self), stream.getvalue())
+
 
 class Variant(Proxy):
     """
@@ -437,6 +1860,9 @@ class BitMaskedIntegerMeta(type, Coder):
     def default_value(self):
         return self()
 
+    def fixed_size(self):
+        return self._coder.fixed_size()
+
 
 class BitMaskedInteger(SelfEncodable):
     __metaclass__ = BitMaskedIntegerMeta
@@ -468,11 +1894,164 @@ class BitMaskedInteger(SelfEncodable):
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    __reduce__ = _reduce_encoded
+    __copy__ = _copy_attributes
+    __deepcopy__ = _deepcopy_attributes
+
     def __str__(self):
         return "{name}: {masks}".format(
             name=self.__class__.__name__,
             masks={name: getattr(self, name) for name in self.masks.iterkeys()}
         )
 
+class _CompressionState(object):
+    """
+    The state of a streaming Compressed coder in a single Session.
+    """
+    __slots__ = ("compressor", "decompressor")
+
+    def __init__(self, compressor, decompressor):
+        self.compressor = compressor
+        self.decompressor = decompressor
+
+
+class Compressed(Coder):
+    """
+    A Coder that compresses the encoding of another coder.
+
+    The compressed data is prefixed by its length.
+
+    Small messages hardly compress on their own, but a series of similar
+    messages compresses very well. Two features are offered for this case:
+
+    - A preset dictionary: data that is similar to the messages, which both
+      sides feed the compressor with before compressing the first message.
+    - Streaming: one compression stream per connection, flushed after each
+      message, so each message is compressed using the history of the
+      previous ones. The stream is kept in the active Session, so both sides
+      must encode / decode all the messages of a connection within the same
+      Session, in order.
+    """
+
+    CODECS = ("zlib",)
+
+    # Every sync-flushed zlib block ends with these bytes, so they are not
+    # sent on the wire.
+    SYNC_MARKER = "\x00\x00\xff\xff"
+
+    def __init__(self, coder, codec="zlib",
+                 level=zlib.Z_DEFAULT_COMPRESSION, dictionary=None,
+                 streaming=False, max_size=None, length_coder=None):
+        """
+        Initialize new Compressed coder.
+
+        :param coder: The coder of the uncompressed values.
+        :param codec: The compression codec. Only "zlib" is supported.
+        :param level: The compression level.
+        :param dictionary: Optional. A preset dictionary.
+        :param streaming: Whether to compress all the messages of a Session
+            as a single stream.
+        :param max_size: Optional. The maximum size of a decompressed message.
+            Protects against maliciously crafted data.
+        :param length_coder: Optional. The coder of the length prefix.
+            Defaults to VarUInt().
+        """
+        if codec not in self.CODECS:
+            raise ValueError("Unsupported codec: %s. Supported codecs are %s" %
+                             (codec, self.CODECS))
+        self.coder = coder
+        self.codec = codec
+        self.level = level
+        self.dictionary = dictionary
+        self.streaming = streaming
+        self.max_size = max_size
+        self.length_coder = (length_coder if length_coder is not None
+                             else VarUInt())
+        self._compressor, self._decompressor = self._new_contexts()
+
+    def _new_contexts(self):
+        """
+        :return: A (compressor, decompressor) pair, primed with the dictionary.
+        """
+        compressor = zlib.compressobj(self.level)
+        decompressor = zlib.decompressobj()
+        if self.dictionary:
+            # Python 2's zlib doesn't support preset dictionaries, so we get the
+            # same effect by compressing the dictionary on both sides.
+            primer = compressor.compress(self.dictionary)
+            primer += compressor.flush(zlib.Z_SYNC_FLUSH)
+            decompressor.decompress(primer)
+        return compressor, decompressor
+
+    def _new_state(self):
+        return _CompressionState(*self._new_contexts())
+
+    def _session_state(self):
+        """
+        :return: (session, state) The active Session, and the
+            _CompressionState of this coder in it.
+        """
+        session = current_session()
+        if session is None:
+            raise ValueError(
+                "Streaming compression requires an active Session")
+        return session, session.state(self, self._new_state)
+
+    def default_value(self):
+        return self.coder.default_value()
+
+    def write_to(self, value, stream):
+        if not self.streaming:
+            # Each message is compressed on its own, but starting from the
+            # (primed) initial state.
+            compressor = self._compressor.copy()
+            compressed = compressor.compress(self.coder.encode(value))
+            compressed += compressor.flush()
+        else:
+            session, state = self._session_state()
+            data = self.coder.encode(value)
+            if session.undoable():
+                # The stream is rewound if the message is discarded. Copying
+                # a compressor costs far more than compressing a message, so
+                # it is done only when needed.
+                session.undo(setattr, state, "compressor",
+                             state.compressor.copy())
+            compressed = state.compressor.compress(data)
+            compressed += state.compressor.flush(zlib.Z_SYNC_FLUSH)
+            compressed = compressed[:-len(self.SYNC_MARKER)]
+
+        written = self.length_coder.write_to(len(compressed), stream)
+        stream.write(compressed)
+        return written + len(compressed)
+
+    def read_from(self, stream):
+        length = self.length_coder.read_from(stream)
+        compressed = stream.read(length)
+        if len(compressed) < length:
+            raise ValueError("Cannot decode - reached end of data")
+
+        if self.streaming:
+            decompressor = self._session_state()[1].decompressor
+            compressed += self.SYNC_MARKER
+        else:
+            decompressor = self._decompressor.copy()
+        try:
+            data = decompressor.decompress(compressed, self.max_size or 0)
+        except zlib.error as e:
+            raise ValueError(str(e))
+        if decompressor.unconsumed_tail:
+            raise ValueError("Decompressed data exceeds %s bytes" %
+                             (self.max_size,))
+
+        value, remainder = self.coder.decode(data)
+        if remainder:
+            raise ValueError("%s bytes left after decoding the decompressed "
+                             "data" % (len(remainder),))
+        return value
+
+
 __all__ = (Record.__name__, Member.__name__, BitMask.__name__,
-           BitMaskedInteger.__name__, Choice.__name__, Enumeration.__name__)
+           BitMaskedInteger.__name__, Choice.__name__, Enumeration.__name__,
+           Compressed.__name__, Checksum.__name__, LengthOf.__name__,
+           Template.__name__, CachedRecord.__name__, RecordPool.__name__,
+           FrozenRecord.__name__, Batch.__name__)
@@ -0,0 +1,320 @@
+import itertools
+
+import enum34
+from coders import Coder, current_session
+from primitives import VarUInt, VarSInt
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# The most bytes a 64-bit value takes as a variable-length integer.
+_MAX_VARINT_WIDTH = 10
+
+
+def _encode_varints(values):
+    """
+    Encode an array of unsigned 64-bit integers as variable-length integers
+    (see VarUInt), using vectorized operations.
+
+    :param values: A NumPy array of uint64.
+    :return: The concatenated encodings.
+    """
+    shifts = numpy.arange(0, 7 * _MAX_VARINT_WIDTH, 7, dtype=numpy.uint64)
+    # Every group of 7 bits of every value, least significant first.
+    groups = (values[:, None] >> shifts) & numpy.uint64(0x7f)
+    widths = 1 + (values[:, None] >> shifts[1:] != 0).sum(axis=1)
+    positions = numpy.arange(_MAX_VARINT_WIDTH)
+    groups[positions < widths[:, None] - 1] |= numpy.uint64(0x80)
+    return groups[positions < widths[:, None]].astype(numpy.uint8).tostring()
+
+
+def _decode_varints(buf, count):
+    """
+    Decode consecutive variable-length integers (see VarUInt), using
+    vectorized operations.
+
+    :param buf: A sequence of bytes.
+    :param count: The number of values to decode.
+    :return: (values, remainder) A NumPy array of uint64 and the remainder of
+        the buffer, or None if the values cannot be decoded this way (they are
+        truncated, or too wide to fit an int64 once unzigzagged).
+    """
+    head = buf[:count * _MAX_VARINT_WIDTH]
+    if isinstance(head, memoryview):
+        # NumPy reads only the old buffer interface (under Python 2).
+        head = head.tobytes()
+    data = numpy.frombuffer(head, dtype=numpy.uint8)
+    ends = numpy.flatnonzero(data < 0x80)[:count]
+    if len(ends) < count:
+        return None
+    starts = numpy.empty(count, dtype=numpy.intp)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    widths = ends - starts + 1
+    if widths.max() >= _MAX_VARINT_WIDTH:
+        return None
+    size = ends[-1] + 1
+    # The shift of each byte, within the value it belongs to.
+    shifts = 7 * (numpy.arange(size) - numpy.repeat(starts, widths))
+    groups = (data[:size] & 0x7f).astype(numpy.uint64) << \
+        shifts.astype(numpy.uint64)
+    return numpy.add.reduceat(groups, starts), buf[size:]
+
+
+class DeltaSequence(Coder):
+    """
+    A sequence of integers, encoded as differences between consecutive values.
+
+    The number of elements and the first value are encoded first, followed by
+    the difference of each value from its predecessor. All of them are
+    variable-length integers, so slowly changing series (timestamps, sensor
+    readings) take about a byte per element.
+
+    With run-length encoding, each distinct difference is followed by the
+    number of times it repeats, so series that change at a constant rate take
+    a few bytes in total.
+
+    When NumPy is available, NumPy arrays are encoded, and optionally decoded,
+    using vectorized operations, from the differences down to the bytes of
+    the variable-length integers. Run-length encoded sequences, and
+    sequences read from streams (rather than decoded from buffers), are
+    decoded value by value.
+    """
+
+    def __init__(self, max_length, min_length=0, run_length=False,
+                 as_array=False):
+        """
+        Initialize new DeltaSequence.
+
+        :param max_length: The maximum number of elements allowed.
+        :param min_length: Optional. The minimal number of elements allowed.
+        :param run_length: Whether to run-length encode the differences.
+        :param as_array: Whether to decode into a NumPy array rather than a
+            list. Requires NumPy.
+        """
+        if as_array and numpy is None:
+            raise ValueError("as_array requires NumPy")
+        self.max = max_length
+        self.min = min_length
+        self.run_length = run_length
+        self.as_array = as_array
+        self.length_coder = VarUInt(max_value=max_length)
+        self.run_coder = VarUInt(min_value=1, max_value=max_length)
+        self.value_coder = VarSInt()
+        # Differences are zigzagged with the values.
+        self._zigzag = VarUInt()
+
+    def default_value(self):
+        return []
+
+    def validate(self, value):
+        count = len(value)
+        if not self.min <= count <= self.max:
+            raise ValueError(
+                "Number of elements (%s) is not in [%s, %s]" %
+                (count, self.min, self.max))
+        return True
+
+    def write_to(self, value, stream):
+        encoded = self.encode(value)
+        stream.write(encoded)
+        return len(encoded)
+
+    def encode(self, value):
+        if self.validate_on_encode():
+            self.validate(value)
+        parts = [self.length_coder.encode(len(value))]
+        if len(value) > 0:
+            parts.append(self.value_coder.encode(int(value[0])))
+            if self.run_length:
+                for delta, count in self._runs(value):
+                    parts.append(self.value_coder.encode(delta))
+                    parts.append(self.run_coder.encode(count))
+            elif numpy is not None and isinstance(value, numpy.ndarray):
+                deltas = numpy.diff(value.astype(numpy.int64))
+                zigzagged = (deltas << 1) ^ (deltas >> 63)
+                parts.append(_encode_varints(zigzagged.view(numpy.uint64)))
+            else:
+                parts.append(self._zigzag.encode_many(self._deltas(value)))
+        return "".join(parts)
+
+    @staticmethod
+    def _deltas(value):
+        """
+        :return: The zigzagged differences between consecutive values.
+        """
+        to_unsigned = VarSInt.to_unsigned
+        return [to_unsigned(b - a) for a, b in itertools.izip(value, value[1:])]
+
+    @staticmethod
+    def _runs(value):
+        """
+        :return: (difference, count) pairs for each run of equal differences.
+        """
+        deltas = (int(b) - int(a) for a, b in itertools.izip(value, value[1:]))
+        return [(delta, sum(1 for _ in run))
+                for delta, run in itertools.groupby(deltas)]
+
+    def read_from(self, stream):
+        count = self.length_coder.read_from(stream)
+        deltas = []
+        if count > 0:
+            deltas.append(self.value_coder.read_from(stream))
+        while len(deltas) < count:
+            delta = self.value_coder.read_from(stream)
+            repeat = self.run_coder.read_from(stream) if self.run_length else 1
+            deltas.extend([delta] * repeat)
+        return self._accumulate(deltas, count)
+
+    def decode(self, buf):
+        count, buf = self.length_coder.decode(buf)
+        if count == 0:
+            return self._accumulate([], count), buf
+        if not self.run_length:
+            first, buf = self.value_coder.decode(buf)
+            decoded = _decode_varints(buf, count - 1) if self.as_array and \
+                count > 1 else None
+            if decoded is not None:
+                zigzagged, buf = decoded
+                one = numpy.uint64(1)
+                deltas = (zigzagged >> one).view(numpy.int64) ^ \
+                    -(zigzagged & one).view(numpy.int64)
+                return self._accumulate(numpy.concatenate(([first], deltas)),
+                                        count), buf
+            deltas, buf = self.value_coder.decode_many(buf, count - 1)
+            deltas.insert(0, first)
+            return self._accumulate(deltas, count), buf
+
+        first, buf = self.value_coder.decode(buf)
+        deltas = [first]
+        while len(deltas) < count:
+            delta, buf = self.value_coder.decode(buf)
+            repeat, buf = self.run_coder.decode(buf)
+            deltas.extend([delta] * repeat)
+        return self._accumulate(deltas, count), buf
+
+    def _accumulate(self, deltas, count):
+        """
+        Turn the first value and the differences back into values.
+        """
+        if len(deltas) != count:
+            raise ValueError("Run exceeds the number of elements (%s)" %
+                             (count,))
+        if self.validate_on_decode():
+            self.validate(deltas)
+        if self.as_array:
+            return numpy.cumsum(numpy.array(deltas, dtype=numpy.int64))
+
+        total = 0
+        values = []
+        for delta in deltas:
+            total += delta
+            values.append(total)
+        return values
+
+
+def _is_immutable(value):
+    return isinstance(value, (int, long, float, basestring, enum34.Enum))
+
+
+class _DeltaState(object):
+    """
+    The state of a DeltaRecord coder in a single Session.
+    """
+    __slots__ = ("sent", "received")
+
+    def __init__(self):
+        # The encoding of each member, as last sent.
+        self.sent = None
+        # A (value, encoding) pair for each member, as last received. Only
+        # one of them is kept: the value if it is immutable, and can therefore
+        # be shared by consecutive records, or the encoding otherwise.
+        self.received = None
+
+
+class DeltaRecord(Coder):
+    """
+    Encodes a Record as the difference from the previous Record of the same
+    coder within a Session (usually, the previous message of the same type on
+    the same connection).
+
+    Each encoding starts with a bitmap of the members that changed, followed
+    by those members. The first Record in a Session is always sent in full.
+    Both sides must encode / decode all the Records of the connection in order,
+    each within its own Session.
+    """
+
+    def __init__(self, record_class):
+        """
+        Initialize new DeltaRecord.
+
+        :param record_class: The Record subclass this coder encodes.
+        """
+        self.record_class = record_class
+        self.names = record_class.members.keys()
+        self.coders = record_class.members.values()
+        self.bitmap_size = (len(self.names) + 7) // 8
+
+    def _session(self):
+        session = current_session()
+        if session is None:
+            raise ValueError("DeltaRecord requires an active Session")
+        return session
+
+    def default_value(self):
+        return self.record_class.default_value()
+
+    def write_to(self, value, stream):
+        session = self._session()
+        state = session.state(self, _DeltaState)
+        encodings = [coder.encode(getattr(value, name))
+                     for name, coder in itertools.izip(self.names, self.coders)]
+        previous = state.sent
+        bitmap = bytearray(self.bitmap_size)
+        changed = []
+        for i, encoding in enumerate(encodings):
+            if previous is None or previous[i] != encoding:
+                bitmap[i // 8] |= 0x80 >> (i % 8)
+                changed.append(encoding)
+        state.sent = encodings
+        session.undo(setattr, state, "sent", previous)
+
+        stream.write(bitmap)
+        for encoding in changed:
+            stream.write(encoding)
+        return self.bitmap_size + sum(len(encoding) for encoding in changed)
+
+    def read_from(self, stream):
+        state = self._session().state(self, _DeltaState)
+        bitmap = bytearray(stream.read(self.bitmap_size))
+        if len(bitmap) < self.bitmap_size:
+            raise ValueError("Cannot decode - reached end of data")
+
+        previous = state.received
+        received = []
+        kwargs = {}
+        for i, (name, coder) in enumerate(itertools.izip(self.names,
+                                                         self.coders)):
+            if bitmap[i // 8] & (0x80 >> (i % 8)):
+                value = coder.read_from(stream)
+                if _is_immutable(value):
+                    received.append((value, None))
+                else:
+                    received.append((None, coder.encode(value)))
+            elif previous is None:
+                raise ValueError("Member %s is missing from the first record" %
+                                 (name,))
+            else:
+                value, encoding = previous[i]
+                received.append(previous[i])
+                if encoding is not None:
+                    # Decode a fresh copy, so records never share members.
+                    value, _ = coder.decode(encoding)
+            kwargs[name] = value
+        state.received = received
+        return self.record_class(**kwargs)
+
+
+__all__ = (DeltaSequence.__name__, DeltaRecord.__name__)
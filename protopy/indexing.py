@@ -0,0 +1,283 @@
+import bisect
+import os
+
+from containers import RecordBase, ChoiceBase, Choice
+from storage import RecordFile
+
+
+class _Missing(Exception):
+    """
+    Raised when a record does not have the indexed field, for example when the
+    field belongs to a variant of a Choice other than the one in the record.
+    """
+
+
+def _variant_tags(choice_class):
+    return {variant.__name__: tag
+            for tag, variant in choice_class.variants.iteritems()}
+
+
+def field_extractor(coder, path):
+    """
+    Create a function that extracts a single field from an encoded value.
+
+    The function reads only what is needed to reach the field: fixed-size
+    members preceding it are skipped by seeking, and only variable-size
+    members are decoded in order to skip them.
+
+    The path is a dot-separated list of names. For Records, each name is a
+    member name. For Choices, a name may be "tag" for the tag of the Choice,
+    "value" for whatever variant it holds, or the name of a specific variant,
+    in which case values holding other variants do not have the field.
+
+    :param coder: The coder of the encoded values.
+    :param path: The path of the field, for example "payload.Upgrade.path".
+    :return: A function that takes a seekable stream positioned at the
+        beginning of an encoded value, and returns the value of the field.
+        The function raises _Missing if the value does not have the field.
+    :raise ValueError: If `path` does not describe a field of `coder`.
+    """
+    return _extractor(coder, path.split(".") if path else [])
+
+
+def _extractor(coder, names):
+    if not names:
+        return coder.read_from
+
+    name, rest = names[0], names[1:]
+    if isinstance(coder, RecordBase):
+        return _record_extractor(coder, name, rest)
+    if isinstance(coder, ChoiceBase):
+        return _choice_extractor(coder, name, rest)
+    raise ValueError("%s has no field named %s" % (coder, name))
+
+
+def _record_extractor(record_class, name, rest):
+    if name not in record_class.members:
+        raise ValueError("%s has no member named %s" %
+                         (record_class.__name__, name))
+
+    # Group the members preceding `name` into (bytes to seek, coder to decode)
+    # pairs, so consecutive fixed-size members are skipped in a single seek.
+    skips = []
+    fixed = 0
+    for member_name, member_coder in record_class.members.iteritems():
+        if member_name == name:
+            break
+        size = member_coder.fixed_size()
+        if size is None:
+            skips.append((fixed, member_coder))
+            fixed = 0
+        else:
+            fixed += size
+    inner = _extractor(record_class.members[name], rest)
+
+    def extract(stream):
+        for offset, skipped in skips:
+            if offset:
+                stream.seek(offset, os.SEEK_CUR)
+            skipped.read_from(stream)
+        if fixed:
+            stream.seek(fixed, os.SEEK_CUR)
+        return inner(stream)
+
+    return extract
+
+
+def _choice_extractor(choice_class, name, rest):
+    tag_enum = choice_class.tag_enum
+    if name == "tag":
+        if rest:
+            raise ValueError("The tag of %s has no fields" %
+                             (choice_class.__name__,))
+        return tag_enum.read_from
+
+    if name == "value":
+        inners = {}
+        for tag, variant in choice_class.variants.iteritems():
+            try:
+                inners[tag] = _extractor(variant, rest)
+            except ValueError:
+                # This variant doesn't have the field.
+                pass
+        if not inners:
+            raise ValueError("No variant of %s has the field %s" %
+                             (choice_class.__name__, ".".join(rest)))
+
+        def extract(stream):
+            inner = inners.get(tag_enum.read_from(stream))
+            if inner is None:
+                raise _Missing()
+            return inner(stream)
+
+        return extract
+
+    expected_tag = _variant_tags(choice_class).get(name)
+    if expected_tag is None:
+        raise ValueError("%s has no variant named %s" %
+                         (choice_class.__name__, name))
+    inner = _extractor(choice_class.variants[expected_tag], rest)
+
+    def extract(stream):
+        if tag_enum.read_from(stream) != expected_tag:
+            raise _Missing()
+        return inner(stream)
+
+    return extract
+
+
+def field_getter(path):
+    """
+    Create a function that gets a field from a decoded value.
+
+    This is the decoded counterpart of `field_extractor`, and accepts the same
+    paths.
+
+    :param path: The path of the field, for example "payload.Upgrade.path".
+    :return: A function that takes a decoded value and returns the value of the
+        field. The function raises _Missing if the value does not have the
+        field.
+    """
+    names = path.split(".") if path else []
+
+    def get(value):
+        # Whether the value is a variant of a Choice, which may or may not have
+        # the requested field.
+        any_variant = False
+        for name in names:
+            if isinstance(value, Choice):
+                if name == "tag":
+                    value = value.tag
+                    continue
+                any_variant = name == "value"
+                if not any_variant:
+                    variant = value.variants[value.tag]
+                    if variant.__name__ != name:
+                        raise _Missing()
+                value = value.value
+            else:
+                try:
+                    value = getattr(value, name)
+                except AttributeError:
+                    if any_variant:
+                        raise _Missing()
+                    raise
+                any_variant = False
+        return value
+
+    return get
+
+
+class FieldIndex(object):
+    """
+    A secondary index, mapping the values of a field to the positions of the
+    records holding them.
+
+    Supports equality lookups through a hash table and range queries through
+    a sorted list of the values.
+    """
+
+    def __init__(self, source, path, entries):
+        """
+        Initialize new FieldIndex. Use `build_index` to create indexes.
+
+        :param source: The indexed records. A RecordFile or a list.
+        :param path: The path of the indexed field.
+        :param entries: An iterable of (value, position) pairs.
+        """
+        self.source = source
+        self.path = path
+        entries = sorted(entries)
+        self._keys = [key for key, _ in entries]
+        self._positions = [position for _, position in entries]
+        self._table = {}
+        for key, position in entries:
+            self._table.setdefault(key, []).append(position)
+
+    def __len__(self):
+        """
+        :return: The number of indexed records.
+        """
+        return len(self._positions)
+
+    def __contains__(self, value):
+        return value in self._table
+
+    def keys(self):
+        """
+        :return: The distinct values of the field, sorted.
+        """
+        return sorted(self._table.keys())
+
+    def positions(self, value):
+        """
+        :param value: A value of the indexed field.
+        :return: The positions of the records whose field equals `value`, in
+            ascending order.
+        """
+        return list(self._table.get(value, ()))
+
+    def positions_in_range(self, low=None, high=None):
+        """
+        :param low: Optional. The lowest value to include.
+        :param high: Optional. The highest value to include.
+        :return: The positions of the records whose field is in
+            [`low`, `high`], ordered by the value of the field.
+        """
+        start = 0 if low is None else bisect.bisect_left(self._keys, low)
+        end = (len(self._keys) if high is None
+               else bisect.bisect_right(self._keys, high))
+        return self._positions[start:end]
+
+    def find(self, value):
+        """
+        :param value: A value of the indexed field.
+        :return: The records whose field equals `value`.
+        """
+        return [self.source[i] for i in self.positions(value)]
+
+    def find_range(self, low=None, high=None):
+        """
+        :param low: Optional. The lowest value to include.
+        :param high: Optional. The highest value to include.
+        :return: The records whose field is in [`low`, `high`].
+        """
+        return [self.source[i] for i in self.positions_in_range(low, high)]
+
+
+def build_index(source, path):
+    """
+    Index records by the value of one of their fields.
+
+    If `source` is a RecordFile, the field is extracted from the encoded
+    records, without decoding them completely. Otherwise `source` should be a
+    sequence of decoded records.
+
+    Records that do not have the field (because their Choice holds a different
+    variant) are not indexed.
+
+    :param source: A RecordFile or a sequence of decoded records.
+    :param path: The path of the field. See `field_extractor`.
+    :return: A FieldIndex.
+    """
+    entries = []
+    if isinstance(source, RecordFile):
+        extract = field_extractor(source.coder, path)
+        with source.session:
+            for position in xrange(len(source)):
+                try:
+                    entries.append(
+                        (extract(source.stream_at(position)), position))
+                except _Missing:
+                    pass
+    else:
+        get = field_getter(path)
+        for position, record in enumerate(source):
+            try:
+                entries.append((get(record), position))
+            except _Missing:
+                pass
+    return FieldIndex(source, path, entries)
+
+
+__all__ = (FieldIndex.__name__, build_index.__name__)
@@ -0,0 +1,164 @@
+import array
+import itertools
+import multiprocessing
+from cStringIO import StringIO
+
+from containers import Batch
+from storage import RecordFile, scan_records, INDEX_TYPECODE
+
+# The records being decoded, and the function applied to them. Set by the
+# parent process right before the worker processes are forked, so the workers
+# inherit them instead of receiving them through pickling. Workers only ever
+# get (start, stop) pairs.
+_records = None
+_func = None
+
+
+class BufferRecords(object):
+    """
+    Random access to the records in an in-memory buffer of concatenated
+    encodings.
+    """
+
+    def __init__(self, buf, coder):
+        """
+        :param buf: An object supporting the buffer interface, such as a
+            bytearray, an mmap or a buffer() of a string.
+        :param coder: The coder of the records in the buffer.
+        """
+        self.buffer = buf
+        self.coder = coder
+        self.size = len(buf)
+        record_size = coder.fixed_size()
+        if record_size is not None:
+            count = self.size // record_size if record_size else 0
+            self._starts = xrange(0, count * record_size, record_size)
+        else:
+            ends = array.array(INDEX_TYPECODE)
+            scan_records(coder, self._stream(), 0, self.size, ends)
+            self._starts = [0] + ends[:-1].tolist() if ends else []
+
+    def _stream(self):
+        # cStringIO reads directly from the buffer, without copying it.
+        return StringIO(self.buffer)
+
+    def __len__(self):
+        return len(self._starts)
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError("Record index out of range")
+            return self[index:index + 1][0]
+        start, stop, _ = index.indices(len(self))
+        if start >= stop:
+            return []
+        stream = self._stream()
+        stream.seek(self._starts[start])
+        return [self.coder.read_from(stream) for _ in xrange(stop - start)]
+
+
+def _decode_shard(bounds):
+    start, stop = bounds
+    records = _records[start:stop]
+    if _func is not None:
+        return [_func(record) for record in records]
+    # Sent back as a single encoding, rather than pickled record by record.
+    return Batch(_records.coder, records)
+
+
+def _shards(count, shard_size):
+    return [(start, min(start + shard_size, count))
+            for start in xrange(0, count, shard_size)]
+
+
+def parallel_decode(source, coder, workers=None, shard_size=None,
+                    stream=False, func=None):
+    """
+    Decode a large number of records using multiple processes.
+
+    The records are split into shards at record boundaries. If the records
+    have a fixed size, the boundaries are computed. Otherwise they are taken
+    from the offset index of the file (see RecordFile), or found by a single
+    pass over the buffer that skips the records rather than decoding them
+    (see `Coder.skip`).
+
+    Worker processes are forked with access to the file (through mmap) or the
+    buffer, and receive only the boundaries of the shards they decode. This
+    relies on the `fork` start method, and therefore works on Unix only.
+
+    Whatever the workers return has to be rebuilt by this process. Records
+    are sent back as their encoding (see Batch), so rebuilding them costs
+    about as much as decoding them in the first place, and returning the
+    records themselves is no faster than decoding them serially. To scale,
+    pass a `func` that does the work on the records in the workers, and
+    returns only what is needed of them:
+
+        sizes = parallel_decode(path, Packet,
+                                func=lambda packet: packet.header.size)
+
+    :param source: The path of a record file, or a buffer (bytearray, mmap,
+        memoryview, or buffer() of a string) of concatenated encodings.
+    :param coder: The coder of the records.
+    :param workers: Optional. The number of worker processes. Defaults to the
+        number of CPUs.
+    :param shard_size: Optional. The number of records decoded by a worker in
+        a single task. Defaults to a size that gives each worker several
+        shards, for load balancing.
+    :param stream: If True, return an iterator that yields the records as
+        soon as their shard is decoded. Otherwise return a list.
+    :param func: Optional. A function applied to each record in the worker
+        processes. It is inherited by the workers, so it need not be
+        picklable, but its results must be.
+    :return: The decoded records, or the results of `func`, in order.
+    """
+    global _records, _func
+    if isinstance(source, basestring):
+        records = RecordFile(source, coder)
+    else:
+        records = BufferRecords(source, coder)
+
+    workers = workers or multiprocessing.cpu_count()
+    count = len(records)
+    if shard_size is None:
+        shard_size = max(count // (workers * 4), 1)
+    shards = _shards(count, shard_size)
+
+    _records, _func = records, func
+    try:
+        pool = multiprocessing.Pool(workers)
+    finally:
+        # The workers already have their own copy.
+        _records = _func = None
+
+    if stream:
+        return _stream_results(pool, shards, records)
+
+    try:
+        results = pool.map(_decode_shard, shards)
+        pool.close()
+    finally:
+        pool.terminate()
+        _close(records)
+    return list(itertools.chain.from_iterable(results))
+
+
+def _stream_results(pool, shards, records):
+    try:
+        for results in pool.imap(_decode_shard, shards):
+            for record in results:
+                yield record
+        pool.close()
+    finally:
+        pool.terminate()
+        _close(records)
+
+
+def _close(records):
+    if isinstance(records, RecordFile):
+        records.close()
+
+
+__all__ = (parallel_decode.__name__,)
@@ -1,10 +1,22 @@
+import array
 import struct
+import sys
 from cStringIO import StringIO
 
 import binascii
 
 import enum34
-from coders import Coder
+from coders import Coder, current_session, _policies
+from streams import BufferedSource, skip_bytes
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# The struct symbol of the byte order of this machine.
+NATIVE_ENDIAN = "<" if sys.byteorder == "little" else ">"
 
 
 class ByteOrder(str, enum34.Enum):
@@ -23,6 +35,11 @@ class UnsignedInteger(Coder):
     DEFAULT_WIDTH = 4
     SIGNED = False
 
+    # Coders whose values are packed by `self.struct` exactly as `encode` does
+    # are "fusable": Records and Sequences may pack / unpack many of their
+    # values at once, using a single struct.
+    fusable = True
+
     @classmethod
     def get_bounds(cls, width):
         return 0, 2 ** (8 * width) - 1
@@ -82,9 +99,24 @@ class UnsignedInteger(Coder):
 
         raise ValueError("%s is out of [%s, %s]" % (value, self.min, self.max))
 
+    def validate_many(self, values):
+        """
+        Validate multiple values at once.
+
+        :param values: A sequence of values.
+        """
+        if len(values) > 0:
+            # Checking the extremes is enough, and min / max run at C speed.
+            self.validate(min(values))
+            self.validate(max(values))
+        return True
+
     def default_value(self):
         return self.default
 
+    def fixed_size(self):
+        return self.width
+
     def write_to(self, value, stream):
         encoded = self.encode(value)
         stream.write(encoded)
@@ -95,8 +127,13 @@ class UnsignedInteger(Coder):
         return binascii.unhexlify(hexlified)
 
     def encode(self, value):
-        if self.validate(value):
+        if _policies[self.validation].encode:
+            self.validate(value)
+        try:
             return self.struct.pack(value)
+        except struct.error as e:
+            # Reachable only when validation is turned off.
+            raise ValueError(str(e))
 
     def decode(self, buf):
         mine = buf[:self.width]
@@ -107,11 +144,17 @@ class UnsignedInteger(Coder):
                 (self.width, len(mine)))
 
         value = self._decode_func(mine)
-        if self.validate(value):
-
-            return value, remainder
+        if _policies[self.validation].decode:
+            self.validate(value)
+        return value, remainder
 
     def read_from(self, stream):
+        if isinstance(stream, BufferedSource):
+            value = stream.unpack(self.struct)[0]
+            if _policies[self.validation].decode:
+                self.validate(value)
+            return value
+
         mine = stream.read(self.width)
         if not len or len(mine) < self.width:
             raise ValueError("Cannot decode - reached end of data")
@@ -166,6 +209,9 @@ class Boolean(UnsignedInteger):
     A Coder capable of encoding/decoding Boolean values.
     """
 
+    # Any true value is encoded as 1, which struct wouldn't do for us.
+    fusable = False
+
     def __init__(self, default=False, **kwargs):
         # BooleanField is a 1-byte integer
         super(Boolean, self).__init__(default, width=1, **kwargs)
@@ -175,11 +221,270 @@ class Boolean(UnsignedInteger):
         # Optimized, since we only have two possible values
         return "\x01" if value else "\x00"
 
+    def write_to(self, value, stream):
+        stream.write("\x01" if value else "\x00")
+        return 1
+
+    def read_from(self, stream):
+        c = stream.read(1)
+        if len(c) == 0:
+            raise ValueError("Cannot decode - reached end of data")
+        return c != "\x00"
+
     @staticmethod
     def _decode_bool(as_bytes):
         return False if as_bytes == "\x00" else True
 
 
+class Float(Coder):
+    """
+    A Coder capable of encoding/decoding IEEE 754 floating point numbers.
+    """
+
+    DEFAULT_BYTE_ORDER = ByteOrder.MSB_FIRST
+    STANDARD_WIDTHS = {4: "f", 8: "d"}
+    DEFAULT_WIDTH = 8
+
+    fusable = True
+
+    def __init__(self, default=0.0, width=DEFAULT_WIDTH,
+                 byte_order=DEFAULT_BYTE_ORDER):
+        """
+        Initialize a new Float Coder.
+
+        :param default: The default value of this coder.
+        :param width: 4 for single precision, or 8 for double precision.
+        :param byte_order: The byte-order of this coder. Must be one of
+            ByteOrder's values.
+        """
+        if width not in self.STANDARD_WIDTHS:
+            raise ValueError("Invalid width: %s. Supported widths are %s" %
+                             (width, sorted(self.STANDARD_WIDTHS.keys())))
+        self.default = default
+        self.width = width
+        self.byte_order = byte_order
+        self.struct = struct.Struct("%s%s" % (
+            UnsignedInteger.ENDIAN[byte_order], self.STANDARD_WIDTHS[width]))
+
+    def validate(self, value):
+        # Every float can be encoded. Values that are too large for single
+        # precision are rejected by struct.
+        return True
+
+    def validate_many(self, values):
+        return True
+
+    def default_value(self):
+        return self.default
+
+    def fixed_size(self):
+        return self.width
+
+    def encode(self, value):
+        try:
+            return self.struct.pack(value)
+        except (struct.error, OverflowError) as e:
+            raise ValueError(str(e))
+
+    def write_to(self, value, stream):
+        stream.write(self.encode(value))
+        return self.width
+
+    def decode(self, buf):
+        if len(buf) < self.width:
+            raise ValueError(
+                "Premature end of data. Expected %s bytes, got only %s" %
+                (self.width, len(buf)))
+        return self.struct.unpack_from(buf)[0], buf[self.width:]
+
+    def read_from(self, stream):
+        if isinstance(stream, BufferedSource):
+            return stream.unpack(self.struct)[0]
+        mine = stream.read(self.width)
+        if len(mine) < self.width:
+            raise ValueError("Cannot decode - reached end of data")
+        return self.struct.unpack(mine)[0]
+
+
+class VarUInt(Coder):
+    """
+    A Coder for unsigned integers of variable width (LEB128).
+
+    Each byte holds 7 bits of the value, least significant group first. The
+    most significant bit of each byte is set if more bytes follow. Small
+    values therefore take fewer bytes: values below 128 take a single byte.
+    """
+
+    DEFAULT_MAX = 2 ** 64 - 1
+
+    def __init__(self, default=0, min_value=None, max_value=None):
+        """
+        Initialize a new VarUInt Coder.
+
+        :param default: The default value of this coder.
+        :param min_value: Optional. A lower limit for valid values.
+        :param max_value: Optional. An upper limit for valid values. Defaults
+            to the largest 64 bit value. The limit also bounds the number of
+            bytes read when decoding.
+        """
+        self.default = default
+        self.min, self.max = self.get_bounds()
+        if min_value is not None and min_value > self.min:
+            self.min = min_value
+        if max_value is not None and max_value < self.max:
+            self.max = max_value
+        # The number of bytes needed to encode the largest magnitude.
+        largest = max(self.to_unsigned(self.min), self.to_unsigned(self.max))
+        self.max_width = max((largest.bit_length() + 6) // 7, 1)
+
+    @classmethod
+    def get_bounds(cls):
+        return 0, cls.DEFAULT_MAX
+
+    @staticmethod
+    def to_unsigned(value):
+        return value
+
+    @staticmethod
+    def from_unsigned(value):
+        return value
+
+    def validate(self, value):
+        if self.min <= value <= self.max:
+            return True
+
+        raise ValueError("%s is out of [%s, %s]" % (value, self.min, self.max))
+
+    def default_value(self):
+        return self.default
+
+    def write_to(self, value, stream):
+        encoded = self.encode(value)
+        stream.write(encoded)
+        return len(encoded)
+
+    def encode(self, value):
+        if _policies[self.validation].encode:
+            self.validate(value)
+        out = bytearray()
+        self._encode_into(self.to_unsigned(value), out)
+        return str(out)
+
+    def encode_many(self, values):
+        """
+        Encode multiple values into a single buffer, in one pass.
+
+        :param values: An iterable of values.
+        :return: The concatenated encodings of `values`.
+        """
+        validate = self.validate_on_encode()
+        out = bytearray()
+        for value in values:
+            if validate:
+                self.validate(value)
+            self._encode_into(self.to_unsigned(value), out)
+        return str(out)
+
+    @staticmethod
+    def _encode_into(value, out):
+        if value < 0:
+            raise ValueError("Cannot encode negative value %s" % (value,))
+        while value > 0x7f:
+            out.append((value & 0x7f) | 0x80)
+            value >>= 7
+        out.append(value)
+
+    def read_from(self, stream):
+        if isinstance(stream, BufferedSource):
+            values, offset = self._decode_from(stream.peek(self.max_width), 0,
+                                               1)
+            stream.consume(offset)
+            return values[0]
+
+        value = shift = 0
+        for _ in xrange(self.max_width):
+            c = stream.read(1)
+            if len(c) == 0:
+                raise ValueError("Cannot decode - reached end of data")
+            byte = ord(c)
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return self._decoded(value)
+            shift += 7
+        raise ValueError("Variable-length integer exceeds %s bytes" %
+                         (self.max_width,))
+
+    def decode(self, buf):
+        # Only the first max_width bytes can belong to the value.
+        values, offset = self._decode_from(buf[:self.max_width], 0, 1)
+        return values[0], buf[offset:]
+
+    def decode_many(self, buf, count=None):
+        """
+        Decode multiple consecutive values from a buffer, in one pass.
+
+        :param buf: A sequence of bytes.
+        :param count: Optional. The number of values to decode. If omitted,
+            values are decoded until the buffer is exhausted.
+        :return: (values, remainder) A tuple of the list of decoded values and
+            the remainder of the buffer.
+        """
+        values, offset = self._decode_from(buf, 0, count)
+        return values, buf[offset:]
+
+    def _decode_from(self, buf, offset, count):
+        data = bytearray(buf)
+        end = len(data)
+        values = []
+        value = shift = width = 0
+        while count is None or len(values) < count:
+            if offset >= end:
+                if width == 0 and count is None:
+                    break
+                raise ValueError("Cannot decode - reached end of data")
+            byte = data[offset]
+            offset += 1
+            value |= (byte & 0x7f) << shift
+            width += 1
+            if byte < 0x80:
+                values.append(self._decoded(value))
+                value = shift = width = 0
+            elif width == self.max_width:
+                raise ValueError("Variable-length integer exceeds %s bytes" %
+                                 (self.max_width,))
+            else:
+                shift += 7
+        return values, offset
+
+    def _decoded(self, value):
+        value = self.from_unsigned(value)
+        if _policies[self.validation].decode:
+            self.validate(value)
+        return value
+
+
+class VarSInt(VarUInt):
+    """
+    A Coder for signed integers of variable width.
+
+    Values are mapped to unsigned integers using ZigZag encoding, so values of
+    small magnitude take fewer bytes regardless of their sign:
+    0 -> 0, -1 -> 1, 1 -> 2, -2 -> 3 and so on.
+    """
+
+    @classmethod
+    def get_bounds(cls):
+        return -2 ** 63, 2 ** 63 - 1
+
+    @staticmethod
+    def to_unsigned(value):
+        return value << 1 if value >= 0 else ((-value) << 1) - 1
+
+    @staticmethod
+    def from_unsigned(value):
+        return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
 def singleton(cls):
     """
     Transform a class into a single instance of that class. like None.
@@ -209,6 +514,9 @@ class Char(Coder):
     def default_value(self):
         return self.NULL
 
+    def fixed_size(self):
+        return 1
+
 
 class Sequence(Coder):
     """
@@ -223,8 +531,11 @@ class Sequence(Coder):
     When decoding a countless sequence, the entire buffer/stream is decoded.
     """
 
+    CONTAINERS = ("list", "array", "numpy")
+
     def __init__(self, element_coder, max_length=None,
-                 min_length=0, include_length=False, length_width=None):
+                 min_length=0, include_length=False, length_width=None,
+                 length_coder=None, container="list"):
         """
         Initialize new Sequence.
 
@@ -236,7 +547,25 @@ class Sequence(Coder):
             prefix when encoding the sequence.
         :param length_width: The number of bytes to use when encoding the number
             of elements.
+        :param length_coder: Optional. The coder used to encode the number of
+            elements, for example VarUInt(). By default an UnsignedInteger
+            capable of encoding `max_length` is used. If `max_length` is not
+            specified, the upper limit of this coder is used instead.
+        :param container: The type of the decoded sequence. One of "list",
+            "array" for array.array, or "numpy" for a read-only NumPy array.
+            Arrays are supported only for fusable elements, such as integers
+            and floats.
         """
+        if container not in self.CONTAINERS:
+            raise ValueError("Invalid container: %s. Supported containers are "
+                             "%s" % (container, self.CONTAINERS))
+        if container != "list" and not getattr(element_coder, "fusable", False):
+            raise ValueError("Only sequences of fusable elements can be decoded"
+                             " into arrays")
+        if container == "numpy" and numpy is None:
+            raise ValueError("Decoding into NumPy arrays requires NumPy")
+        if max_length is None and length_coder is not None:
+            max_length = length_coder.max
         if max_length is None and length_width is None:
             raise ValueError(
                 "You must specify either max_length or length_width. Unbound "
@@ -246,12 +575,48 @@ class Sequence(Coder):
         self.min = min_length
         self.include_length = include_length
         self.length_width = length_width
-        self.length_coder = UnsignedInteger.capable_of(
-            self.max, min_value=self.min)
+        if length_coder is None:
+            length_coder = UnsignedInteger.capable_of(
+                self.max, min_value=self.min)
+        self.length_coder = length_coder
+        self.container = container
+
+        # Fusable elements are packed / unpacked in bulk.
+        self._bulk = getattr(element_coder, "fusable", False)
+        if self._bulk:
+            fmt = element_coder.struct.format
+            self._endian, self._element_format = fmt[0], fmt[1:]
+            self._element_size = element_coder.struct.size
+            if container == "array":
+                self._typecode = self._array_typecode()
+            elif container == "numpy":
+                self._dtype = numpy.dtype(fmt)
+
+    def _array_typecode(self):
+        """
+        :return: The array typecode that matches the element format.
+        """
+        # Python 2 doesn't have the "q" and "Q" typecodes, and the size of the
+        # other integer typecodes is platform-dependent.
+        candidates = {"B": "B", "H": "H", "I": "IL", "Q": "L", "b": "b",
+                      "h": "h", "i": "il", "q": "l", "f": "f", "d": "d"}
+        for typecode in candidates[self._element_format]:
+            if array.array(typecode).itemsize == self._element_size:
+                return typecode
+        raise ValueError("No array typecode matches %s" %
+                         (self._element_format,))
 
     def default_value(self):
         return []
 
+    def fixed_size(self):
+        if self.include_length or self.min != self.max:
+            return None
+        element_size = self.element_coder.fixed_size()
+        if element_size is None:
+            return None
+        return self.max * element_size
+
     def validate(self, value):
         count = len(value)
         if not self.min <= count <= self.max:
@@ -261,17 +626,45 @@ class Sequence(Coder):
         return True
 
     def write_to(self, value, stream):
-        if self.validate(value):
-            written = self._write_length(stream, value)
-            written += self._write_elements(stream, value)
-            return written
+        if self.validate_on_encode():
+            self.validate(value)
+        written = self._write_length(stream, value)
+        written += self._write_elements(stream, value)
+        return written
 
     def _write_elements(self, stream, value):
+        if self._bulk:
+            return self._write_bulk(stream, value)
+
+        encode_many = getattr(self.element_coder, "encode_many", None)
+        if encode_many is not None:
+            encoded = encode_many(value)
+            stream.write(encoded)
+            return len(encoded)
+
         written = 0
         for element in value:
             written += self.element_coder.write_to(element, stream)
         return written
 
+    def _write_bulk(self, stream, value):
+        if _policies[self.element_coder.validation].encode:
+            self.element_coder.validate_many(value)
+        if numpy is not None and isinstance(value, numpy.ndarray):
+            # Arrays that already have the right layout are written without
+            # copying them.
+            encoded = buffer(numpy.ascontiguousarray(value, dtype=numpy.dtype(
+                self._endian + self._element_format)))
+        else:
+            try:
+                encoded = struct.pack(
+                    "%s%d%s" % (self._endian, len(value), self._element_format),
+                    *value)
+            except (struct.error, OverflowError) as e:
+                raise ValueError(str(e))
+        stream.write(encoded)
+        return len(encoded)
+
     def _write_length(self, stream, value):
         length = len(value)
         written = 0
@@ -282,19 +675,82 @@ class Sequence(Coder):
     def read_from(self, stream):
         count = self._read_length(stream)
         elements = self._read_elements(count, stream)
-        if self.validate(elements):
-            return elements
+        if self.validate_on_decode():
+            self.validate(elements)
+        return elements
+
+    def decode(self, buf):
+        decode_many = getattr(self.element_coder, "decode_many", None)
+        if decode_many is None or not self.include_length:
+            return super(Sequence, self).decode(buf)
+
+        # The elements can be decoded in bulk, straight from the buffer.
+        count, buf = self.length_coder.decode(buf)
+        elements, remainder = decode_many(buf, count)
+        if self.validate_on_decode():
+            self.validate(elements)
+        return elements, remainder
+
+    def skip(self, stream):
+        count = self._read_length(stream)
+        if count < 0:
+            # Extends to the end of the data.
+            self.read_from(stream)
+            return
+        element_size = self.element_coder.fixed_size()
+        if element_size is not None:
+            skip_bytes(stream, count * element_size)
+            return
+        for _ in xrange(count):
+            self.element_coder.skip(stream)
 
     def _read_length(self, stream):
         if not self.include_length:
-            return -1
+            # A sequence of a fixed number of elements ends after them.
+            # Otherwise, it extends to the end of the data.
+            return self.max if self.min == self.max else -1
         return self.length_coder.read_from(stream)
 
     def _read_elements(self, count, stream):
+        if self._bulk:
+            return self._read_bulk(count, stream)
         if count < 0:
             return self._read_countless(stream)
         return [self.element_coder.read_from(stream) for _ in xrange(count)]
 
+    def _read_bulk(self, count, stream):
+        size = self._element_size
+        if count < 0:
+            data = stream.read()
+            count = min(len(data) // size, self.max)
+            if count < self.max and len(data) % size:
+                raise ValueError("Premature end of data. %s bytes cannot be "
+                                 "decoded" % (len(data) % size,))
+            data = data[:count * size]
+        elif self.container == "list" and isinstance(stream, BufferedSource):
+            elements = list(stream.unpack(struct.Struct(
+                "%s%d%s" % (self._endian, count, self._element_format))))
+            if _policies[self.element_coder.validation].decode:
+                self.element_coder.validate_many(elements)
+            return elements
+        else:
+            data = stream.read(count * size)
+            if len(data) < count * size:
+                raise ValueError("Cannot decode - reached end of data")
+
+        if self.container == "numpy":
+            elements = numpy.frombuffer(data, dtype=self._dtype)
+        elif self.container == "array":
+            elements = array.array(self._typecode, data)
+            if self._endian != NATIVE_ENDIAN:
+                elements.byteswap()
+        else:
+            elements = list(struct.unpack(
+                "%s%d%s" % (self._endian, count, self._element_format), data))
+        if _policies[self.element_coder.validation].decode:
+            self.element_coder.validate_many(elements)
+        return elements
+
     def _read_countless(self, stream):
         # If you try to decode an element from a depleted stream, you'll get a
         # ValueError.
@@ -314,10 +770,10 @@ class Array(Sequence):
     Array is a sequence with fixed size.
     """
 
-    def __init__(self, element_coder, size):
+    def __init__(self, element_coder, size, container="list"):
         super(Array, self).__init__(
             element_coder=element_coder, min_length=size, max_length=size,
-            include_length=False, length_width=None)
+            include_length=False, length_width=None, container=container)
 
 
 class String(Coder):
@@ -325,6 +781,10 @@ class String(Coder):
     Null-terminated character sequence, optionally limited in length.
     """
 
+    # The number of bytes read at a time when looking for the NULL terminator
+    # of a string that is skipped.
+    SKIP_CHUNK_SIZE = 64
+
     def __init__(self, max_length=None):
         """
         Initialize new String coder.
@@ -340,21 +800,27 @@ class String(Coder):
 
     def write_to(self, value, stream):
         ascii = self.asciify(value)
-        if Char.NULL in ascii:
-            raise ValueError("NULL (\\0) character cannot appear in the string")
-
         total_length = len(ascii) + 1  # + 1 for null terminator.
-        if self.max_length is not None and total_length > self.max_length:
-            raise ValueError(
-                "String length (%s) is larger than the specified limit (%s). "
-                "Be aware that the NULL terminator is also counted towards the"
-                " limit" % (total_length, self.max_length))
+        if _policies[self.validation].encode:
+            if Char.NULL in ascii:
+                raise ValueError(
+                    "NULL (\\0) character cannot appear in the string")
+            if self.max_length is not None and \
+                    total_length > self.max_length:
+                raise ValueError(
+                    "String length (%s) is larger than the specified limit "
+                    "(%s). Be aware that the NULL terminator is also counted "
+                    "towards the limit" % (total_length, self.max_length))
 
-        stream.write(ascii)
-        stream.write(Char.NULL)
+        # A single write, since for short strings the call costs more than
+        # the copy.
+        stream.write(ascii + Char.NULL)
         return total_length
 
     def read_from(self, stream):
+        if isinstance(stream, BufferedSource):
+            return self._read_buffered(stream)
+
         buf = StringIO()
         read = 0
         while True:
@@ -371,6 +837,37 @@ class String(Coder):
             buf.write(c)
         return self.unasciify(buf.getvalue())
 
+    def skip(self, stream):
+        start = stream.tell()
+        read = 0
+        while True:
+            chunk = stream.read(self.SKIP_CHUNK_SIZE)
+            if not chunk:
+                raise ValueError("Cannot decode - reached end of data")
+            length = chunk.find(Char.NULL)
+            if length >= 0:
+                read += length + 1
+                break
+            read += len(chunk)
+            if self.max_length is not None and read >= self.max_length:
+                raise ValueError(
+                    "Reached maximum length of string (%s) without "
+                    "encountering a NULL terminator" % (self.max_length,))
+        stream.seek(start + read)
+
+    def _read_buffered(self, stream):
+        length = stream.find(Char.NULL, self.max_length)
+        if length < 0:
+            if self.max_length is not None and \
+                    stream.fill(self.max_length) >= self.max_length:
+                raise ValueError(
+                    "Reached maximum length of string (%s) without "
+                    "encountering a NULL terminator" % (self.max_length,))
+            raise ValueError("Cannot decode - reached end of data")
+        value = stream.read(length)
+        stream.consume(1)
+        return self.unasciify(value)
+
     @staticmethod
     def asciify(string):
         """
@@ -400,6 +897,241 @@ class String(Coder):
             raise ValueError(str(e))
 
 
+class Bytes(Coder):
+    """
+    A blob of raw bytes, either of a fixed length or prefixed by its length.
+
+    The payload is read with a single read, and decoding a bytearray or a
+    memoryview returns a memoryview into it, without copying the payload.
+    """
+
+    def __init__(self, length=None, length_coder=None, max_length=None):
+        """
+        Initialize new Bytes coder.
+
+        Exactly one of `length` and `length_coder` must be specified.
+
+        :param length: The length of the blob, for fixed-length blobs.
+        :param length_coder: The coder of the length prefix, for
+            variable-length blobs. For example UnsignedInteger(width=4).
+        :param max_length: Optional. Upper limit for the length of
+            variable-length blobs.
+        """
+        if (length is None) == (length_coder is None):
+            raise ValueError("Exactly one of length and length_coder must be "
+                             "specified")
+        self.length = length
+        self.length_coder = length_coder
+        self.max_length = max_length
+
+    def default_value(self):
+        return "\x00" * self.length if self.length is not None else ""
+
+    def fixed_size(self):
+        return self.length
+
+    def validate(self, length):
+        if self.length is not None and length != self.length:
+            raise ValueError("Expected %s bytes, got %s" %
+                             (self.length, length))
+        if self.max_length is not None and length > self.max_length:
+            raise ValueError("Length (%s) is larger than the specified limit "
+                             "(%s)" % (length, self.max_length))
+        return True
+
+    def write_to(self, value, stream):
+        length = len(value)
+        if _policies[self.validation].encode:
+            self.validate(length)
+        written = 0
+        if self.length_coder is not None:
+            written = self.length_coder.write_to(length, stream)
+        stream.write(value)
+        return written + length
+
+    def encode(self, value):
+        length = len(value)
+        if _policies[self.validation].encode:
+            self.validate(length)
+        data = value.tobytes() if isinstance(value, memoryview) else str(value)
+        if self.length_coder is None:
+            return data
+        return self.length_coder.encode(length) + data
+
+    def _read_length(self, stream):
+        if self.length_coder is None:
+            return self.length
+        length = self.length_coder.read_from(stream)
+        if _policies[self.validation].decode:
+            self.validate(length)
+        return length
+
+    def skip(self, stream):
+        skip_bytes(stream, self._read_length(stream))
+
+    def read_from(self, stream):
+        length = self._read_length(stream)
+        data = stream.read(length)
+        if len(data) < length:
+            raise ValueError("Cannot decode - reached end of data")
+        return data
+
+    def decode(self, buf):
+        if isinstance(buf, (bytearray, memoryview)):
+            # Slice a view, rather than copying the payload.
+            buf = memoryview(buf)
+        length = self.length
+        if self.length_coder is not None:
+            length, buf = self.length_coder.decode(buf)
+            if _policies[self.validation].decode:
+                self.validate(length)
+        if len(buf) < length:
+            raise ValueError("Cannot decode - reached end of data")
+        return buf[:length], buf[length:]
+
+
+class FixedString(Coder):
+    """
+    A string that always takes a fixed number of bytes, padded as needed.
+
+    The padding is removed when decoding, so the string itself must not end
+    with the padding character.
+    """
+
+    def __init__(self, length, pad=Char.NULL):
+        """
+        Initialize new FixedString coder.
+
+        :param length: The number of bytes the string takes.
+        :param pad: The character to pad the string with.
+        """
+        if len(pad) != 1:
+            raise ValueError("The padding must be a single character")
+        self.length = length
+        self.pad = pad
+
+    def default_value(self):
+        return ""
+
+    def fixed_size(self):
+        return self.length
+
+    def validate(self, value):
+        if len(value) > self.length:
+            raise ValueError("String length (%s) is larger than %s" %
+                             (len(value), self.length))
+        return True
+
+    def encode(self, value):
+        value = str(value)
+        if _policies[self.validation].encode:
+            self.validate(value)
+        return value.ljust(self.length, self.pad)[:self.length]
+
+    def write_to(self, value, stream):
+        stream.write(self.encode(value))
+        return self.length
+
+    def read_from(self, stream):
+        data = stream.read(self.length)
+        if len(data) < self.length:
+            raise ValueError("Cannot decode - reached end of data")
+        return data.rstrip(self.pad)
+
+    def decode(self, buf):
+        if len(buf) < self.length:
+            raise ValueError("Cannot decode - reached end of data")
+        return str(buf[:self.length]).rstrip(self.pad), buf[self.length:]
+
+
+class _StringTable(object):
+    """
+    The string table of an InternedString coder in a single Session.
+    """
+    __slots__ = ("ids", "strings")
+
+    def __init__(self):
+        self.ids = {}  # Used for encoding: string -> id
+        self.strings = {}  # Used for decoding: id -> string
+
+
+class InternedString(Coder):
+    """
+    A String that is sent in full only once per Session.
+
+    The first time a string is encoded in a Session, it is assigned an id, and
+    both the id and the string are sent. From then on, only the id is sent.
+    On the decoding side, all the occurrences of a string decode into the same
+    object, so decoded values share their memory.
+
+    The wire format is a VarUInt id. 0 means a new string follows, as
+    a VarUInt of its assigned id followed by the NULL-terminated string.
+
+    Both sides must encode / decode the messages of a connection or file in
+    order, each within its own Session (see RecordLogWriter and RecordFile).
+    Messages that may fail to encode should be encoded within
+    `Session.atomic`, so strings are only assigned ids once sent.
+    """
+
+    def __init__(self, max_length=None, max_entries=2 ** 16):
+        """
+        Initialize new InternedString coder.
+
+        :param max_length: Upper limit for the length of the strings, including
+            the NULL terminator.
+        :param max_entries: The maximum number of strings in the table. Once
+            the table is full, new strings are always sent in full.
+        """
+        self.string = String(max_length=max_length)
+        self.max_entries = max_entries
+        self.id_coder = VarUInt(max_value=max_entries)
+
+    def _session(self):
+        session = current_session()
+        if session is None:
+            raise ValueError("InternedString requires an active Session")
+        return session
+
+    def default_value(self):
+        return self.string.default_value()
+
+    def write_to(self, value, stream):
+        session = self._session()
+        table = session.state(self, _StringTable)
+        string_id = table.ids.get(value)
+        if string_id is not None:
+            return self.id_coder.write_to(string_id, stream)
+
+        string_id = 0  # Not stored.
+        if len(table.ids) < self.max_entries:
+            string_id = len(table.ids) + 1
+        written = self.id_coder.write_to(0, stream)
+        written += self.id_coder.write_to(string_id, stream)
+        written += self.string.write_to(value, stream)
+        # Only now that we know it is valid.
+        if string_id:
+            table.ids[value] = string_id
+            session.undo(table.ids.pop, value)
+        return written
+
+    def read_from(self, stream):
+        table = self._session().state(self, _StringTable)
+        string_id = self.id_coder.read_from(stream)
+        if string_id:
+            try:
+                return table.strings[string_id]
+            except KeyError:
+                raise ValueError("Unknown string id: %s" % (string_id,))
+
+        string_id = self.id_coder.read_from(stream)
+        value = self.string.read_from(stream)
+        if string_id:
+            table.strings[string_id] = value
+        return value
+
+
 __all__ = (UnsignedInteger.__name__, SignedInteger.__name__, Boolean.__name__,
+           VarUInt.__name__, VarSInt.__name__, InternedString.__name__,
+           Bytes.__name__, FixedString.__name__, Float.__name__,
            Sequence.__name__, String.__name__, ByteOrder.__name__,
            Char.__class__.__name__)
@@ -0,0 +1,450 @@
+import multiprocessing
+import threading
+import time
+from collections import deque
+from Queue import Queue, Empty
+
+from containers import ChoiceBase, Choice, Variant
+
+
+def _resolve(choice_class, path):
+    """
+    Turn a route path into the tags it matches.
+
+    :param choice_class: The outermost Choice.
+    :param path: A dot-separated string of variant names, such as
+        "General.Reset", a sequence of tags and variant names, or a variant,
+        such as Command.General.Reset. `choice_class` itself is the empty
+        path.
+    :return: A tuple of tags, outermost first.
+    :raise ValueError: If the path does not lead through nested Choices.
+    """
+    if path is choice_class:
+        return ()
+    if isinstance(path, Variant):
+        variant = path
+        path = []
+        # Nested variants point to the variant of the Choice holding them.
+        while variant is not choice_class and isinstance(variant, Variant):
+            path.insert(0, variant._tag)
+            variant = variant._parent_choice
+        if variant is not choice_class:
+            raise ValueError("%s is not a variant of %s" %
+                             (path, choice_class.__name__))
+    names = path.split(".") if isinstance(path, basestring) else list(path)
+    if names == [""]:
+        names = []
+    tags = []
+    coder = choice_class
+    for name in names:
+        if not isinstance(coder, ChoiceBase):
+            raise ValueError("%s is not a Choice, so it has no variant %s" %
+                             (coder.__name__, name))
+        if isinstance(name, basestring):
+            tags_by_name = {variant.__name__: tag
+                            for tag, variant in coder.variants.iteritems()}
+            if name not in tags_by_name:
+                raise ValueError("%s has no variant named %s" %
+                                 (coder.__name__, name))
+            tag = coder.tag_enum(tags_by_name[name])
+        else:
+            tag = coder.tag_enum(name)
+        tags.append(tag)
+        coder = coder.variants[tag]._obj
+    return tuple(tags)
+
+
+def _match(routes, path):
+    """
+    :return: The route with the longest path that `path` starts with, or
+        None.
+    """
+    for length in xrange(len(path), -1, -1):
+        route = routes.get(path[:length])
+        if route is not None:
+            return route
+    return None
+
+
+def _path_name(path):
+    return ".".join(tag.name for tag in path)
+
+
+class LazyMessage(object):
+    """
+    An encoded message, decoded only when its value is first needed.
+    """
+    __slots__ = ("coder", "raw", "path", "_value")
+
+    def __init__(self, coder, raw, path):
+        """
+        Initialize new LazyMessage.
+
+        :param coder: The Choice the message is encoded with.
+        :param raw: A memoryview of the encoding.
+        :param path: The tags of the message (see ChoiceBase.peek_path).
+        """
+        self.coder = coder
+        self.raw = raw
+        self.path = path
+        self._value = None
+
+    @property
+    def value(self):
+        """
+        The decoded message.
+
+        :raise ValueError: If the message cannot be decoded.
+        """
+        if self._value is None:
+            value, remainder = self.coder.decode(self.raw)
+            if remainder:
+                raise ValueError("%s bytes left after decoding the message" %
+                                 (len(remainder),))
+            self._value = value
+        return self._value
+
+
+class Router(object):
+    """
+    Routes encoded messages to handlers by their tags, without decoding them.
+
+    Routes are registered for paths of variants. A message goes to the route
+    with the longest path matching its tags, so a route for "General" takes
+    every General message except those with a route of their own, such as
+    "General.Reset". The empty path matches every message.
+
+    Handlers get a memoryview of the encoding, so messages can be forwarded
+    without ever being decoded, or a LazyMessage, which decodes the message
+    only if its value is used.
+    """
+
+    def __init__(self, coder):
+        """
+        Initialize new Router.
+
+        :param coder: The Choice the messages are encoded with.
+        """
+        if not isinstance(coder, ChoiceBase):
+            raise ValueError("Messages can only be routed by the tags of a "
+                             "Choice, not by %r" % (coder,))
+        self.coder = coder
+        self._routes = {}
+
+    def route(self, path, handler, lazy=False):
+        """
+        Register a handler.
+
+        :param path: The variants to handle. A dot-separated string of
+            variant names, such as "General.Reset", a sequence of tags, or a
+            variant, such as Command.General.Reset.
+        :param handler: A callable, called with each message.
+        :param lazy: Whether the handler gets a LazyMessage, rather than a
+            memoryview of the encoding.
+        :raise ValueError: If the path does not match any variant.
+        """
+        self._routes[_resolve(self.coder, path)] = (handler, lazy)
+
+    def dispatch(self, buf):
+        """
+        Pass an encoded message to the handler of its route.
+
+        :param buf: The encoding of a single message. A string, a bytearray
+            or a memoryview.
+        :return: The return value of the handler.
+        :raise ValueError: If the tags cannot be decoded, or no route matches
+            them.
+        """
+        view = memoryview(buf)
+        path = self.coder.peek_path(view)
+        route = _match(self._routes, path)
+        if route is None:
+            raise ValueError("No route for %s" % (_path_name(path),))
+        handler, lazy = route
+        if lazy:
+            return handler(LazyMessage(self.coder, view, path))
+        return handler(view)
+
+
+class _RouteStats(object):
+    """
+    The counters of a single route of a Dispatcher.
+    """
+    __slots__ = ("handled", "errors", "total_latency", "max_latency")
+
+    def __init__(self):
+        self.handled = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def as_dict(self):
+        return {"handled": self.handled,
+                "errors": self.errors,
+                "mean_latency": (self.total_latency / self.handled
+                                 if self.handled else 0.0),
+                "max_latency": self.max_latency}
+
+
+class Dispatcher(object):
+    """
+    Decodes messages and passes them to the handlers of their variants, which
+    run on a set of worker threads ("lanes").
+
+    Messages are assigned to lanes by a key, and each lane handles its
+    messages one at a time, in order, so messages with the same key are
+    handled in the order they were submitted. Each lane has a bounded queue:
+    once it is full, submitting blocks until the lane catches up.
+
+    Handlers are registered for variants, as in Router: a message goes to the
+    handler with the longest path matching its tags. Handlers get the decoded
+    message (the outermost Choice).
+
+    With `processes`, handlers run in a pool of worker processes instead of
+    the lane threads. Each lane keeps several messages in the pool at once,
+    but never two with the same key, so the order of each key is kept.
+    Messages are pickled as their encodings, and handlers must be picklable,
+    module-level functions.
+
+    Usage:
+        with Dispatcher(Command, lanes=4, key=session_of) as dispatcher:
+            dispatcher.register(Command.General.Reset, reset)
+            dispatcher.register(Command, log_unhandled)
+            for buf in frames:
+                dispatcher.submit(buf)
+    """
+
+    def __init__(self, coder, lanes=1, queue_size=1024, key=None,
+                 processes=0, on_error=None):
+        """
+        Initialize new Dispatcher, and start its lanes.
+
+        :param coder: The Choice the messages are encoded with.
+        :param lanes: The number of worker threads.
+        :param queue_size: The maximal number of messages waiting in each
+            lane.
+        :param key: Optional. A function of a decoded message, returning the
+            key that orders it. By default all messages have the same key,
+            and are handled in order.
+        :param processes: Optional. The number of worker processes to run the
+            handlers in. If 0, handlers run in the lane threads.
+        :param on_error: Optional. Called with the message and the exception
+            when a handler fails. Failures are counted in `metrics` anyway.
+        """
+        if not isinstance(coder, ChoiceBase):
+            raise ValueError("Messages can only be dispatched by the tags of "
+                             "a Choice, not by %r" % (coder,))
+        if lanes < 1:
+            raise ValueError("A Dispatcher needs at least one lane")
+        self.coder = coder
+        self.key = key
+        self.on_error = on_error
+        self._routes = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+        # Forked before any lane thread starts.
+        self._pool = multiprocessing.Pool(processes) if processes else None
+        # The number of messages each lane keeps in the pool: enough to keep
+        # the processes busy while the lane collects results.
+        self._pipeline = 2 * processes
+        self._queues = [Queue(queue_size) for _ in xrange(lanes)]
+        self._lanes = [threading.Thread(target=self._run, args=(queue,))
+                       for queue in self._queues]
+        self._closed = False
+        # The number of `dispatch` calls queueing a message, which `close`
+        # waits for, so none is queued after the lanes stop.
+        self._dispatching = 0
+        self._dispatched = threading.Condition(threading.Lock())
+        for lane in self._lanes:
+            lane.daemon = True
+            lane.start()
+
+    def register(self, variant, handler):
+        """
+        Register the handler of a variant.
+
+        :param variant: The variant, such as Command.General.Reset, or its
+            path (see Router.route). The Choice itself matches all messages.
+        :param handler: A callable, called with each decoded message.
+        :raise ValueError: If `variant` is not a variant of the Choice.
+        """
+        path = _resolve(self.coder, variant)
+        with self._lock:
+            self._routes[path] = (path, handler)
+            self._stats.setdefault(path, _RouteStats())
+
+    def submit(self, buf):
+        """
+        Decode a message in the current thread, and queue it for its handler.
+        Blocks while the queue of its lane is full.
+
+        :param buf: The encoding of a single message.
+        :raise ValueError: If the message cannot be decoded, or no handler
+            matches it.
+        """
+        message, remainder = self.coder.decode(buf)
+        if remainder:
+            raise ValueError("%s bytes left after decoding the message" %
+                             (len(remainder),))
+        self.dispatch(message)
+
+    def dispatch(self, message):
+        """
+        Queue a decoded message for its handler. Blocks while the queue of its
+        lane is full.
+
+        :param message: An instance of the Choice.
+        :raise ValueError: If no handler matches the message.
+        """
+        tags = []
+        value = message
+        while isinstance(value, Choice):
+            tags.append(value.tag)
+            value = value.value
+        route = _match(self._routes, tuple(tags))
+        if route is None:
+            raise ValueError("No handler for %s" % (_path_name(tags),))
+        key = self.key(message) if self.key is not None else None
+        queue = self._queues[hash(key) % len(self._queues)]
+
+        with self._dispatched:
+            if self._closed:
+                raise ValueError("The Dispatcher is closed")
+            self._dispatching += 1
+        try:
+            queue.put((route, key, message, time.time()))
+        finally:
+            with self._dispatched:
+                self._dispatching -= 1
+                if not self._dispatching:
+                    self._dispatched.notify_all()
+
+    def _run(self, queue):
+        if self._pool is not None:
+            self._run_pipelined(queue)
+            return
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            error = None
+            try:
+                item[0][1](item[2])
+            except Exception as e:
+                error = e
+            self._handled(queue, item, error)
+
+    def _run_pipelined(self, queue):
+        """
+        Run the handlers of a lane in the pool, several messages at a time.
+        """
+        # (item, result) pairs, in the order the messages were queued.
+        pending = deque()
+        keys = set()
+        while True:
+            if not pending:
+                item = queue.get()
+            else:
+                try:
+                    item = queue.get_nowait()
+                except Empty:
+                    # Nothing else to do meanwhile.
+                    self._collect(queue, pending, keys)
+                    continue
+            if item is None:
+                while pending:
+                    self._collect(queue, pending, keys)
+                return
+            (_, handler), key, message, _ = item
+            # Messages with the same key wait for each other.
+            while key in keys or len(pending) >= self._pipeline:
+                self._collect(queue, pending, keys)
+            pending.append((item, self._pool.apply_async(handler,
+                                                         (message,))))
+            keys.add(key)
+
+    def _collect(self, queue, pending, keys):
+        """
+        Wait for the oldest message of a lane in the pool to be handled.
+        """
+        item, result = pending.popleft()
+        keys.discard(item[1])
+        error = None
+        try:
+            result.get()
+        except Exception as e:
+            error = e
+        self._handled(queue, item, error)
+
+    def _handled(self, queue, item, error):
+        """
+        Account for a message that has been handled.
+
+        :param error: The exception the handler raised, or None.
+        """
+        (path, _), _, message, submitted = item
+        try:
+            if error is not None and self.on_error is not None:
+                try:
+                    self.on_error(message, error)
+                except Exception:
+                    # Already counted as an error. The lane must go on, or
+                    # its queue would block the submitters forever.
+                    pass
+        finally:
+            latency = time.time() - submitted
+            with self._lock:
+                stats = self._stats[path]
+                stats.handled += 1
+                stats.errors += int(error is not None)
+                stats.total_latency += latency
+                stats.max_latency = max(stats.max_latency, latency)
+            queue.task_done()
+
+    def join(self):
+        """
+        Wait until all the queued messages are handled.
+        """
+        for queue in self._queues:
+            queue.join()
+
+    def metrics(self):
+        """
+        :return: A dict holding the number of messages waiting in each lane
+            ("queue_depths"), and for each route ("routes", by the names of
+            its variants), the number of messages handled ("handled") and
+            failed ("errors"), and the mean and maximal latency, in seconds,
+            from submission to completion ("mean_latency", "max_latency").
+        """
+        with self._lock:
+            routes = {_path_name(path): stats.as_dict()
+                      for path, stats in self._stats.iteritems()}
+        return {"queue_depths": [queue.qsize() for queue in self._queues],
+                "routes": routes}
+
+    def close(self):
+        """
+        Handle all the queued messages, and stop the lanes (and processes).
+        """
+        with self._dispatched:
+            if self._closed:
+                return
+            self._closed = True
+            while self._dispatching:
+                self._dispatched.wait()
+        for queue in self._queues:
+            queue.put(None)
+        for lane in self._lanes:
+            lane.join()
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+__all__ = (Router.__name__, LazyMessage.__name__, Dispatcher.__name__)
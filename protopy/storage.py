@@ -0,0 +1,403 @@
+import array
+import mmap
+import os
+
+import enum34
+from coders import Session
+from streams import BufferWriter
+
+# The offset index of a file is kept next to it, in a file with this suffix.
+INDEX_SUFFIX = ".idx"
+
+# Type code of the offsets in the index file. Offsets are 64 bit unsigned
+# integers. Python 2 has no "Q" typecode, but "L" is 64 bit on LP64 platforms.
+INDEX_TYPECODE = "L" if array.array("L").itemsize == 8 else "Q"
+
+# The number of entries the stamp of the record file takes in the index.
+_STAMP_LENGTH = 2
+
+
+def index_path_for(path):
+    """
+    :param path: The path of a record file.
+    :return: The default path of the offset index of that file.
+    """
+    return path + INDEX_SUFFIX
+
+
+def file_stamp(f):
+    """
+    :param f: An open file.
+    :return: The stamp of the file: its size and modification time (in
+        microseconds). An index is trusted only by the file it was written
+        for, as long as its stamp has not changed.
+    """
+    stat = os.fstat(f.fileno())
+    return array.array(INDEX_TYPECODE,
+                       (stat.st_size, int(stat.st_mtime * 1000000)))
+
+
+def read_index(path, stamp=None):
+    """
+    Read an offset index file.
+
+    The index is a flat array of the offsets in which each record **ends**.
+    Storing the end offsets makes the index append-only: adding a record is
+    a matter of appending its end offset, and the last entry is always the
+    number of bytes covered by the index.
+
+    The offsets are preceded by the stamp of the record file (see
+    `file_stamp`), as of the last time the index was written.
+
+    :param path: The path of the index file.
+    :param stamp: Optional. The stamp of the record file. If given, and the
+        index was written for a different stamp, the index is considered
+        stale and is ignored.
+    :return: An array of end offsets. Empty if the index does not exist or is
+        stale.
+    """
+    ends = array.array(INDEX_TYPECODE)
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except IOError:
+        return ends
+
+    # Ignore a partially written trailing entry.
+    usable = len(data) - len(data) % ends.itemsize
+    ends.fromstring(data[:usable])
+    if len(ends) < _STAMP_LENGTH or \
+            stamp is not None and ends[:_STAMP_LENGTH] != stamp:
+        return array.array(INDEX_TYPECODE)
+    del ends[:_STAMP_LENGTH]
+    return ends
+
+
+def write_index(path, ends, stamp):
+    """
+    Write an offset index file, replacing the existing one.
+
+    :param path: The path of the index file.
+    :param ends: An array of end offsets.
+    :param stamp: The stamp of the record file.
+    """
+    with open(path, "wb") as f:
+        stamp.tofile(f)
+        ends.tofile(f)
+
+
+def scan_records(coder, stream, position, size, ends):
+    """
+    Skip consecutive records of a stream (see `Coder.skip`), collecting their
+    end offsets.
+
+    A truncated record at the end of the data is ignored.
+
+    :param coder: The coder of the records.
+    :param stream: A readable, seekable stream.
+    :param position: The offset of the first record to decode.
+    :param size: The offset in which the data ends.
+    :param ends: An array to which the end offset of each record is appended.
+    :raise ValueError: If a record could not be decoded, other than for
+        reaching the end of the data.
+    """
+    stream.seek(position)
+    while position < size:
+        try:
+            coder.skip(stream)
+        except ValueError as e:
+            if stream.tell() < size:
+                raise ValueError("Invalid record at offset %s: %s" %
+                                 (position, e))
+            # The record is truncated.
+            break
+        position = stream.tell()
+        ends.append(position)
+
+
+class RecordFile(object):
+    """
+    A read-only, memory-mapped view of a file of concatenated encodings.
+
+    Records are decoded directly from the memory map, so nothing but the
+    bytes of the decoded record is ever read from the file.
+
+    If the coder has a fixed size, the offset of each record is computed.
+    Otherwise, the offsets are taken from an index file kept next to the
+    record file. The index is built by scanning the file the first time it
+    is opened, and rebuilt whenever the file is modified by anything other
+    than a RecordLogWriter that maintains the index.
+
+    Records are decoded within the `session` of the file, for the sake of
+    stateful coders such as InternedString. Such coders need to see the file
+    from its beginning, so random access to their records is possible only
+    after the file has been scanned or iterated.
+    """
+
+    def __init__(self, path, coder, index_path=None, session=None):
+        """
+        Open a record file.
+
+        :param path: The path of the file.
+        :param coder: The coder of the records in the file.
+        :param index_path: Optional. The path of the offset index, used only
+            for variable-size records. Defaults to `path` + ".idx"
+        :param session: Optional. The Session to decode the records in.
+        """
+        self.path = path
+        self.coder = coder
+        self.session = session if session is not None else Session()
+        self.record_size = coder.fixed_size()
+        self.index_path = (index_path if index_path is not None
+                           else index_path_for(path))
+
+        self._file = open(path, "rb")
+        self.size = os.fstat(self._file.fileno()).st_size
+        # An empty file cannot be memory-mapped.
+        self._map = None
+        if self.size > 0:
+            self._map = mmap.mmap(
+                self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self._ends = None
+        if self.record_size is None:
+            self._ends = self._load_index()
+
+    def _load_index(self):
+        stamp = file_stamp(self._file)
+        ends = read_index(self.index_path, stamp)
+        if not ends and self.size > 0:
+            # Either there is no index, or the file was modified since it was
+            # written.
+            with self.session:
+                scan_records(self.coder, self._map, 0, self.size, ends)
+            try:
+                write_index(self.index_path, ends, stamp)
+            except IOError:
+                # Not being able to persist the index only costs us a scan
+                # the next time the file is opened.
+                pass
+        return ends
+
+    def __len__(self):
+        if self._ends is not None:
+            return len(self._ends)
+        if self.record_size == 0:
+            return 0
+        # A truncated record at the end of the file is ignored.
+        return self.size // self.record_size
+
+    def offset(self, index):
+        """
+        :param index: The index of a record in the file.
+        :return: The offset in the file where the record begins.
+        """
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Record index out of range")
+
+        if self._ends is None:
+            return index * self.record_size
+        return self._ends[index - 1] if index > 0 else 0
+
+    def stream_at(self, index):
+        """
+        :param index: The index of a record in the file.
+        :return: A readable stream over the file, positioned at the beginning
+            of the record. The stream is shared by all the users of this
+            RecordFile, so it must not be used after other operations are
+            made on the file.
+        """
+        self._map.seek(self.offset(index))
+        return self._map
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        with self.session:
+            return self.coder.read_from(self.stream_at(index))
+
+    def __iter__(self):
+        # Records are consecutive, so there is no need to look up offsets. We
+        # do keep track of the position, in case the map is used by someone
+        # else between iterations.
+        position = 0
+        for _ in xrange(len(self)):
+            self._map.seek(position)
+            with self.session:
+                record = self.coder.read_from(self._map)
+            position = self._map.tell()
+            yield record
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class Fsync(str, enum34.Enum):
+    """
+    When a RecordLogWriter should fsync the log to disk.
+    """
+    NEVER = "never"
+    ON_FLUSH = "flush"
+    ON_CLOSE = "close"
+
+
+class RecordLogWriter(object):
+    """
+    Append-only writer of record files.
+
+    Records are encoded into a reusable in-memory buffer, which is written to
+    the file in large sequential writes once it fills up.
+
+    Optionally, the writer maintains the offset index of the file as it goes,
+    so a RecordFile can open the log without scanning it.
+    """
+
+    DEFAULT_FLUSH_SIZE = 1 << 20
+
+    def __init__(self, path, coder, flush_size=DEFAULT_FLUSH_SIZE,
+                 flush_records=None, fsync=Fsync.NEVER, index=False,
+                 index_path=None, session=None):
+        """
+        Open a log for appending.
+
+        :param path: The path of the log. Created if it does not exist.
+        :param coder: The coder of the records in the log.
+        :param flush_size: Flush the buffer once it holds at least this many
+            bytes.
+        :param flush_records: Optional. Flush the buffer once it holds this
+            many records.
+        :param fsync: One of Fsync's values.
+        :param index: Whether to maintain the offset index of the log. Logs of
+            fixed-size records do not need an index, so this is ignored for
+            them.
+        :param index_path: Optional. The path of the offset index. Defaults to
+            `path` + ".idx"
+        :param session: Optional. The Session to encode the records in, for
+            the sake of stateful coders such as InternedString. Defaults to a
+            new Session, whose lifetime is that of the writer.
+        """
+        self.path = path
+        self.coder = coder
+        self.session = session if session is not None else Session()
+        self.flush_size = flush_size
+        self.flush_records = flush_records
+        self.fsync = Fsync(fsync)
+        self.index_path = (index_path if index_path is not None
+                           else index_path_for(path))
+        self._buffer = BufferWriter(capacity=flush_size)
+        self._pending_ends = array.array(INDEX_TYPECODE)
+        self._pending_records = 0
+
+        self._file = open(path, "ab")
+        self._file.seek(0, os.SEEK_END)
+        # The offset in the file in which the buffer will be written.
+        self._base = self._file.tell()
+
+        self._index_file = None
+        if index and coder.fixed_size() is None:
+            if self._base > 0:
+                # Make sure the existing index covers the existing records,
+                # since we are about to append to it.
+                RecordFile(path, coder, index_path=self.index_path).close()
+            else:
+                # Discard the index of a previous log, if there is one.
+                write_index(self.index_path, array.array(INDEX_TYPECODE),
+                            file_stamp(self._file))
+            # Not opened for appending, since the stamp is updated in place.
+            self._index_file = open(self.index_path, "r+b")
+
+    def write(self, record):
+        """
+        Append a record to the log.
+
+        :param record: The record to append.
+        :return: The number of bytes the record was encoded into.
+        """
+        start = self._buffer.tell()
+        try:
+            with self.session.atomic():
+                self.coder.write_to(record, self._buffer)
+        except:
+            # Don't leave a partially encoded record in the buffer.
+            self._buffer.truncate(start)
+            raise
+        end = self._buffer.tell()
+        if self._index_file is not None:
+            self._pending_ends.append(self._base + end)
+        self._pending_records += 1
+
+        if (end >= self.flush_size or
+                self._pending_records == self.flush_records):
+            self.flush()
+        return end - start
+
+    def write_many(self, records):
+        """
+        Append multiple records to the log.
+
+        :param records: An iterable of records.
+        """
+        for record in records:
+            self.write(record)
+
+    def flush(self):
+        """
+        Write the buffered records to the file.
+        """
+        if self._pending_records == 0:
+            return
+
+        # Records are written before the index, so the index never refers to
+        # records that are not in the file.
+        self._file.write(self._buffer.view())
+        self._file.flush()
+        if self._index_file is not None:
+            self._index_file.seek(0, os.SEEK_END)
+            self._pending_ends.tofile(self._index_file)
+            # Then the stamp, so the index is trusted only once complete.
+            self._index_file.seek(0)
+            file_stamp(self._file).tofile(self._index_file)
+            self._index_file.flush()
+            del self._pending_ends[:]
+
+        self._base += len(self._buffer)
+        self._buffer.reset()
+        self._pending_records = 0
+
+        if self.fsync is Fsync.ON_FLUSH:
+            self._sync()
+
+    def _sync(self):
+        os.fsync(self._file.fileno())
+        if self._index_file is not None:
+            os.fsync(self._index_file.fileno())
+
+    def close(self):
+        if self._file.closed:
+            return
+        self.flush()
+        if self.fsync is Fsync.ON_CLOSE:
+            self._sync()
+        self._file.close()
+        if self._index_file is not None:
+            self._index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+__all__ = (RecordFile.__name__, RecordLogWriter.__name__, Fsync.__name__)
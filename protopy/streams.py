@@ -0,0 +1,408 @@
+import os
+import threading
+from contextlib import contextmanager
+
+# The maximal number of buffers passed to a single writev / sendmsg call. The
+# operating system limit (IOV_MAX) is at least 1024 on all common platforms.
+IOV_MAX = 1024
+
+# The initial size of the reusable encoding buffers (see `encoding_buffer`).
+ENCODING_BUFFER_SIZE = 512
+# Buffers that grew beyond this size (to encode an unusually large message) are
+# replaced by small ones once released, so a spike does not pin its memory for
+# the lifetime of the thread.
+MAX_RETAINED_SIZE = 1 << 16
+# The number of released buffers kept by each thread. Nested blocks each use a
+# buffer of their own.
+MAX_FREE_BUFFERS = 8
+
+# Holds the free encoding buffers of each thread.
+_local = threading.local()
+
+
+class BufferWriter(object):
+    """
+    A writeable file-like object that writes into a reusable bytearray.
+
+    Unlike StringIO, resetting the writer does not release its memory, so a
+    single writer can be used to encode many messages without reallocating.
+    """
+
+    def __init__(self, capacity=0):
+        """
+        Initialize new BufferWriter.
+
+        :param capacity: The number of bytes to pre-allocate.
+        """
+        self.buffer = bytearray(capacity)
+        self._length = 0
+
+    def write(self, data):
+        end = self._length + len(data)
+        # Overwrite the unused part of the buffer, extending it if needed.
+        self.buffer[self._length:end] = data
+        self._length = end
+
+    def tell(self):
+        return self._length
+
+    def __len__(self):
+        return self._length
+
+    def getvalue(self):
+        """
+        :return: A copy of the bytes written so far, as a string.
+        """
+        return str(buffer(self.buffer, 0, self._length))
+
+    def view(self):
+        """
+        :return: A memoryview of the bytes written so far. The view must be
+            released before writing to the buffer again.
+        """
+        return memoryview(self.buffer)[:self._length]
+
+    def patch(self, offset, data):
+        """
+        Overwrite bytes that were already written.
+
+        :param offset: The offset of the bytes to overwrite.
+        :param data: The new bytes.
+        """
+        if offset + len(data) > self._length:
+            raise ValueError("Cannot patch beyond the written bytes")
+        self.buffer[offset:offset + len(data)] = data
+
+    def truncate(self, size):
+        """
+        Discard the bytes written after the first `size` bytes.
+        """
+        self._length = min(size, self._length)
+
+    def reset(self):
+        """
+        Discard the bytes written so far, keeping the allocated memory.
+        """
+        self._length = 0
+
+
+class IovWriter(object):
+    """
+    A writeable file-like object that collects the written data as a list of
+    buffers, for scatter-gather output (see `write_iov` and `send_iov`).
+
+    Small writes are coalesced into a single buffer. Large writes are kept by
+    reference rather than copied, so they must not be modified until the
+    buffers are sent.
+    """
+
+    DEFAULT_THRESHOLD = 1024
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD):
+        """
+        Initialize new IovWriter.
+
+        :param threshold: The size, in bytes, from which written data is kept
+            by reference.
+        """
+        self.threshold = threshold
+        self._buffers = []
+        self._small = bytearray()
+        self._length = 0
+
+    def write(self, data):
+        size = len(data)
+        if size >= self.threshold:
+            self._flush_small()
+            self._buffers.append(data)
+        else:
+            self._small += data
+        self._length += size
+
+    def _flush_small(self):
+        if self._small:
+            self._buffers.append(self._small)
+            self._small = bytearray()
+
+    def tell(self):
+        return self._length
+
+    def __len__(self):
+        return self._length
+
+    def buffers(self):
+        """
+        :return: The list of buffers written so far, in order.
+        """
+        self._flush_small()
+        return self._buffers
+
+    def getvalue(self):
+        """
+        :return: A copy of the bytes written so far, as a string.
+        """
+        return "".join(view.tobytes() for view in _byte_views(self.buffers()))
+
+
+class BufferedSource(object):
+    """
+    A readable file-like object that reads a socket or a file in large chunks
+    into a reusable bytearray, using recv_into / readinto.
+
+    Coders recognize it and decode straight from its buffer (for example,
+    using struct.unpack_from), rather than reading a new string for every
+    field. Since it reads ahead, the underlying socket or file should not be
+    read directly once wrapped.
+    """
+
+    DEFAULT_CAPACITY = 1 << 16
+
+    def __init__(self, source, capacity=DEFAULT_CAPACITY):
+        """
+        Initialize new BufferedSource.
+
+        :param source: A socket, or a file-like object with a `readinto`
+            method.
+        :param capacity: The initial size of the buffer. It grows as needed
+            to hold larger reads.
+        """
+        self._read_into = (getattr(source, "recv_into", None) or
+                           getattr(source, "readinto", None))
+        if self._read_into is None:
+            raise ValueError("%r supports neither recv_into nor readinto" %
+                             (source,))
+        self.source = source
+        self.buffer = bytearray(max(capacity, 1))
+        # The unconsumed bytes are buffer[_start:_end]. `_offset` is the
+        # position of the beginning of the buffer in the source.
+        self._start = self._end = 0
+        self._offset = 0
+
+    def available(self):
+        """
+        :return: The number of bytes buffered and not consumed yet.
+        """
+        return self._end - self._start
+
+    def fill(self, size):
+        """
+        Buffer at least `size` bytes, reading from the source as needed.
+
+        :param size: The number of bytes to buffer.
+        :return: The number of bytes available, which is less than `size`
+            only at the end of the source.
+        """
+        while self._end - self._start < size:
+            if self._start + size > len(self.buffer):
+                self._compact(size)
+            read = self._read_into(memoryview(self.buffer)[self._end:])
+            if not read:
+                break
+            self._end += read
+        return self._end - self._start
+
+    def _compact(self, size):
+        # Move the unconsumed bytes to the beginning of the buffer, and make
+        # sure it can hold `size` bytes.
+        pending = self._end - self._start
+        self.buffer[:pending] = self.buffer[self._start:self._end]
+        self._offset += self._start
+        self._start, self._end = 0, pending
+        if size > len(self.buffer):
+            self.buffer.extend(
+                bytearray(max(size, 2 * len(self.buffer)) - len(self.buffer)))
+
+    def peek(self, size):
+        """
+        :param size: The number of bytes to look at.
+        :return: A memoryview of the next `size` bytes (or less, at the end of
+            the source), without consuming them. The view must be released
+            before reading any further.
+        """
+        self.fill(size)
+        end = min(self._start + size, self._end)
+        return memoryview(self.buffer)[self._start:end]
+
+    def consume(self, size):
+        """
+        Skip the next `size` bytes, which must be available already.
+        """
+        if size > self._end - self._start:
+            raise ValueError("Cannot consume %s bytes, only %s are available" %
+                             (size, self._end - self._start))
+        self._start += size
+
+    def read(self, size=-1):
+        """
+        :param size: The number of bytes to read. If negative, read until the
+            end of the source.
+        :return: The bytes read, as a string.
+        """
+        if size < 0:
+            # Read until the end of the source, growing the buffer as needed.
+            size = self.available()
+            while self.fill(size + 1) > size:
+                size = self.available()
+        size = min(self.fill(size), size)
+        data = str(buffer(self.buffer, self._start, size))
+        self._start += size
+        return data
+
+    def unpack(self, unpacker):
+        """
+        Unpack values straight from the buffer, and consume them.
+
+        :param unpacker: A struct.Struct.
+        :return: The unpacked values.
+        :raise ValueError: If the source ends before the values.
+        """
+        size = unpacker.size
+        if self._end - self._start < size and self.fill(size) < size:
+            raise ValueError("Cannot decode - reached end of data")
+        values = unpacker.unpack_from(self.buffer, self._start)
+        self._start += size
+        return values
+
+    def find(self, char, limit=None):
+        """
+        Find the next occurrence of a character, without consuming anything.
+
+        :param char: The character to look for.
+        :param limit: Optional. The number of bytes to search.
+        :return: The number of bytes preceding the character, or -1 if it
+            does not occur in the next `limit` bytes, or before the end of the
+            source.
+        """
+        searched = 0
+        while True:
+            end = self._end
+            if limit is not None:
+                end = min(end, self._start + limit)
+            index = self.buffer.find(char, self._start + searched, end)
+            if index >= 0:
+                return index - self._start
+            searched = end - self._start
+            if limit is not None and searched >= limit:
+                return -1
+            if self.fill(searched + 1) <= searched:
+                return -1
+
+    def tell(self):
+        """
+        :return: The number of bytes consumed so far.
+        """
+        return self._offset + self._start
+
+
+@contextmanager
+def encoding_buffer():
+    """
+    Borrow a reusable BufferWriter of the current thread, for encoding
+    several messages into one buffer, without allocating and growing a new
+    one for every batch:
+
+        with encoding_buffer() as buf:
+            for packet in packets:
+                packet.write_to(buf)
+            sock.sendall(buf.view())
+
+    The buffer is empty when borrowed, and must not be used (nor any view of
+    it kept) once the block exits.
+    """
+    free = getattr(_local, "free", None)
+    if free is None:
+        free = _local.free = []
+    writer = free.pop() if free else BufferWriter(ENCODING_BUFFER_SIZE)
+    try:
+        yield writer
+    finally:
+        if len(free) < MAX_FREE_BUFFERS:
+            if len(writer.buffer) > MAX_RETAINED_SIZE:
+                writer.buffer = bytearray(ENCODING_BUFFER_SIZE)
+            writer.reset()
+            free.append(writer)
+
+
+def skip_bytes(stream, count):
+    """
+    Advance a stream past `count` bytes, without reading them.
+
+    :param stream: A readable, seekable file-like object.
+    :param count: The number of bytes to skip.
+    :raise ValueError: If fewer than `count` bytes remain. The stream is then
+        left at its end.
+    """
+    position = stream.tell() + count
+    stream.seek(0, os.SEEK_END)
+    if stream.tell() < position:
+        raise ValueError("Cannot skip - reached end of data")
+    stream.seek(position)
+
+
+def _byte_view(data):
+    if isinstance(data, memoryview):
+        return data
+    # Through buffer(), so arrays are viewed as bytes rather than elements.
+    return memoryview(buffer(data))
+
+
+def _byte_views(buffers):
+    return [_byte_view(data) for data in buffers if len(data) > 0]
+
+
+def _consume(views, written):
+    """
+    Drop the first `written` bytes from a list of byte memoryviews.
+    """
+    while written:
+        if written < len(views[0]):
+            views[0] = views[0][written:]
+            break
+        written -= len(views.pop(0))
+
+
+def write_iov(fd, buffers):
+    """
+    Write a list of buffers to a file descriptor, using os.writev where
+    available and consecutive writes otherwise. Partial writes are retried
+    until all the data is written.
+
+    :param fd: A file descriptor.
+    :param buffers: A list of buffers, as returned by `encode_iov`.
+    :return: The number of bytes written.
+    """
+    views = _byte_views(buffers)
+    total = sum(len(view) for view in views)
+    writev = getattr(os, "writev", None)
+    while views:
+        if writev is not None:
+            _consume(views, writev(fd, views[:IOV_MAX]))
+        else:
+            _consume(views, os.write(fd, views[0]))
+    return total
+
+
+def send_iov(sock, buffers):
+    """
+    Send a list of buffers through a connected socket, using socket.sendmsg
+    where available and consecutive sends otherwise. Partial sends are retried
+    until all the data is sent.
+
+    :param sock: A connected socket.
+    :param buffers: A list of buffers, as returned by `encode_iov`.
+    :return: The number of bytes sent.
+    """
+    views = _byte_views(buffers)
+    total = sum(len(view) for view in views)
+    sendmsg = getattr(sock, "sendmsg", None)
+    while views:
+        if sendmsg is not None:
+            _consume(views, sendmsg(views[:IOV_MAX]))
+        else:
+            _consume(views, sock.send(views[0]))
+    return total
+
+
+__all__ = (BufferWriter.__name__, IovWriter.__name__,
+           BufferedSource.__name__, write_iov.__name__, send_iov.__name__,
+           encoding_buffer.__name__, skip_bytes.__name__)
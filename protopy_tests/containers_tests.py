@@ -1,10 +1,19 @@
+import copy
+import cPickle
 import struct
+import zlib
 from cStringIO import StringIO
 from unittest import TestCase
 
 from protopy.containers import RecordBase, Record, Member, \
-    BitMaskedIntegerMeta, BitMaskedInteger, Enumeration
-from dummy import Header, Command, General, GetStatus, Flags
+    BitMaskedIntegerMeta, BitMaskedInteger, Enumeration, Choice, Compressed, \
+    Checksum, LengthOf, Template, CachedRecord, RecordPool, \
+    FrozenRecord, Batch
+from protopy.coders import Session, Validation, validation
+from protopy.streams import BufferWriter
+from protopy.primitives import VarUInt, Float, UnsignedInteger, \
+    SignedInteger, ByteOrder, String, Boolean, InternedString, Sequence
+from dummy import Header, Command, General, GetStatus, Flags, Packet
 
 
 class EnumerationTests(TestCase):
@@ -43,6 +52,29 @@ class EnumerationTests(TestCase):
             in_buf = StringIO(encoded)
             self.assertRaises(ValueError, self.DaysOfWeek.read_from, in_buf)
 
+    def test_encoding_tables(self):
+        class Schedule(Record):
+            first = Member(self.DaysOfWeek)
+            second = Member(self.DaysOfWeek)
+
+        schedule = Schedule(first=self.DaysOfWeek.Tuesday,
+                            second=self.DaysOfWeek.Friday)
+        self.assertEqual(schedule.encode(), "\x03\x06")
+        self.assertEqual(Schedule().encode(), "\x01\x01")
+
+        decoded, _ = Schedule.decode("\x06\x01")
+        self.assertIs(decoded.first, self.DaysOfWeek.Friday)
+        self.assertRaises(ValueError, Schedule.decode, "\x06")
+        self.assertRaises(ValueError, Schedule.decode, "\x06\x09")
+
+    def test_unencodable_member(self):
+        class Wide(Enumeration):
+            Small = 1
+            Large = 0x100
+
+        self.assertEqual(Wide.Small.encode(), "\x01")
+        self.assertRaises(ValueError, Wide.Large.encode)
+
 
 class MemberTest(TestCase):
     def test_order(self):
@@ -107,6 +139,26 @@ class RecordTest(TestCase):
     def test_default_value(self):
         self.verify_default_members(Header.default_value())
 
+    def test_mutable_defaults(self):
+        class Log(Record):
+            header = Member(Header)
+            payload = Member(Command)
+            lines = Member(Sequence(String(), max_length=10))
+
+        first, second = Log(), Log()
+        self.verify_default_members(first)
+        self.assertIsNot(first.header, second.header)
+        self.assertIsNot(first.payload, second.payload)
+        self.assertIsNot(first.lines, second.lines)
+        first.lines.append("line")
+        self.assertEqual(Log().lines, [])
+
+    def test_from_values(self):
+        header = Header.from_values(0xcafe, 1, 2)
+        self.assertEqual(header, Header(barker=0xcafe, size=1,
+                                        inverted_size=2))
+        self.assertRaises(ValueError, Header.from_values, 1, 2)
+
     def test_invalid_member(self):
         """
         Try to create a Record subclass with a member that is not a Coder.
@@ -138,6 +190,54 @@ class RecordTest(TestCase):
         self.assertNotEqual(h1, 12)
 
 
+class FusedRecordTest(TestCase):
+    class Reading(Record):
+        sensor = Member(UnsignedInteger(width=2))
+        value = Member(Float(width=4))
+        offset = Member(SignedInteger(width=1))
+        label = Member(String())
+        little = Member(UnsignedInteger(width=2,
+                                        byte_order=ByteOrder.LSB_FIRST))
+        scale = Member(Float(width=8, byte_order=ByteOrder.LSB_FIRST))
+
+    def test_layout(self):
+        fused = [step.names for step in self.Reading._layout
+                 if hasattr(step, "names")]
+        self.assertEqual(fused, [["sensor", "value", "offset"],
+                                 ["little", "scale"]])
+
+    def test_coding(self):
+        reading = self.Reading(sensor=7, value=0.5, offset=-1, label="a",
+                               little=1, scale=2.0)
+        expected = (struct.pack(">Hfb", 7, 0.5, -1) + "a\x00" +
+                    struct.pack("<Hd", 1, 2.0))
+        self.assertEqual(reading.encode(), expected)
+        self.assertEqual(self.Reading.decode(expected), (reading, ""))
+
+    def test_validation(self):
+        reading = self.Reading(sensor=0x10000)
+        self.assertRaises(ValueError, reading.encode)
+        self.assertRaises(ValueError, self.Reading.decode, "\x00\x01")
+
+    def test_coder_policy(self):
+        trusted = UnsignedInteger(width=1, max_value=10)
+        trusted.validation = Validation.OFF
+
+        class Limits(Record):
+            low = Member(UnsignedInteger(width=1, max_value=10))
+            high = Member(trusted)
+
+        # Members with policies of their own are not fused with others.
+        self.assertEqual([step.names for step in Limits._layout],
+                         [["low"], ["high"]])
+        self.assertEqual(Limits(high=11).encode(), "\x00\x0b")
+        self.assertRaises(ValueError, Limits(low=11).encode)
+        with validation(Validation.OFF):
+            self.assertEqual(Limits(low=11).encode(), "\x0b\x00")
+        with validation(Validation.STRICT):
+            self.assertRaises(ValueError, Limits(high=11).encode)
+
+
 class ChoiceTest(TestCase):
     get_status = Command.General.GetStatus(
         is_active=True, uptime=0x1234)
@@ -172,6 +272,105 @@ class ChoiceTest(TestCase):
         self.assertEqual(remainder, "")
         self.assertEqual(decoded, self.get_status)
 
+    def test_skip(self):
+        packet = Packet(payload=Command.Upgrade(path="/firmware"))
+        for coder, value in ((Command, self.get_status), (Packet, packet),
+                             (Header, Header())):
+            stream = StringIO(value.encode() + "rest")
+            coder.skip(stream)
+            self.assertEqual(stream.read(), "rest")
+        self.assertRaises(ValueError, Command.skip, StringIO("\x77"))
+
+
+class VarIntTagTest(TestCase):
+    class Message(Choice):
+        tag_coder = VarUInt()
+        variants = {
+            1: GetStatus,
+            1000: Header,
+        }
+
+    def test_coding(self):
+        status = self.Message.GetStatus(is_active=True, uptime=1)
+        encoded = status.encode()
+        self.assertEqual(encoded, "\x01\x01\x00\x00\x00\x01")
+        self.assertEqual(self.Message.decode(encoded), (status, ""))
+
+        header = self.Message.Header()
+        self.assertEqual(header.encode()[:2], "\xe8\x07")
+        self.assertEqual(self.Message.decode(header.encode()), (header, ""))
+        self.assertIsNone(self.Message.fixed_size())
+
+
+class CompressedTest(TestCase):
+    def setUp(self):
+        self.packets = [
+            Packet(header=Header(size=i), crc=i,
+                   payload=Command.Upgrade(path="/usr/lib/firmware/%s" % i))
+            for i in xrange(20)]
+
+    def roundtrip(self, coder, session=None):
+        """
+        Encode and decode the packets, each side using its own session.
+        """
+        stream = StringIO()
+        with session or Session():
+            written = sum(coder.write_to(p, stream) for p in self.packets)
+        self.assertEqual(written, len(stream.getvalue()))
+        stream.reset()
+        with Session():
+            decoded = [coder.read_from(stream) for _ in self.packets]
+        self.assertEqual(decoded, self.packets)
+        return written
+
+    def test_per_message(self):
+        coder = Compressed(Packet)
+        encoded = coder.encode(self.packets[0])
+        self.assertEqual(coder.decode(encoded), (self.packets[0], ""))
+        self.roundtrip(coder)
+
+    def test_dictionary_and_streaming(self):
+        plain = self.roundtrip(Compressed(Packet))
+        with_dictionary = self.roundtrip(Compressed(
+            Packet, dictionary=self.packets[0].encode()))
+        streaming = self.roundtrip(Compressed(Packet, streaming=True))
+        self.assertLess(with_dictionary, plain)
+        self.assertLess(streaming, plain)
+
+    def test_streaming_requires_session(self):
+        coder = Compressed(Packet, streaming=True)
+        self.assertRaises(ValueError, coder.encode, self.packets[0])
+
+    def test_failed_write(self):
+        class Message(Record):
+            packet = Member(Compressed(Packet, streaming=True))
+            count = Member(UnsignedInteger(width=1))
+
+        # The last packet would be compressed as a repetition of the failed
+        # one, had the stream not been rewound.
+        paths = ("/boot", "/usr/lib/firmware", "/usr/lib/firmware")
+        packets = [Packet(payload=Command.Upgrade(path=path))
+                   for path in paths]
+        session = Session()
+        sent = []
+        for i, packet in enumerate(packets):
+            message = Message(packet=packet, count=300 if i == 1 else i)
+            try:
+                with session.atomic():
+                    sent.append(message.encode())
+            except ValueError:
+                pass
+        self.assertEqual(len(sent), 2)
+        with Session():
+            self.assertEqual([Message.decode(data)[0].packet for data in sent],
+                             [packets[0], packets[2]])
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, Compressed, Packet, codec="lzma")
+        coder = Compressed(Header, max_size=4)
+        self.assertRaises(ValueError, coder.decode, coder.encode(Header()))
+        self.assertRaises(ValueError, coder.decode, "\x03abc")
+
 
 class BitMaskedIntegerTest(TestCase):
     def setUp(self):
@@ -222,3 +421,573 @@ class BitMaskedIntegerTest(TestCase):
         
 
 
+
+
+class DefaultEncodingTest(TestCase):
+    class Sample(Record):
+        kind = Member(GetStatus)
+        flag = Member(Boolean())
+        ratio = Member(Float(width=4))
+        count = Member(UnsignedInteger(width=1, default=3))
+
+    def test_defaults(self):
+        self.assertEqual(Header().encode(),
+                         "\xca\xfe\xbe\xef\x00\x00\x00\x00")
+        self.assertEqual(Header(size=1).encode(),
+                         "\xca\xfe\xbe\xef\x00\x01\x00\x00")
+        self.assertEqual(self.Sample().encode(),
+                         "\x00" * 5 + "\x00" + "\x00" * 4 + "\x03")
+        self.assertEqual(self.Sample(flag=2, count=True).encode(),
+                         "\x00" * 5 + "\x01" + "\x00" * 4 + "\x01")
+
+    def test_negative_zero(self):
+        self.assertEqual(self.Sample(ratio=-0.0).encode()[6:10],
+                         "\x80\x00\x00\x00")
+
+    def test_invalid_default(self):
+        class Limits(Record):
+            low = Member(UnsignedInteger(width=1))
+            high = Member(UnsignedInteger(width=1, default=300))
+
+        self.assertRaises(ValueError, Limits().encode)
+        self.assertEqual(Limits(high=255).encode(), "\x00\xff")
+
+
+class ChecksumTest(TestCase):
+    class Frame(Record):
+        header = Member(Header)
+        payload = Member(Command)
+        crc = Member(Checksum())
+        sequence = Member(UnsignedInteger(width=2))
+        header_sum = Member(Checksum("adler32", over=["header", "sequence"],
+                                     width=2))
+
+    def setUp(self):
+        self.frame = self.Frame(header=Header(size=3),
+                                payload=Command.Upgrade(path="/tmp"),
+                                sequence=7)
+
+    def test_encode(self):
+        encoded = self.frame.encode()
+        header = Header(size=3).encode()
+        covered = header + Command.Upgrade(path="/tmp").encode()
+        crc = zlib.crc32(covered) & 0xffffffff
+        adler = zlib.adler32(header + "\x00\x07") & 0xffff
+        self.assertEqual(encoded, covered + struct.pack(">IHH", crc, 7, adler))
+        # Computed while encoding.
+        self.assertEqual((self.frame.crc, self.frame.header_sum), (crc, adler))
+        self.assertEqual(self.Frame.decode(encoded), (self.frame, ""))
+
+    def test_mismatch(self):
+        encoded = bytearray(self.frame.encode())
+        encoded[5] ^= 0xff
+        self.assertRaises(ValueError, self.Frame.decode, str(encoded))
+        with validation(Validation.OFF):
+            self.Frame.decode(str(encoded))
+
+    def test_custom(self):
+        class Summed(Record):
+            data = Member(String())
+            total = Member(Checksum(lambda data, total: total + sum(
+                bytearray(data)), width=1, initial=0))
+
+        encoded = Summed(data="ab").encode()
+        self.assertEqual(encoded, "ab\x00" + chr(ord("a") + ord("b")))
+        self.assertEqual(Summed.decode(encoded)[0].total, 0xc3)
+
+    def test_invalid(self):
+        def define(**members):
+            return type("Invalid", (Record,), members)
+
+        self.assertRaises(ValueError, Checksum, "md5")
+        self.assertRaises(ValueError, Checksum, lambda data, total: total)
+        self.assertRaises(ValueError, define, crc=Member(Checksum(over=["x"])),
+                          x=Member(UnsignedInteger()))
+        self.assertRaises(ValueError, Checksum, over="x")
+
+
+class ComputedMemberTest(TestCase):
+    class Frame(Record):
+        size = Member(UnsignedInteger(width=2), computed=LengthOf("payload"))
+        inverted_size = Member(UnsignedInteger(width=2),
+                               computed=LengthOf("payload", inverted=True))
+        payload = Member(Command)
+        trailer = Member(VarUInt(), computed=LengthOf("payload"))
+        crc = Member(Checksum(over=["payload", "trailer"]))
+
+    def setUp(self):
+        self.frame = self.Frame(payload=Command.Upgrade(path="/tmp"))
+        self.payload = Command.Upgrade(path="/tmp").encode()
+
+    def test_encode(self):
+        encoded = self.frame.encode()
+        body = self.payload + "\x06"
+        self.assertEqual(encoded, struct.pack(">HH", 6, 0xfff9) + body +
+                         struct.pack(">I", zlib.crc32(body) & 0xffffffff))
+        self.assertEqual((self.frame.size, self.frame.inverted_size,
+                          self.frame.trailer), (6, 0xfff9, 6))
+        self.assertEqual(self.Frame.decode(encoded + "!"), (self.frame, "!"))
+
+    def test_buffer_writer(self):
+        writer = BufferWriter()
+        writer.write("prefix")
+        self.assertEqual(self.frame.write_to(writer), 15)
+        self.assertEqual(writer.getvalue(), "prefix" + self.frame.encode())
+
+    def test_bounded_decode(self):
+        class Sized(Record):
+            size = Member(UnsignedInteger(width=1),
+                          computed=LengthOf("payload"))
+            payload = Member(Command)
+
+        encoded = Sized(payload=Command.Upgrade(path="/tmp")).encode()
+        self.assertEqual(encoded, "\x06" + self.payload)
+        # The payload is decoded from exactly `size` bytes.
+        self.assertRaises(ValueError, Sized.decode,
+                          "\x07" + self.payload + "!")
+        self.assertRaises(ValueError, Sized.decode, "\x05" + self.payload)
+        self.assertRaises(ValueError, Sized.decode, "\x08" + self.payload)
+
+        encoded = bytearray(self.frame.encode())
+        encoded[3] = 0xf8
+        self.assertRaises(ValueError, self.Frame.decode, str(encoded))
+
+    def test_skip(self):
+        class Sized(Record):
+            size = Member(UnsignedInteger(width=1),
+                          computed=LengthOf("payload"))
+            payload = Member(Command)
+            name = Member(String())
+
+        stream = StringIO(self.frame.encode() + "rest")
+        self.Frame.skip(stream)
+        self.assertEqual(stream.read(), "rest")
+        # Measured members are skipped by their lengths, without decoding
+        # them (0x77 is not a tag of Command).
+        stream = StringIO("\x03\x77ab" + "name\x00" + "rest")
+        Sized.skip(stream)
+        self.assertEqual(stream.read(), "rest")
+        self.assertRaises(ValueError, Sized.skip, StringIO("\x03\x77a"))
+
+    def test_invalid(self):
+        def define(**members):
+            return type("Invalid", (Record,), members)
+
+        self.assertRaises(ValueError, define, size=Member(
+            UnsignedInteger(), computed=LengthOf("missing")))
+        self.assertRaises(ValueError, define,
+                          size=Member(VarUInt(), computed=LengthOf("data")),
+                          data=Member(String()))
+        self.assertRaises(ValueError, define,
+                          size=Member(UnsignedInteger(),
+                                      computed=LengthOf("data")),
+                          data=Member(String()),
+                          crc=Member(Checksum()))
+
+
+class TemplateTest(TestCase):
+    def test_patching(self):
+        template = Packet.template(header=Header(size=6),
+                                   payload=Command.Upgrade(path="/tmp"))
+        self.assertEqual(template.fields(), [
+            "crc", "header", "header.barker", "header.inverted_size",
+            "header.size"])
+        template.set("header.inverted_size", 0xfff9)
+        view = template.update(crc=42)
+        self.assertEqual(template.get("crc"), 42)
+        self.assertEqual(template.get("header"), Header(size=6,
+                                                        inverted_size=0xfff9))
+        expected = Packet(header=Header(size=6, inverted_size=0xfff9),
+                          payload=Command.Upgrade(path="/tmp"), crc=42)
+        self.assertEqual(view.tobytes(), expected.encode())
+        template["header"] = Header(size=1)
+        expected.header = Header(size=1)
+        self.assertEqual(template.getvalue(), expected.encode())
+
+        stream = StringIO()
+        self.assertEqual(template.write_to(stream), len(template))
+        self.assertEqual(stream.getvalue(), expected.encode())
+
+    def test_checksums(self):
+        template = ChecksumTest.Frame.template(
+            header=Header(size=3), payload=Command.Upgrade(path="/tmp"))
+        template.set("header.size", 4)
+        template.set("sequence", 9)
+        expected = ChecksumTest.Frame(
+            header=Header(size=4), payload=Command.Upgrade(path="/tmp"),
+            sequence=9)
+        self.assertEqual(template.getvalue(), expected.encode())
+
+    def test_invalid(self):
+        template = ComputedMemberTest.Frame.template()
+        for path in ("size", "crc", "trailer", "payload", "missing"):
+            self.assertRaises(ValueError, template.set, path, 1)
+        template = Packet.template()
+        self.assertRaises(ValueError, template.set, "header.size", 0x10000)
+        self.assertRaises(ValueError, template.set, "payload",
+                          Command.Upgrade(path="/"))
+
+        class Event(Record):
+            path = Member(InternedString())
+
+        with Session():
+            self.assertRaises(ValueError, Event.template, path="/tmp")
+
+
+class CachedRecordTest(TestCase):
+    class Version(CachedRecord):
+        major = Member(UnsignedInteger(width=1))
+        minor = Member(UnsignedInteger(width=1))
+
+    class Status(CachedRecord):
+        code = Member(UnsignedInteger(width=2))
+        message = Member(String())
+
+    def setUp(self):
+        class Body(Choice):
+            variants = {1: self.Version, 2: self.Status}
+
+        class Response(CachedRecord):
+            version = Member(self.Version)
+            counter = Member(UnsignedInteger(width=4))
+            body = Member(Body)
+            name = Member(String())
+            crc = Member(Checksum())
+
+        self.Body = Body
+        self.Response = Response
+        self.response = Response(version=self.Version(major=1),
+                                 body=Body.Status(code=200, message="OK"),
+                                 name="status")
+
+    def assertEncoding(self, record):
+        encoded = record.encode()
+        self.assertFalse(record.changed())
+        fresh, _ = type(record).decode(encoded)
+        self.assertEqual(fresh, record)
+        self.assertEqual(encoded, Record.encode(fresh))
+        return encoded
+
+    def test_unchanged(self):
+        encoded = self.assertEncoding(self.response)
+        self.assertIs(self.response.encode(), encoded)
+        self.response.name = "status"
+        self.assertEqual(self.response.encode(), encoded)
+
+    def test_patch(self):
+        self.assertEncoding(self.response)
+        template = self.response._template
+        self.response.counter = 7
+        self.response.version.minor = 2
+        self.assertTrue(self.response.changed())
+        self.assertEncoding(self.response)
+        # Patched in place.
+        self.assertIs(self.response._template, template)
+
+    def test_reencode(self):
+        self.assertEncoding(self.response)
+        template = self.response._template
+        self.response.name = "longer name"
+        self.assertEncoding(self.response)
+        self.assertIsNot(self.response._template, template)
+
+        template = self.response._template
+        self.response.body.value.message = "Not found"
+        self.assertEncoding(self.response)
+        self.response.body = self.Body.Version(major=3)
+        self.assertEncoding(self.response)
+        self.assertIsNot(self.response._template, template)
+
+    def test_invalid_patch(self):
+        self.assertEncoding(self.response)
+        self.response.counter = -1
+        self.assertRaises(ValueError, self.response.encode)
+        self.response.counter = 1
+        self.assertEncoding(self.response)
+
+    def test_member_encoded_alone(self):
+        self.assertEncoding(self.response)
+        self.response.version.minor = 5
+        self.response.version.encode()
+        self.assertTrue(self.response.changed())
+        self.assertEqual(self.assertEncoding(self.response)[1], "\x05")
+
+        self.response.body.value.code = 404
+        self.response.body.value.encode()
+        self.assertEncoding(self.response)
+
+    def test_shared_member(self):
+        version = self.response.version
+        other = self.Response(version=version, body=self.Body.Version(),
+                              name="other")
+        self.assertEncoding(self.response)
+        self.assertEncoding(other)
+        version.major = 2
+        self.assertEncoding(other)
+        self.assertTrue(self.response.changed())
+        self.assertEqual(self.assertEncoding(self.response)[0], "\x02")
+
+
+class DecodeIntoTest(TestCase):
+    def test_reuse(self):
+        packet = Packet(header=Header(size=1), payload=Command.Dummy(),
+                        crc=1)
+        header, payload, dummy = packet.header, packet.payload, \
+            packet.payload.value
+
+        expected = Packet(header=Header(size=2),
+                          payload=Command.Dummy(counter_size=5), crc=2)
+        decoded, remainder = Packet.decode_into(packet,
+                                                expected.encode() + "!")
+        self.assertIs(decoded, packet)
+        self.assertEqual(remainder, "!")
+        self.assertEqual(packet, expected)
+        self.assertIs(packet.header, header)
+        self.assertIs(packet.payload, payload)
+        self.assertIs(packet.payload.value, dummy)
+
+        # A different variant replaces the value.
+        expected.payload = Command.General.Reset()
+        Packet.decode_into(packet, expected.encode())
+        self.assertEqual(packet, expected)
+        self.assertIs(packet.payload, payload)
+        general = packet.payload.value
+        expected.payload = Command.General.GetStatus(uptime=3)
+        Packet.decode_into(packet, expected.encode())
+        self.assertEqual(packet, expected)
+        self.assertIs(packet.payload.value, general)
+
+    def test_checksums(self):
+        frame = ChecksumTest.Frame(header=Header(size=3), sequence=1)
+        encoded = frame.encode()
+        target = ChecksumTest.Frame()
+        self.assertEqual(ChecksumTest.Frame.decode_into(target, encoded),
+                         (frame, ""))
+        self.assertRaises(ValueError, ChecksumTest.Frame.decode_into, target,
+                          encoded[:-1] + "\x00")
+
+    def test_cached(self):
+        response = CachedRecordTest.Version(major=1)
+        response.encode()
+        CachedRecordTest.Version.decode_into(response, "\x02\x03")
+        self.assertEqual(response.encode(), "\x02\x03")
+
+    def test_pool(self):
+        pool = RecordPool(Packet, max_size=1)
+        encoded = [Packet(crc=i).encode() for i in xrange(3)]
+        first, _ = pool.decode(encoded[0])
+        self.assertEqual(first.crc, 0)
+        pool.release(first)
+        self.assertEqual(len(pool), 1)
+        second = pool.read_from(StringIO(encoded[1]))
+        self.assertIs(second, first)
+        self.assertEqual(second.crc, 1)
+        self.assertEqual(len(pool), 0)
+        third, _ = pool.decode(encoded[2])
+        self.assertIsNot(third, first)
+        pool.release(first)
+        pool.release(third)
+        self.assertEqual(len(pool), 1)
+
+
+class FrozenSample(FrozenRecord):
+    time = Member(UnsignedInteger(width=4))
+    value = Member(Float())
+
+
+class FrozenRecordTest(TestCase):
+    class Point(FrozenRecord):
+        x = Member(SignedInteger(width=2))
+        y = Member(SignedInteger(width=2))
+        label = Member(String(max_length=8))
+
+    class Sample(FrozenRecord):
+        time = Member(UnsignedInteger(width=4))
+        value = Member(Float())
+
+    def test_construction(self):
+        Point = self.Point
+        point = Point(1, label="a")
+        self.assertEqual(point, (1, 0, "a"))
+        self.assertEqual((point.x, point.y, point.label), (1, 0, "a"))
+        self.assertEqual(Point(), Point(0, 0, ""))
+        self.assertEqual(Point.from_values(1, 2, "b"), Point(y=2, x=1,
+                                                             label="b"))
+        self.assertEqual(point.replace(y=5), Point(1, 5, "a"))
+        self.assertEqual(repr(point), "Point(x=1, y=0, label='a')")
+        self.assertRaises(ValueError, Point, 1, 2, "c", 4)
+        self.assertRaises(ValueError, Point.from_values, 1, 2)
+
+    def test_immutable(self):
+        point = self.Point(1, 2, "a")
+        self.assertRaises(AttributeError, setattr, point, "x", 3)
+        self.assertRaises(AttributeError, setattr, point, "other", 3)
+        self.assertFalse(hasattr(point, "__dict__"))
+        self.assertRaises(ValueError, self.Point.read_into, point,
+                          StringIO(point.encode()))
+
+    def test_hashing(self):
+        points = {self.Point(1, 2, "a"), self.Point(1, 2, "a"),
+                  self.Point(2, 1, "a")}
+        self.assertEqual(len(points), 2)
+        self.assertIn(self.Point(x=2, y=1, label="a"), points)
+
+    def test_encoding(self):
+        point = self.Point(-1, 2, "ab")
+        encoded = point.encode()
+        self.assertEqual(encoded, "\xff\xff\x00\x02ab\x00")
+        self.assertEqual(self.Point.decode(encoded + "!"), (point, "!"))
+        self.assertIs(type(self.Point.decode(encoded)[0]), self.Point)
+
+        sample = self.Sample(7, 0.5)
+        self.assertEqual(sample.encode(), struct.pack(">Id", 7, 0.5))
+        self.assertEqual(self.Sample.decode(sample.encode()), (sample, ""))
+        self.assertEqual(self.Sample.fixed_size(), 12)
+        self.assertRaises(ValueError, self.Sample.decode, "\x00" * 11)
+
+    def test_nested(self):
+        class Line(Record):
+            start = Member(FrozenRecordTest.Point)
+            end = Member(FrozenRecordTest.Point)
+
+        line = Line(end=self.Point(3, 4, "end"))
+        decoded, _ = Line.decode(line.encode())
+        self.assertEqual(decoded, line)
+        self.assertEqual(decoded.start, self.Point())
+        self.assertEqual(Line.template(end=self.Point(3, 4)).get("end.y"), 4)
+
+    def test_pickling(self):
+        # The class must be found by name, so it is declared at module level.
+        sample = FrozenSample(7, 0.5)
+        for protocol in xrange(cPickle.HIGHEST_PROTOCOL + 1):
+            restored = cPickle.loads(cPickle.dumps(sample, protocol))
+            self.assertEqual(restored, sample)
+            self.assertIs(type(restored), FrozenSample)
+            self.assertEqual(restored.value, 0.5)
+
+    def test_decode_into(self):
+        class Line(Record):
+            start = Member(FrozenRecordTest.Point)
+            length = Member(UnsignedInteger(width=1))
+
+        line = Line(start=self.Point(1, 2, "a"), length=3)
+        expected = Line(start=self.Point(3, 4, "b"), length=5)
+        Line.decode_into(line, expected.encode())
+        self.assertEqual(line, expected)
+
+    def test_unsupported_members(self):
+        with self.assertRaises(ValueError):
+            class Frame(FrozenRecord):
+                payload = Member(String())
+                crc = Member(Checksum())
+
+
+class Reading(Record):
+    value = Member(Float(width=4))
+    level = Member(UnsignedInteger(width=1))
+    name = Member(String())
+    crc = Member(Checksum())
+
+
+class PicklingTest(TestCase):
+    packet = Packet(header=Header(size=3),
+                    payload=Command.General.GetStatus(uptime=4), crc=5)
+
+    def round_trip(self, value, protocol=cPickle.HIGHEST_PROTOCOL):
+        return cPickle.loads(cPickle.dumps(value, protocol))
+
+    def test_records(self):
+        for protocol in xrange(cPickle.HIGHEST_PROTOCOL + 1):
+            self.assertEqual(self.round_trip(self.packet, protocol),
+                             self.packet)
+        self.assertEqual(self.round_trip(self.packet.payload),
+                         self.packet.payload)
+        flags = Flags(request_ack=1, field_d=5)
+        self.assertEqual(self.round_trip(flags), flags)
+        # The pickle holds the encoding rather than the attributes.
+        self.assertIn(self.packet.encode(), cPickle.dumps(self.packet, 2))
+
+    def test_enumerations(self):
+        # Tag enums are resolved through their Choice.
+        tag = self.packet.payload.value.tag
+        self.assertIs(self.round_trip(tag), tag)
+        self.assertIs(self.round_trip(tag, 0), tag)
+        self.assertIs(self.round_trip(Command.tag_enum.Dummy),
+                      Command.tag_enum.Dummy)
+
+    def test_session(self):
+        # Each pickled value is encoded in a Session of its own.
+        class Event(Record):
+            path = Member(InternedString())
+
+        with Session():
+            Event(path="/dev/sda").encode()
+            event = Event(path="/dev/sda")
+            function, args = event.__reduce__()
+            self.assertEqual(function(*args), event)
+
+    def test_batch(self):
+        packets = [Packet(header=Header(size=i), payload=Command.Dummy(),
+                          crc=i) for i in xrange(100)]
+        batch = Batch(Packet, packets)
+        data = cPickle.dumps(batch, 2)
+        self.assertLess(len(data), len(cPickle.dumps(packets, 2)))
+        restored = cPickle.loads(data)
+        self.assertIsInstance(restored, Batch)
+        self.assertIs(restored.coder, Packet)
+        self.assertEqual(restored, packets)
+        self.assertEqual(self.round_trip(Batch(Packet)), [])
+
+    def test_precision(self):
+        # Pickled as encoded, unlike copies (see CopyTest).
+        reading = Reading(value=0.1)
+        self.assertNotEqual(self.round_trip(reading).value, 0.1)
+        self.assertIsInstance(self.round_trip(reading).name, unicode)
+
+
+class CopyTest(TestCase):
+    def setUp(self):
+        class Body(Choice):
+            variants = {1: Reading}
+
+        self.Body = Body
+
+    def assertCopies(self, value):
+        for function in copy.copy, copy.deepcopy:
+            copied = function(value)
+            self.assertIsNot(copied, value)
+            self.assertIs(type(copied), type(value))
+            self.assertEqual(copied, value)
+        return copied
+
+    def test_records(self):
+        # Copied as they are, not as they would be encoded.
+        reading = Reading(value=0.1, level=300, name="sda", crc=7)
+        copied = self.assertCopies(reading)
+        self.assertEqual(copied.value, 0.1)
+        self.assertIs(type(copied.name), str)
+        self.assertEqual(copied.level, 300)
+        self.assertEqual(reading.crc, 7)
+
+        body = self.Body.Reading(value=0.1, level=300)
+        copied = self.assertCopies(body)
+        self.assertIsNot(copied.value, body.value)
+        self.assertIs(copied.tag, body.tag)
+        self.assertEqual(body.value.crc, 0)
+
+    def test_other_values(self):
+        self.assertCopies(Flags(request_ack=1, field_d=5))
+        sample = FrozenSample(7, 0.1)
+        self.assertEqual(self.assertCopies(sample).value, 0.1)
+
+    def test_cached_record(self):
+        class Reading(CachedRecord):
+            level = Member(UnsignedInteger(width=1))
+
+        reading = Reading(level=1)
+        reading.encode()
+        copied = copy.copy(reading)
+        copied.level = 2
+        self.assertEqual(copied.encode(), "\x02")
+        self.assertFalse(reading.changed())
+        self.assertEqual(reading.encode(), "\x01")
@@ -0,0 +1,110 @@
+from cStringIO import StringIO
+from unittest import TestCase, skipIf
+
+from protopy.coders import Session
+from protopy.delta import DeltaSequence, DeltaRecord, numpy
+from dummy import Packet, Header, Command
+
+
+class DeltaSequenceTest(TestCase):
+    timestamps = [1500000000 + 10 * i for i in xrange(100)]
+    readings = [20, 21, 21, 19, -5, 0, 0, 0, 2 ** 40]
+
+    def check_roundtrip(self, coder, values):
+        encoded = coder.encode(values)
+        self.assertEqual(coder.decode(encoded + "\xaa"), (values, "\xaa"))
+        self.assertEqual(coder.read_from(StringIO(encoded)), values)
+        return encoded
+
+    def test_coding(self):
+        coder = DeltaSequence(max_length=1000)
+        encoded = self.check_roundtrip(coder, self.timestamps)
+        # count + first value + 99 one-byte deltas.
+        self.assertEqual(len(encoded), 1 + 5 + 99)
+        self.check_roundtrip(coder, self.readings)
+        self.check_roundtrip(coder, [])
+        self.check_roundtrip(coder, [-7])
+
+    def test_run_length(self):
+        coder = DeltaSequence(max_length=1000, run_length=True)
+        encoded = self.check_roundtrip(coder, self.timestamps)
+        # count + first value + a single (delta, count) pair.
+        self.assertEqual(len(encoded), 1 + 5 + 2)
+        self.check_roundtrip(coder, self.readings)
+
+    def test_invalid(self):
+        coder = DeltaSequence(max_length=3, run_length=True)
+        self.assertRaises(ValueError, coder.encode, [1, 2, 3, 4])
+        # Three elements, but a run of five.
+        self.assertRaises(ValueError, coder.decode, "\x03\x00\x02\x05")
+
+    @skipIf(numpy is None, "NumPy is not available")
+    def test_numpy(self):
+        coder = DeltaSequence(max_length=1000, as_array=True)
+        values = numpy.array(self.readings, dtype=numpy.int64)
+        encoded = coder.encode(values)
+        self.assertEqual(encoded, DeltaSequence(1000).encode(self.readings))
+        decoded, _ = coder.decode(encoded)
+        self.assertTrue(numpy.array_equal(decoded, values))
+
+    @skipIf(numpy is None, "NumPy is not available")
+    def test_numpy_varints(self):
+        coder = DeltaSequence(max_length=1000, as_array=True)
+        # Differences of every width, up to the widest (10 bytes), which is
+        # decoded value by value.
+        for values in ([0, 127, 128, -2 ** 40, 2 ** 40, 0],
+                       [0, 2 ** 62, 0]):
+            values = numpy.array(values, dtype=numpy.int64)
+            encoded = coder.encode(values)
+            self.assertEqual(encoded,
+                             DeltaSequence(1000).encode(values.tolist()))
+            for buf in encoded + "!", memoryview(encoded + "!"):
+                decoded, remainder = coder.decode(buf)
+                self.assertTrue(numpy.array_equal(decoded, values))
+                self.assertEqual(remainder[:], "!")
+        for end in xrange(len(encoded)):
+            self.assertRaises(ValueError, coder.decode, encoded[:end])
+
+
+class DeltaRecordTest(TestCase):
+    def setUp(self):
+        self.coder = DeltaRecord(Packet)
+        self.packets = [
+            Packet(header=Header(size=10), crc=i,
+                   payload=Command.Upgrade(path="/firmware"))
+            for i in xrange(5)]
+        self.packets[3].header.size = 11
+
+    def test_only_changes_are_sent(self):
+        stream = StringIO()
+        with Session():
+            sizes = [self.coder.write_to(p, stream) for p in self.packets]
+        full = len(self.packets[0].encode())
+        self.assertEqual(sizes[0], 1 + full)
+        # Only the CRC changed.
+        self.assertEqual(sizes[1], 1 + 4)
+        self.assertEqual(sizes[3], 1 + 8 + 4)
+
+        stream.reset()
+        with Session():
+            decoded = [self.coder.read_from(stream) for _ in self.packets]
+        self.assertEqual(decoded, self.packets)
+        # Unchanged mutable members are not shared between records.
+        self.assertIsNot(decoded[1].payload, decoded[2].payload)
+
+    def test_requires_session(self):
+        self.assertRaises(ValueError, self.coder.encode, self.packets[0])
+
+    def test_atomic(self):
+        session = Session()
+        with session.atomic():
+            first = self.coder.encode(self.packets[0])
+        with self.assertRaises(ValueError):
+            with session.atomic():
+                self.coder.encode(self.packets[3])
+                raise ValueError("The message is discarded")
+        with session.atomic():
+            # Encoded against the first packet, which was sent.
+            self.assertEqual(len(self.coder.encode(self.packets[3])),
+                             1 + 8 + 4)
+        self.assertEqual(len(first), 1 + len(self.packets[0].encode()))
@@ -19,7 +19,6 @@ class General(Choice):
 
 
 class Command(Choice):
-    tag_width = 2
 
     class Upgrade(Record):
         path = Member(String(max_length=1024))
@@ -29,7 +28,8 @@ class Command(Choice):
 
     variants = {
         0x01: Upgrade,
-        0x12: Dummy
+        0x12: Dummy,
+        0x54: General,
     }
 
 
@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from protopy.indexing import build_index
+from protopy.storage import RecordFile, RecordLogWriter
+from dummy import Header, Command, Packet
+
+
+class BuildIndexTest(TestCase):
+    def setUp(self):
+        self.packets = []
+        for i in xrange(60):
+            if i % 2:
+                payload = Command.Upgrade(path="/path/%s" % (i % 5,))
+            else:
+                payload = Command.Dummy(counter_size=i)
+            self.packets.append(Packet(header=Header(size=i % 10),
+                                       payload=payload, crc=i))
+
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, "packets.bin")
+        with RecordLogWriter(path, Packet, index=True) as writer:
+            writer.write_many(self.packets)
+        self.file = RecordFile(path, Packet)
+
+    def tearDown(self):
+        self.file.close()
+        shutil.rmtree(self.directory)
+
+    def check_index(self, path, expected):
+        """
+        Build an index over both the file and the decoded packets, and check
+        both against `expected`, a list of (value, position) pairs.
+        """
+        for source in (self.file, self.packets):
+            index = build_index(source, path)
+            self.assertEqual(len(index), len(expected))
+            for value in set(v for v, _ in expected):
+                self.assertEqual(index.positions(value),
+                                 [p for v, p in expected if v == value])
+        return index
+
+    def test_fixed_offset(self):
+        index = self.check_index(
+            "header.size",
+            [(p.header.size, i) for i, p in enumerate(self.packets)])
+        self.assertEqual(index.find(3), [p for p in self.packets
+                                         if p.header.size == 3])
+
+    def test_after_variable_member(self):
+        self.check_index(
+            "crc", [(p.crc, i) for i, p in enumerate(self.packets)])
+
+    def test_choice(self):
+        self.check_index(
+            "payload.tag",
+            [(p.payload.tag, i) for i, p in enumerate(self.packets)])
+        self.check_index(
+            "payload.Upgrade.path",
+            [(p.payload.value.path, i) for i, p in enumerate(self.packets)
+             if i % 2])
+        self.check_index(
+            "payload.value.counter_size",
+            [(p.payload.value.counter_size, i)
+             for i, p in enumerate(self.packets) if not i % 2])
+
+    def test_range(self):
+        index = build_index(self.file, "crc")
+        self.assertEqual(index.positions_in_range(10, 14), range(10, 15))
+        self.assertEqual(index.positions_in_range(high=1), [0, 1])
+        self.assertEqual(index.find_range(low=58), self.packets[58:])
+        self.assertEqual(index.positions_in_range(100), [])
+
+    def test_invalid_path(self):
+        self.assertRaises(ValueError, build_index, self.file, "header.foo")
+        self.assertRaises(ValueError, build_index, self.file, "payload.Foo")
+        self.assertRaises(ValueError, build_index, self.file, "crc.foo")
@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from protopy.containers import Record, Member
+from protopy.parallel import parallel_decode, BufferRecords
+from protopy.primitives import String, UnsignedInteger
+from protopy.storage import RecordLogWriter
+from dummy import Header
+
+
+# Records sent back from the workers must be picklable, so this one is declared
+# at module level.
+class Message(Record):
+    sequence = Member(UnsignedInteger(width=4))
+    text = Member(String())
+
+
+class ParallelDecodeTest(TestCase):
+    def setUp(self):
+        self.headers = [Header(size=i % 0xffff) for i in xrange(1000)]
+        self.messages = [Message(sequence=i, text="m" * (i % 13))
+                         for i in xrange(1000)]
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_buffer(self):
+        for coder, records in ((Header, self.headers),
+                               (Message, self.messages)):
+            buf = bytearray("".join(r.encode() for r in records))
+            self.assertEqual(
+                parallel_decode(buf, coder, workers=3), records)
+            self.assertEqual(
+                list(parallel_decode(buf, coder, workers=2, shard_size=7,
+                                     stream=True)),
+                records)
+
+    def test_file(self):
+        path = os.path.join(self.directory, "messages.bin")
+        with RecordLogWriter(path, Message, index=True) as writer:
+            writer.write_many(self.messages)
+        self.assertEqual(
+            parallel_decode(path, Message, workers=4), self.messages)
+
+    def test_func(self):
+        buf = bytearray("".join(m.encode() for m in self.messages))
+        # Applied in the workers, so it need not be picklable.
+        sequence = lambda message: message.sequence
+        self.assertEqual(
+            parallel_decode(buf, Message, workers=3, func=sequence),
+            range(1000))
+        self.assertEqual(
+            list(parallel_decode(buf, Message, workers=2, shard_size=7,
+                                 stream=True, func=sequence)),
+            range(1000))
+
+    def test_empty(self):
+        self.assertEqual(parallel_decode(bytearray(), Message, workers=2), [])
+
+
+class BufferRecordsTest(TestCase):
+    def test_access(self):
+        messages = [Message(sequence=i, text="%s" % i) for i in xrange(20)]
+        records = BufferRecords(
+            buffer("".join(m.encode() for m in messages)), Message)
+        self.assertEqual(len(records), 20)
+        self.assertEqual(records[5], messages[5])
+        self.assertEqual(records[-1], messages[-1])
+        self.assertEqual(records[3:6], messages[3:6])
+        self.assertRaises(IndexError, records.__getitem__, 20)
@@ -19,3 +19,96 @@ d = Command.decode(b)
 e = time()
 
 print "Decoding took ", e - s
+
+from timeit import timeit
+
+from protopy.coders import Validation, validation
+from dummy import Header
+
+header = Header(size=10, inverted_size=~10 & 0xffff)
+encoded = header.encode()
+iterations = 100000
+
+for policy in (Validation.STRICT, Validation.DECODE_ONLY, Validation.OFF):
+    with validation(policy):
+        encoding = timeit(header.encode, number=iterations)
+        decoding = timeit(lambda: Header.decode(encoded), number=iterations)
+    print "Validation %-11s encode: %.3fs decode: %.3fs (%s iterations)" % (
+        policy.value, encoding, decoding, iterations)
+
+from protopy.primitives import Float, Sequence
+
+samples = [i * 0.5 for i in xrange(10000)]
+for container in Sequence.CONTAINERS:
+    try:
+        coder = Sequence(Float(), max_length=len(samples),
+                         include_length=True, container=container)
+    except ValueError:
+        # NumPy is not available.
+        continue
+    encoded = coder.encode(samples)
+    decoding = timeit(lambda: coder.decode(encoded), number=100)
+    print "Decoding %s floats into %-5s took %.3fs (100 iterations)" % (
+        len(samples), container, decoding)
+
+from dummy import Packet
+
+packet = Packet(header=Header(size=10), payload=Command.Dummy(counter_size=1))
+template = Packet.template(header=Header(size=10),
+                           payload=Command.Dummy(counter_size=1))
+encoding = timeit(packet.encode, number=iterations)
+patching = timeit(lambda: template.update(crc=7), number=iterations)
+print "Packet encode: %.3fs template update: %.3fs (%s iterations)" % (
+    encoding, patching, iterations)
+
+construction = timeit(Packet, number=iterations)
+positional = timeit(lambda: Header.from_values(0xcafebeef, 1, 2),
+                    number=iterations)
+print "Default Packet: %.3fs positional Header: %.3fs (%s iterations)" % (
+    construction, positional, iterations)
+
+from protopy.containers import RecordPool
+
+encoded_packet = packet.encode()
+pool = RecordPool(Packet)
+
+
+def pooled_decode():
+    pool.release(pool.decode(encoded_packet)[0])
+
+decoding = timeit(lambda: Packet.decode(encoded_packet), number=iterations)
+pooled = timeit(pooled_decode, number=iterations)
+print "Packet decode: %.3fs pooled decode: %.3fs (%s iterations)" % (
+    decoding, pooled, iterations)
+
+import sys
+from protopy.containers import FrozenRecord, Member
+from protopy.primitives import UnsignedInteger
+
+
+class FrozenHeader(FrozenRecord):
+    barker = Member(UnsignedInteger(default=0xcafebeef))
+    size = Member(UnsignedInteger(width=2))
+    inverted_size = Member(UnsignedInteger(width=2))
+
+encoded_header = Header(size=10).encode()
+decoding = timeit(lambda: Header.decode(encoded_header), number=iterations)
+frozen = timeit(lambda: FrozenHeader.decode(encoded_header),
+                number=iterations)
+header, frozen_header = Header(size=10), FrozenHeader(size=10)
+print "Header decode: %.3fs frozen: %.3fs (%s iterations)" % (
+    decoding, frozen, iterations)
+print "Header size: %s bytes, frozen: %s bytes" % (
+    sys.getsizeof(header) + sys.getsizeof(header.__dict__),
+    sys.getsizeof(frozen_header))
+
+from protopy.routing import Router
+
+router = Router(Command)
+router.route("General", lambda message: message)
+router.route("", lambda message: message, lazy=True)
+encoded_status = Command.General.GetStatus(uptime=1).encode()
+decoding = timeit(lambda: Command.decode(encoded_status), number=iterations)
+routing = timeit(lambda: router.dispatch(encoded_status), number=iterations)
+print "Command decode: %.3fs routing: %.3fs (%s iterations)" % (
+    decoding, routing, iterations)
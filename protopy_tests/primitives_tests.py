@@ -1,10 +1,12 @@
 import array
 from cStringIO import StringIO
-from unittest import TestCase
+from unittest import TestCase, skipIf
 
-from protopy.coders import Coder
+from protopy.coders import Coder, Validation, validation, set_validation, \
+    get_validation, Session
 from protopy.primitives import UnsignedInteger, SignedInteger, Boolean, \
-    Sequence, String, Char
+    Sequence, String, Char, Array, VarUInt, VarSInt, InternedString, Bytes, \
+    FixedString, Float, ByteOrder, numpy
 
 
 class CoderTests(TestCase):
@@ -17,6 +19,47 @@ class CoderTests(TestCase):
             self.assertRaises(NotImplementedError, func, *args)
 
 
+class ValidationTests(TestCase):
+    def setUp(self):
+        self.limited = UnsignedInteger(width=1, max_value=10)
+        self.sequence = Sequence(element_coder=self.limited, max_length=2)
+        self.string = String(max_length=4)
+
+    def tearDown(self):
+        set_validation(Validation.STRICT)
+
+    def test_default_policy(self):
+        self.assertIs(get_validation(), Validation.STRICT)
+        self.assertRaises(ValueError, self.limited.encode, 11)
+        self.assertRaises(ValueError, self.limited.decode, "\x0b")
+
+    def test_decode_only(self):
+        with validation(Validation.DECODE_ONLY):
+            self.assertEqual(self.limited.encode(11), "\x0b")
+            self.assertEqual(self.sequence.encode([1, 2, 3]), "\x01\x02\x03")
+            self.assertRaises(ValueError, self.limited.decode, "\x0b")
+
+    def test_off(self):
+        with validation("off"):
+            self.assertEqual(self.limited.decode("\x0b"), (11, ""))
+            self.assertEqual(self.string.encode("abcd"), "abcd\x00")
+            # Values which cannot be packed at all are still rejected.
+            self.assertRaises(ValueError, self.limited.encode, 256)
+        self.assertRaises(ValueError, self.string.encode, "abcd")
+
+    def test_global_policy(self):
+        set_validation(Validation.OFF)
+        self.assertEqual(self.limited.encode(11), "\x0b")
+        # Per-call policy takes precedence over the global one.
+        with validation(Validation.STRICT):
+            self.assertRaises(ValueError, self.limited.encode, 11)
+
+    def test_coder_policy(self):
+        self.limited.validation = Validation.OFF
+        self.assertEqual(self.limited.encode(11), "\x0b")
+        self.assertRaises(ValueError, UnsignedInteger(max_value=10).encode, 11)
+
+
 class UnsignedIntegerFieldTests(TestCase):
     def test_creation(self):
         """
@@ -112,6 +155,52 @@ class SignedIntegerTests(TestCase):
                 self.assertEqual(decoded_value, value)
 
 
+class VarIntTests(TestCase):
+    unsigned_cases = ((0, "\x00"), (1, "\x01"), (127, "\x7f"),
+                      (128, "\x80\x01"), (300, "\xac\x02"),
+                      (2 ** 64 - 1, "\xff" * 9 + "\x01"))
+    signed_cases = ((0, "\x00"), (-1, "\x01"), (1, "\x02"), (-2, "\x03"),
+                    (63, "\x7e"), (-64, "\x7f"), (64, "\x80\x01"),
+                    (-2 ** 63, "\xff" * 9 + "\x01"))
+
+    def test_coding(self):
+        for coder, cases in ((VarUInt(), self.unsigned_cases),
+                             (VarSInt(), self.signed_cases)):
+            for value, expected in cases:
+                self.assertEqual(coder.encode(value), expected)
+                self.assertEqual(coder.decode(expected + "\xaa"),
+                                 (value, "\xaa"))
+                self.assertEqual(coder.read_from(StringIO(expected)), value)
+
+    def test_bounds(self):
+        self.assertRaises(ValueError, VarUInt().encode, -1)
+        self.assertRaises(ValueError, VarUInt().encode, 2 ** 64)
+        self.assertRaises(ValueError, VarSInt().encode, 2 ** 63)
+        limited = VarUInt(max_value=1000)
+        self.assertEqual(limited.max_width, 2)
+        self.assertRaises(ValueError, limited.encode, 1001)
+        self.assertRaises(ValueError, limited.decode, "\xff\xff\x01")
+        self.assertRaises(ValueError, limited.decode, "\x80")
+
+    def test_bulk(self):
+        coder = VarSInt()
+        values = [0, -1, 1, 1000, -100000, 2 ** 40]
+        encoded = coder.encode_many(values)
+        self.assertEqual(encoded, "".join(coder.encode(v) for v in values))
+        self.assertEqual(coder.decode_many(encoded), (values, ""))
+        self.assertEqual(coder.decode_many(encoded + "\x05", len(values)),
+                         (values, "\x05"))
+
+    def test_sequence(self):
+        sequence = Sequence(VarUInt(), include_length=True,
+                            length_coder=VarUInt(max_value=100000))
+        values = [1, 200, 3]
+        encoded = sequence.encode(values)
+        self.assertEqual(encoded, "\x03\x01\xc8\x01\x03")
+        self.assertEqual(sequence.decode(encoded), (values, ""))
+        self.assertEqual(sequence.read_from(StringIO(encoded)), values)
+
+
 class BooleanFieldTests(TestCase):
     def test_encoding(self):
         f = Boolean()
@@ -149,6 +238,15 @@ class SequenceTest(TestCase):
     def test_default_value(self):
         self.assertEqual(self.with_length.default_value(), [])
 
+    def test_skip(self):
+        strings = Sequence(element_coder=String(), max_length=10,
+                           include_length=True)
+        for coder, value in ((self.with_length, range(50)),
+                             (strings, ["a", "", "bc"])):
+            stream = StringIO(coder.encode(value) + "rest")
+            coder.skip(stream)
+            self.assertEqual(stream.read(), "rest")
+
     def test_encoding_with_length(self):
         for i in xrange(self.with_length.min, self.with_length.max):
             items = [0x34] * i
@@ -189,6 +287,12 @@ class SequenceTest(TestCase):
             items, _ = self.with_length.decode(encoded)
             self.assertEqual(items, expected)
 
+    def test_fixed_size(self):
+        self.assertIsNone(self.with_length.fixed_size())
+        self.assertIsNone(self.without_length.fixed_size())
+        self.assertEqual(Array(UnsignedInteger(width=2), 10).fixed_size(), 20)
+        self.assertIsNone(Array(String(), 10).fixed_size())
+
     def test_decoding_without_length(self):
         for i in (self.without_length.min, self.without_length.max):
             expected = [0xaa] * i
@@ -260,3 +364,195 @@ class StringTest(TestCase):
         self.assertEqual(decoded, original)
         stream = StringIO(expected)
         self.assertEqual(coder.read_from(stream), original)
+
+    def test_skip(self):
+        for length in (0, 63, 64, 200):
+            stream = StringIO("a" * length + Char.NULL + "rest")
+            self.unlimited.skip(stream)
+            self.assertEqual(stream.read(), "rest")
+        stream = StringIO("a" * 200)
+        self.assertRaises(ValueError, self.unlimited.skip, stream)
+        # Truncated, so the stream is left at its end.
+        self.assertEqual(stream.tell(), 200)
+        self.assertRaises(ValueError, self.limited.skip,
+                          StringIO("a" * 200 + Char.NULL))
+
+
+class InternedStringTest(TestCase):
+    def test_coding(self):
+        coder = InternedString(max_length=100)
+        values = ["/bin", "/usr", "/bin", "/bin", "/usr"]
+        stream = StringIO()
+        with Session():
+            sizes = [coder.write_to(v, stream) for v in values]
+        self.assertEqual(sizes, [7, 7, 1, 1, 1])
+        self.assertEqual(stream.getvalue()[:7], "\x00\x01/bin\x00")
+
+        stream.reset()
+        with Session():
+            decoded = [coder.read_from(stream) for _ in values]
+        self.assertEqual(decoded, values)
+        # Occurrences of the same string share the same object.
+        self.assertIs(decoded[0], decoded[3])
+
+    def test_full_table(self):
+        coder = InternedString(max_entries=1)
+        with Session():
+            self.assertEqual(coder.encode("a"), "\x00\x01a\x00")
+            self.assertEqual(coder.encode("b"), "\x00\x00b\x00")
+            self.assertEqual(coder.encode("b"), "\x00\x00b\x00")
+            self.assertEqual(coder.encode("a"), "\x01")
+
+    def test_invalid(self):
+        coder = InternedString()
+        self.assertRaises(ValueError, coder.encode, "a")
+        with Session():
+            self.assertRaises(ValueError, coder.decode, "\x05")
+            self.assertRaises(ValueError, coder.encode, "a\x00")
+            # The invalid string was not added to the table.
+            self.assertEqual(coder.encode("b"), "\x00\x01b\x00")
+
+    def test_atomic(self):
+        coder = InternedString()
+        session = Session()
+        with self.assertRaises(ValueError):
+            with session.atomic():
+                coder.encode("a")
+                coder.encode("b")
+                raise ValueError("The message is discarded")
+        with session.atomic():
+            # Neither string was added to the table.
+            self.assertEqual(coder.encode("b"), "\x00\x01b\x00")
+            self.assertEqual(coder.encode("b"), "\x01")
+
+
+class BytesTest(TestCase):
+    fixed = Bytes(length=4)
+    prefixed = Bytes(length_coder=UnsignedInteger(width=2), max_length=1024)
+
+    def test_fixed(self):
+        self.assertEqual(self.fixed.fixed_size(), 4)
+        self.assertEqual(self.fixed.default_value(), "\x00" * 4)
+        self.assertEqual(self.fixed.encode("\x00\x01\x02\x03"),
+                         "\x00\x01\x02\x03")
+        self.assertEqual(self.fixed.encode(bytearray("abcd")), "abcd")
+        self.assertEqual(self.fixed.decode("abcdef"), ("abcd", "ef"))
+        self.assertEqual(self.fixed.read_from(StringIO("abcdef")), "abcd")
+        self.assertRaises(ValueError, self.fixed.encode, "abc")
+        self.assertRaises(ValueError, self.fixed.decode, "abc")
+
+    def test_prefixed(self):
+        blob = "\xff" * 1000
+        encoded = self.prefixed.encode(memoryview(blob))
+        self.assertEqual(encoded, "\x03\xe8" + blob)
+        stream = StringIO()
+        self.assertEqual(self.prefixed.write_to(blob, stream), 1002)
+        self.assertEqual(stream.getvalue(), encoded)
+        self.assertEqual(self.prefixed.read_from(StringIO(encoded)), blob)
+        self.assertRaises(ValueError, self.prefixed.encode, "\x00" * 1025)
+        self.assertRaises(ValueError, self.prefixed.decode, "\x00\x05abc")
+
+    def test_skip(self):
+        stream = StringIO(self.prefixed.encode("abc") + "rest")
+        self.prefixed.skip(stream)
+        self.assertEqual(stream.read(), "rest")
+        stream = StringIO("\x00\x05abc")
+        self.assertRaises(ValueError, self.prefixed.skip, stream)
+        self.assertEqual(stream.tell(), 5)
+
+    def test_zero_copy(self):
+        data = bytearray("\x00\x03abcdef")
+        value, remainder = self.prefixed.decode(data)
+        self.assertIsInstance(value, memoryview)
+        self.assertEqual(value.tobytes(), "abc")
+        self.assertEqual(remainder.tobytes(), "def")
+        # The view refers to the original buffer.
+        data[2] = "x"
+        self.assertEqual(value.tobytes(), "xbc")
+
+
+class FixedStringTest(TestCase):
+    def test_coding(self):
+        coder = FixedString(8)
+        self.assertEqual(coder.fixed_size(), 8)
+        self.assertEqual(coder.encode("abc"), "abc\x00\x00\x00\x00\x00")
+        self.assertEqual(coder.decode("abc\x00\x00\x00\x00\x00!"),
+                         ("abc", "!"))
+        self.assertEqual(coder.read_from(StringIO(coder.encode("12345678"))),
+                         "12345678")
+        self.assertRaises(ValueError, coder.encode, "123456789")
+        self.assertRaises(ValueError, coder.decode, "abc")
+
+    def test_padding(self):
+        coder = FixedString(4, pad=" ")
+        self.assertEqual(coder.encode("ab"), "ab  ")
+        self.assertEqual(coder.decode("ab  "), ("ab", ""))
+        self.assertRaises(ValueError, FixedString, 4, pad="ab")
+
+
+class FloatTest(TestCase):
+    def test_coding(self):
+        for width, byte_order, expected in (
+                (4, ByteOrder.MSB_FIRST, "\x3f\xc0\x00\x00"),
+                (4, ByteOrder.LSB_FIRST, "\x00\x00\xc0\x3f"),
+                (8, ByteOrder.MSB_FIRST, "\x3f\xf8" + "\x00" * 6)):
+            coder = Float(width=width, byte_order=byte_order)
+            self.assertEqual(coder.fixed_size(), width)
+            self.assertEqual(coder.encode(1.5), expected)
+            self.assertEqual(coder.decode(expected + "!"), (1.5, "!"))
+            self.assertEqual(coder.read_from(StringIO(expected)), 1.5)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, Float, width=2)
+        self.assertRaises(ValueError, Float(width=4).encode, 1e300)
+        self.assertRaises(ValueError, Float().encode, "1.5")
+        self.assertRaises(ValueError, Float().decode, "\x00")
+
+
+class BulkSequenceTest(TestCase):
+    values = [0.5, -1.25, 3.0, 1e10]
+
+    def test_list(self):
+        coder = Sequence(Float(width=4), max_length=10, include_length=True)
+        encoded = coder.encode(self.values)
+        self.assertEqual(encoded, "\x04" + "".join(
+            Float(width=4).encode(v) for v in self.values))
+        self.assertEqual(coder.decode(encoded), (self.values, ""))
+
+    def test_array(self):
+        for element in (Float(width=4, byte_order=ByteOrder.LSB_FIRST),
+                        Float(width=8)):
+            coder = Array(element, 4, container="array")
+            encoded = coder.encode(self.values)
+            decoded, remainder = coder.decode(encoded + "!")
+            self.assertIsInstance(decoded, array.array)
+            self.assertEqual(decoded.tolist(), self.values)
+            self.assertEqual(remainder, "!")
+
+        coder = Array(UnsignedInteger(width=8), 2, container="array")
+        decoded, _ = coder.decode("\x00" * 7 + "\x01" + "\xff" * 8)
+        self.assertEqual(decoded.tolist(), [1, 2 ** 64 - 1])
+
+    def test_integer_bounds(self):
+        coder = Sequence(UnsignedInteger(width=1, max_value=100),
+                         max_length=10, include_length=True)
+        self.assertEqual(coder.encode([1, 100]), "\x02\x01\x64")
+        self.assertRaises(ValueError, coder.encode, [1, 101])
+        self.assertRaises(ValueError, coder.decode, "\x02\x01\x65")
+        self.assertRaises(ValueError, coder.decode, "\x02\x01")
+
+    def test_invalid_container(self):
+        self.assertRaises(ValueError, Sequence, String(), max_length=10,
+                          container="array")
+        self.assertRaises(ValueError, Sequence, Float(), max_length=10,
+                          container="tuple")
+
+    @skipIf(numpy is None, "NumPy is not available")
+    def test_numpy(self):
+        coder = Sequence(Float(width=4), max_length=10, include_length=True,
+                         container="numpy")
+        values = numpy.array(self.values, dtype=numpy.float32)
+        encoded = coder.encode(values)
+        self.assertEqual(encoded, coder.encode(self.values))
+        decoded, _ = coder.decode(encoded)
+        self.assertTrue(numpy.array_equal(decoded, values))
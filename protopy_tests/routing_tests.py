@@ -0,0 +1,257 @@
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from protopy.routing import Router, LazyMessage, Dispatcher
+from dummy import Command, General, Packet
+
+
+class PeekTest(TestCase):
+    def test_peek_tag(self):
+        encoded = Command.General.Reset().encode()
+        self.assertIs(Command.peek_tag(encoded), Command.tag_enum.General)
+        self.assertIs(Command.peek_tag(memoryview(bytearray(encoded))),
+                      Command.tag_enum.General)
+        self.assertRaises(ValueError, Command.peek_tag, "")
+        self.assertRaises(ValueError, Command.peek_tag, "\x77")
+
+    def test_peek_path(self):
+        self.assertEqual(
+            Command.peek_path(Command.General.GetStatus(uptime=1).encode()),
+            (Command.tag_enum.General, General.tag_enum.GetStatus))
+        self.assertEqual(Command.peek_path(Command.Dummy().encode()),
+                         (Command.tag_enum.Dummy,))
+        # Only the tags are read.
+        self.assertEqual(Command.peek_path("\x54\x02"),
+                         (Command.tag_enum.General, General.tag_enum.Reset))
+        self.assertRaises(ValueError, Command.peek_path, "\x54")
+
+
+class RouterTest(TestCase):
+    def setUp(self):
+        self.received = []
+        self.router = Router(Command)
+
+    def handler(self, name):
+        def handle(message):
+            self.received.append((name, message))
+            return name
+        return handle
+
+    def test_longest_path(self):
+        self.router.route("General", self.handler("general"))
+        self.router.route("General.Reset", self.handler("reset"))
+        self.router.route([0x12], self.handler("dummy"))
+        self.router.route("", self.handler("other"))
+
+        messages = [Command.General.Reset(), Command.General.GetStatus(),
+                    Command.Dummy(), Command.Upgrade(path="/")]
+        self.assertEqual(
+            [self.router.dispatch(message.encode()) for message in messages],
+            ["reset", "general", "dummy", "other"])
+        # Handlers get the encoding itself.
+        name, view = self.received[0]
+        self.assertIsInstance(view, memoryview)
+        self.assertEqual(view.tobytes(), messages[0].encode())
+
+    def test_no_route(self):
+        self.router.route("General.Reset", self.handler("reset"))
+        self.assertRaises(ValueError, self.router.dispatch,
+                          Command.General.GetStatus().encode())
+
+    def test_lazy(self):
+        self.router.route("Upgrade", self.handler("upgrade"), lazy=True)
+        buf = bytearray(Command.Upgrade(path="/boot").encode())
+        self.router.dispatch(buf)
+        _, message = self.received[0]
+        self.assertIsInstance(message, LazyMessage)
+        self.assertEqual(message.path, (Command.tag_enum.Upgrade,))
+        self.assertIsNone(message._value)
+        self.assertEqual(message.value, Command.Upgrade(path="/boot"))
+
+        self.router.dispatch(buf + "!")
+        _, message = self.received[1]
+        self.assertRaises(ValueError, getattr, message, "value")
+
+    def test_invalid_routes(self):
+        self.assertRaises(ValueError, Router, Packet)
+        self.assertRaises(ValueError, self.router.route, "Missing",
+                          self.handler(None))
+        self.assertRaises(ValueError, self.router.route, "Dummy.Missing",
+                          self.handler(None))
+        self.assertRaises(ValueError, self.router.route, [0x77],
+                          self.handler(None))
+
+
+def fail_on_odd(message):
+    # Runs in a worker process, so it must be defined at module level.
+    if message.value.counter_size % 2:
+        raise ValueError("Odd counter")
+
+
+# Where record_handled writes. Set before the worker processes are forked.
+handled_log = None
+
+
+def record_handled(message):
+    time.sleep(random.random() * 0.01)
+    with open(handled_log, "a") as log:
+        log.write("%s\n" % (message.value.counter_size,))
+
+
+def sleep_briefly(message):
+    time.sleep(0.3)
+
+
+class DispatcherTest(TestCase):
+    def test_handlers(self):
+        received = []
+        with Dispatcher(Command) as dispatcher:
+            dispatcher.register(Command.General, received.append)
+            dispatcher.register(General.Reset, lambda m: received.append(1))
+            dispatcher.submit(Command.General.Reset().encode())
+            dispatcher.submit(Command.General.GetStatus(uptime=2).encode())
+            self.assertRaises(ValueError, dispatcher.submit,
+                              Command.Dummy().encode())
+            self.assertRaises(ValueError, dispatcher.submit,
+                              Command.General.Reset().encode() + "!")
+        self.assertEqual(received, [1, Command.General.GetStatus(uptime=2)])
+        self.assertRaises(ValueError, dispatcher.dispatch,
+                          Command.General.Reset())
+        self.assertRaises(ValueError, Dispatcher, Packet)
+
+    def test_choice_route(self):
+        received = []
+        with Dispatcher(Command) as dispatcher:
+            dispatcher.register(Command, received.append)
+            dispatcher.dispatch(Command.Dummy())
+            dispatcher.dispatch(Command.General.Reset())
+        self.assertEqual(received, [Command.Dummy(), Command.General.Reset()])
+
+        router = Router(Command)
+        router.route(Command, len)
+        self.assertEqual(router.dispatch(Command.Dummy().encode()), 5)
+
+    def test_failing_error_handler(self):
+        def fail(message, error):
+            raise RuntimeError("Failed to report")
+
+        with Dispatcher(Command, queue_size=1, on_error=fail) as dispatcher:
+            dispatcher.register(Command.Dummy, fail_on_odd)
+            for i in xrange(10):
+                dispatcher.dispatch(Command.Dummy(counter_size=i))
+        stats = dispatcher.metrics()["routes"]["Dummy"]
+        self.assertEqual((stats["handled"], stats["errors"]), (10, 5))
+
+    def test_ordering(self):
+        received = {}
+        lock = threading.Lock()
+
+        def handle(message):
+            with lock:
+                received.setdefault(message.value.counter_size % 3,
+                                    []).append(message.value.counter_size)
+
+        with Dispatcher(Command, lanes=4, queue_size=2,
+                        key=lambda m: m.value.counter_size % 3) as dispatcher:
+            dispatcher.register(Command.Dummy, handle)
+            for i in xrange(300):
+                dispatcher.dispatch(Command.Dummy(counter_size=i))
+        self.assertEqual(received, {key: range(key, 300, 3)
+                                    for key in xrange(3)})
+
+    def test_metrics(self):
+        errors = []
+        started = threading.Semaphore(0)
+        release = threading.Event()
+
+        def handle(message):
+            started.release()
+            release.wait()
+            fail_on_odd(message)
+
+        dispatcher = Dispatcher(
+            Command, lanes=2, key=lambda m: m.value.counter_size,
+            on_error=lambda message, error: errors.append(error))
+        dispatcher.register("Dummy", handle)
+        for i in xrange(10):
+            dispatcher.dispatch(Command.Dummy(counter_size=i))
+        # Each lane is blocked on its first message.
+        started.acquire()
+        started.acquire()
+        self.assertEqual(sum(dispatcher.metrics()["queue_depths"]), 8)
+        release.set()
+        dispatcher.join()
+        metrics = dispatcher.metrics()
+        self.assertEqual(metrics["queue_depths"], [0, 0])
+        stats = metrics["routes"]["Dummy"]
+        self.assertEqual((stats["handled"], stats["errors"]), (10, 5))
+        self.assertGreater(stats["max_latency"], 0)
+        self.assertLessEqual(stats["mean_latency"], stats["max_latency"])
+        self.assertEqual(len(errors), 5)
+        dispatcher.close()
+
+    def test_processes(self):
+        with Dispatcher(Command, lanes=2, processes=2,
+                        key=lambda m: m.value.counter_size) as dispatcher:
+            dispatcher.register(Command.Dummy, fail_on_odd)
+            for i in xrange(20):
+                dispatcher.dispatch(Command.Dummy(counter_size=i))
+        stats = dispatcher.metrics()["routes"]["Dummy"]
+        self.assertEqual((stats["handled"], stats["errors"]), (20, 10))
+
+    def test_process_parallelism(self):
+        with Dispatcher(Command, processes=4,
+                        key=lambda m: m.value.counter_size) as dispatcher:
+            dispatcher.register(Command.Dummy, sleep_briefly)
+            started = time.time()
+            for i in xrange(4):
+                dispatcher.dispatch(Command.Dummy(counter_size=i))
+            dispatcher.join()
+        # A single lane handles its messages in all the processes at once.
+        self.assertLess(time.time() - started, 0.9)
+
+    def test_process_ordering(self):
+        global handled_log
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        handled_log = os.path.join(directory, "handled")
+        with Dispatcher(Command, processes=3,
+                        key=lambda m: m.value.counter_size % 3) as dispatcher:
+            dispatcher.register(Command.Dummy, record_handled)
+            for i in xrange(60):
+                dispatcher.dispatch(Command.Dummy(counter_size=i))
+        with open(handled_log) as log:
+            handled = [int(line) for line in log]
+        self.assertEqual(sorted(handled), range(60))
+        for key in xrange(3):
+            self.assertEqual([i for i in handled if i % 3 == key],
+                             range(key, 60, 3))
+
+    def test_close_while_dispatching(self):
+        handled = []
+        dispatched = []
+
+        def dispatch():
+            for i in xrange(10000):
+                try:
+                    dispatcher.dispatch(Command.Dummy(counter_size=i))
+                except ValueError:
+                    return
+                dispatched.append(i)
+
+        dispatcher = Dispatcher(Command, lanes=2, queue_size=4)
+        dispatcher.register(Command.Dummy, handled.append)
+        threads = [threading.Thread(target=dispatch) for _ in xrange(4)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        dispatcher.close()
+        for thread in threads:
+            thread.join()
+        # Every message was either refused or handled.
+        self.assertEqual(len(handled), len(dispatched))
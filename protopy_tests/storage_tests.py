@@ -0,0 +1,184 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from protopy.storage import RecordFile, RecordLogWriter, Fsync, read_index, \
+    index_path_for, file_stamp
+from protopy.containers import Record, Member
+from protopy.primitives import InternedString, UnsignedInteger
+from dummy import Header, Command
+
+
+class Event(Record):
+    path = Member(InternedString())
+
+
+class Tagged(Record):
+    name = Member(InternedString())
+    count = Member(UnsignedInteger(width=1))
+
+
+class RecordFileTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "records.bin")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_records(self, records, mode="wb"):
+        with open(self.path, mode) as f:
+            for record in records:
+                record.write_to(f)
+
+
+class FixedSizeRecordFileTest(RecordFileTestCase):
+    def setUp(self):
+        super(FixedSizeRecordFileTest, self).setUp()
+        self.headers = [Header(size=i, inverted_size=0xffff - i)
+                        for i in xrange(100)]
+        self.write_records(self.headers)
+
+    def test_random_access(self):
+        with RecordFile(self.path, Header) as records:
+            self.assertEqual(len(records), len(self.headers))
+            self.assertEqual(records[42], self.headers[42])
+            self.assertEqual(records[-1], self.headers[-1])
+            self.assertEqual(records[10:13], self.headers[10:13])
+            self.assertRaises(IndexError, records.__getitem__, 100)
+
+    def test_iteration(self):
+        with RecordFile(self.path, Header) as records:
+            self.assertEqual(list(records), self.headers)
+        # Fixed-size files do not need an index.
+        self.assertFalse(os.path.exists(index_path_for(self.path)))
+
+    def test_truncated(self):
+        with open(self.path, "ab") as f:
+            f.write("\x00\x01")
+        with RecordFile(self.path, Header) as records:
+            self.assertEqual(len(records), len(self.headers))
+
+    def test_empty(self):
+        open(self.path, "wb").close()
+        with RecordFile(self.path, Header) as records:
+            self.assertEqual(len(records), 0)
+            self.assertEqual(list(records), [])
+
+
+class VariableSizeRecordFileTest(RecordFileTestCase):
+    def setUp(self):
+        super(VariableSizeRecordFileTest, self).setUp()
+        self.commands = [Command.Upgrade(path="/" * i) if i % 2 else
+                         Command.Dummy(counter_size=i) for i in xrange(50)]
+        self.write_records(self.commands)
+
+    def test_random_access(self):
+        with RecordFile(self.path, Command) as records:
+            self.assertEqual(len(records), len(self.commands))
+            for i in (0, 1, 25, -1):
+                self.assertEqual(records[i], self.commands[i])
+            self.assertEqual(list(records), self.commands)
+
+    def test_index_persisted(self):
+        RecordFile(self.path, Command).close()
+        ends = read_index(index_path_for(self.path))
+        self.assertEqual(len(ends), len(self.commands))
+        self.assertEqual(ends[-1], os.path.getsize(self.path))
+
+    def test_index_extended(self):
+        RecordFile(self.path, Command).close()
+        more = [Command.Upgrade(path="more")] * 3
+        self.write_records(more, mode="ab")
+        with RecordFile(self.path, Command) as records:
+            self.assertEqual(list(records), self.commands + more)
+
+    def test_index_stale(self):
+        RecordFile(self.path, Command).close()
+        # Rewritten in place, rather than appended to.
+        rewritten = [Command.Upgrade(path="/" * i) for i in xrange(60)]
+        self.write_records(rewritten)
+        with RecordFile(self.path, Command) as records:
+            self.assertEqual(list(records), rewritten)
+            self.assertEqual(records[-1], rewritten[-1])
+
+    def test_truncated(self):
+        with open(self.path, "ab") as f:
+            f.write(Command.Upgrade(path="truncated").encode()[:-3])
+        with RecordFile(self.path, Command) as records:
+            self.assertEqual(list(records), self.commands)
+
+    def test_corrupt(self):
+        data = "".join(command.encode() for command in self.commands[:10])
+        with open(self.path, "wb") as f:
+            f.write(data + "\xff" + data)
+        self.assertRaises(ValueError, RecordFile, self.path, Command)
+
+
+class RecordLogWriterTest(RecordFileTestCase):
+    def setUp(self):
+        super(RecordLogWriterTest, self).setUp()
+        self.commands = [Command.Upgrade(path="x" * (i % 7)) if i % 3 else
+                         Command.Dummy(counter_size=i) for i in xrange(100)]
+
+    def test_buffering(self):
+        writer = RecordLogWriter(self.path, Command, flush_size=1 << 20)
+        writer.write_many(self.commands)
+        # Nothing reached the file yet.
+        self.assertEqual(os.path.getsize(self.path), 0)
+        writer.close()
+        expected = "".join(command.encode() for command in self.commands)
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), expected)
+
+    def test_flush_thresholds(self):
+        with RecordLogWriter(self.path, Command, flush_records=10) as writer:
+            writer.write_many(self.commands[:15])
+            self.assertEqual(
+                os.path.getsize(self.path),
+                sum(len(command.encode()) for command in self.commands[:10]))
+
+        path = os.path.join(self.directory, "headers.bin")
+        with RecordLogWriter(path, Header, flush_size=16) as writer:
+            for _ in xrange(3):
+                writer.write(Header())
+            self.assertEqual(os.path.getsize(path), 16)
+
+    def test_index(self):
+        with RecordLogWriter(self.path, Command, flush_records=7,
+                             index=True, fsync=Fsync.ON_FLUSH) as writer:
+            writer.write_many(self.commands[:50])
+        # Reopening appends to the same log and index.
+        with RecordLogWriter(self.path, Command, index=True) as writer:
+            writer.write_many(self.commands[50:])
+
+        ends = read_index(index_path_for(self.path))
+        self.assertEqual(len(ends), len(self.commands))
+        self.assertEqual(ends[-1], os.path.getsize(self.path))
+        # The index is up to date, so it is used without scanning the log.
+        with open(self.path, "rb") as f:
+            self.assertEqual(
+                read_index(index_path_for(self.path), file_stamp(f)), ends)
+        with RecordFile(self.path, Command) as records:
+            self.assertEqual(records[73], self.commands[73])
+            self.assertEqual(list(records), self.commands)
+
+    def test_session(self):
+        events = [Event(path="/dev/sd%s" % (i % 3,)) for i in xrange(30)]
+        with RecordLogWriter(self.path, Event) as writer:
+            writer.write_many(events)
+        # Each string is sent in full only once.
+        self.assertEqual(os.path.getsize(self.path), 3 * 11 + 27)
+        with RecordFile(self.path, Event) as records:
+            self.assertEqual(records[29], events[29])
+            self.assertEqual(list(records), events)
+
+    def test_failed_write(self):
+        with RecordLogWriter(self.path, Tagged) as writer:
+            self.assertRaises(ValueError, writer.write,
+                              Tagged(name="abc", count=300))
+            writer.write(Tagged(name="abc", count=1))
+        # The string is sent in full, since the failed record was not.
+        with RecordFile(self.path, Tagged) as records:
+            self.assertEqual(list(records), [Tagged(name="abc", count=1)])
@@ -0,0 +1,204 @@
+import io
+import os
+import shutil
+import socket
+import tempfile
+import threading
+from unittest import TestCase, skipIf
+
+from protopy.containers import Record, Member
+from protopy.primitives import UnsignedInteger, Bytes, Float, Sequence, \
+    String, VarUInt, numpy
+from protopy.streams import IovWriter, BufferedSource, write_iov, send_iov, \
+    encoding_buffer, MAX_RETAINED_SIZE
+from dummy import Command
+
+
+class Upload(Record):
+    id = Member(UnsignedInteger(width=4))
+    name = Member(Bytes(length_coder=UnsignedInteger(width=1)))
+    data = Member(Bytes(length_coder=UnsignedInteger(width=4)))
+    checksum = Member(UnsignedInteger(width=2))
+
+
+class IovWriterTest(TestCase):
+    def test_coalescing(self):
+        writer = IovWriter(threshold=4)
+        payload = "x" * 10
+        for data in ("a", "bc", payload, "d", "e"):
+            writer.write(data)
+        buffers = writer.buffers()
+        self.assertEqual(len(buffers), 3)
+        self.assertIs(buffers[1], payload)
+        self.assertEqual(len(writer), 15)
+        self.assertEqual(writer.getvalue(), "abc" + payload + "de")
+
+    def test_encode_iov(self):
+        payload = "p" * 4096
+        upload = Upload(id=1, name="file", data=payload, checksum=2)
+        buffers = upload.encode_iov()
+        self.assertEqual(len(buffers), 3)
+        self.assertIs(buffers[1], payload)
+        self.assertEqual("".join(str(b) for b in buffers), upload.encode())
+        self.assertEqual(Upload.encode_iov(upload), buffers)
+
+        small = Upload(id=1, name="file", data="p", checksum=2)
+        self.assertEqual(len(Upload.encode_iov(small)), 1)
+
+    @skipIf(numpy is None, "NumPy is not available")
+    def test_numpy_by_reference(self):
+        coder = Sequence(Float(), max_length=1000, include_length=True)
+        values = numpy.arange(1000, dtype=">f8")
+        buffers = coder.encode_iov(values)
+        self.assertEqual(len(buffers), 2)
+        # The buffer shares the memory of the array.
+        values[0] = 1.5
+        self.assertEqual(str(buffers[1])[:8], Float().encode(1.5))
+
+
+class SendTest(TestCase):
+    buffers = [bytearray("head"), "x" * 100000, memoryview("tail")[1:]]
+    expected = "head" + "x" * 100000 + "ail"
+
+    def send_and_receive(self, send, receive):
+        # The data exceeds the capacity of the pipe / socket, so it is received
+        # concurrently, and partial writes are retried.
+        received = []
+
+        def read_all():
+            chunks = []
+            remaining = len(self.expected)
+            while remaining:
+                chunk = receive(remaining)
+                chunks.append(chunk)
+                remaining -= len(chunk)
+            received.append("".join(chunks))
+
+        reader = threading.Thread(target=read_all)
+        reader.start()
+        self.assertEqual(send(self.buffers), len(self.expected))
+        reader.join()
+        self.assertEqual(received, [self.expected])
+
+    def test_write_iov(self):
+        read_fd, write_fd = os.pipe()
+        try:
+            self.send_and_receive(lambda buffers: write_iov(write_fd, buffers),
+                                  lambda size: os.read(read_fd, size))
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+
+    def test_send_iov(self):
+        sender, receiver = socket.socketpair()
+        try:
+            self.send_and_receive(lambda buffers: send_iov(sender, buffers),
+                                  receiver.recv)
+        finally:
+            sender.close()
+            receiver.close()
+
+
+class Sample(Record):
+    name = Member(String(max_length=16))
+    id = Member(VarUInt())
+    values = Member(Sequence(Float(width=4), max_length=100,
+                             include_length=True))
+    flags = Member(UnsignedInteger(width=2))
+
+
+class BufferedSourceTest(TestCase):
+    samples = [Sample(name="s%s" % (i,), id=i * 1000, values=[0.5] * i,
+                      flags=i) for i in xrange(50)]
+    commands = [Command.Upgrade(path="/" * i) if i % 2 else
+                Command.Dummy(counter_size=i) for i in xrange(50)]
+
+    def test_socket(self):
+        sender, receiver = socket.socketpair()
+        try:
+            data = "".join(sample.encode() for sample in self.samples)
+            sender.sendall(data)
+            sender.close()
+            # A small buffer, so it is refilled and grown along the way.
+            source = BufferedSource(receiver, capacity=8)
+            self.assertEqual([Sample.read_from(source) for _ in self.samples],
+                             self.samples)
+            self.assertEqual(source.tell(), len(data))
+            self.assertRaises(ValueError, Sample.read_from, source)
+        finally:
+            receiver.close()
+
+    def test_file(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "commands.bin")
+            with open(path, "wb") as f:
+                for command in self.commands:
+                    command.write_to(f)
+            with io.open(path, "rb") as f:
+                source = BufferedSource(f, capacity=16)
+                self.assertEqual(
+                    [Command.read_from(source) for _ in self.commands],
+                    self.commands)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_primitives(self):
+        source = BufferedSource(io.BytesIO("abc\x00\x01\x02rest"),
+                                capacity=2)
+        self.assertEqual(source.peek(2).tobytes(), "ab")
+        self.assertEqual(source.find("\x00"), 3)
+        self.assertEqual(source.find("\x00", limit=3), -1)
+        self.assertEqual(String().read_from(source), "abc")
+        self.assertRaises(ValueError, String(max_length=2).read_from,
+                          BufferedSource(io.BytesIO("abc\x00")))
+        self.assertEqual(
+            UnsignedInteger(width=2).read_from(source), 0x0102)
+        self.assertRaises(ValueError, source.consume, 5)
+        self.assertEqual(source.read(), "rest")
+        self.assertEqual(source.read(), "")
+        self.assertRaises(ValueError, UnsignedInteger().read_from, source)
+        self.assertRaises(ValueError, String().read_from, source)
+
+    def test_invalid_source(self):
+        self.assertRaises(ValueError, BufferedSource, "data")
+
+
+class EncodingBufferTest(TestCase):
+    def test_batching(self):
+        with encoding_buffer() as buf:
+            for sample in BufferedSourceTest.samples:
+                sample.write_to(buf)
+            expected = "".join(sample.encode()
+                               for sample in BufferedSourceTest.samples)
+            self.assertEqual(buf.getvalue(), expected)
+
+    def test_reuse(self):
+        with encoding_buffer() as buf:
+            buf.write("data")
+            with encoding_buffer() as inner:
+                # Nested blocks get buffers of their own.
+                self.assertIsNot(inner, buf)
+        with encoding_buffer() as again:
+            self.assertIn(again, (buf, inner))
+            self.assertEqual(len(again), 0)
+
+    def test_spikes(self):
+        with encoding_buffer() as buf:
+            buf.write("x" * (MAX_RETAINED_SIZE + 1))
+        with encoding_buffer() as again:
+            self.assertIs(again, buf)
+            self.assertLessEqual(len(again.buffer), MAX_RETAINED_SIZE)
+
+    def test_threads(self):
+        buffers = []
+
+        def borrow():
+            with encoding_buffer() as buf:
+                buffers.append(buf)
+
+        with encoding_buffer() as buf:
+            thread = threading.Thread(target=borrow)
+            thread.start()
+            thread.join()
+        self.assertIsNot(buffers[0], buf)